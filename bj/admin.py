@@ -1,3 +1,21 @@
 from django.contrib import admin
 
-# Register your models here.
+from bj.models import Hand, Player, Round
+
+
+@admin.register(Player)
+class PlayerAdmin(admin.ModelAdmin):
+    list_display = ("name", "chips", "updated_at")
+    search_fields = ("name",)
+
+
+@admin.register(Round)
+class RoundAdmin(admin.ModelAdmin):
+    list_display = ("room", "number", "dealer_cards", "dealer_value", "finished_at")
+    list_filter = ("room",)
+
+
+@admin.register(Hand)
+class HandAdmin(admin.ModelAdmin):
+    list_display = ("round", "player", "hand_index", "cards", "outcome", "bet", "payout")
+    list_filter = ("outcome",)
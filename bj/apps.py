@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BjConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bj'
+
+    def ready(self):
+        from bj import log, strategy
+        log.start()
+        strategy.load_tables()
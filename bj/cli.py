@@ -0,0 +1,97 @@
+from bj.blackjack import Shoe
+from bj.engine import MAX_SEATS, BlackjackEngine, InvalidAction
+
+# The engine actions a player can type at the prompt.
+HAND_ACTIONS = ("hit", "stand", "split", "double")
+
+
+class BlackjackGame:
+    def __init__(self, num_decks=2, rng=None):
+        self.engine = BlackjackEngine(shoe=Shoe(num_decks, rng))
+
+    def add_player(self, name):
+        self.engine.join(name, 500)
+
+    def show(self, events):
+        for event in events:
+            player = self.engine.players.get(event.get("player_name"))
+            if event["type"] == "deal":
+                hand = player.hands[0]
+                print(f"{player.name}'s hand: {hand} ({hand.value})")
+            elif event["type"] in ("card", "split"):
+                for hand in player.hands:
+                    print(f"{player.name}'s hand: {hand} ({hand.value})")
+            elif event["type"] == "bust":
+                print("Busted!")
+            elif event["type"] == "blackjack":
+                print("Blackjack!")
+            elif event["type"] == "dealer_card":
+                print(f"Dealer draws {event['card']}")
+            elif event["type"] == "result":
+                print(event["message"])
+            elif event["type"] == "round_end":
+                dealer_cards = ", ".join(str(card) for card in event["dealer_cards"])
+                print(f"Dealer's hand: {dealer_cards} ({event['dealer_value']})")
+
+    def play_player_hands(self):
+        engine = self.engine
+        for name in list(engine.turns):
+            player = engine.players[name]
+            while engine.turns.get(name, len(player.hands)) < len(player.hands):
+                hand_index = engine.turns[name]
+                hand = player.hands[hand_index]
+                print(f"{player.name}'s hand: {hand} ({hand.value})")
+                if hand.is_splitable():
+                    action = input("Do you want to hit, stand, split, or double down? ")
+                else:
+                    action = input("Do you want to hit, stand, or double down? ")
+                action = action.lower()
+                if action not in HAND_ACTIONS:
+                    print("Invalid action. Please enter hit, stand, split or double.")
+                    continue
+                try:
+                    self.show(engine.apply(action, name, hand_index=hand_index))
+                except InvalidAction as e:
+                    print(e)
+        print()
+
+    def play_game(self):
+        print("Welcome to Blackjack!")
+        while True:
+            num_players = int(input("How many players? "))
+            if not 0 < num_players <= MAX_SEATS:
+                print(f"Invalid number of players. Please enter a number from 1 to {MAX_SEATS}.")
+                continue
+            for i in range(num_players):
+                while True:
+                    name = input(f"Enter player {i + 1}'s name: ")
+                    try:
+                        self.add_player(name)
+                        break
+                    except InvalidAction as e:
+                        print(e)
+            while True:
+                for player in self.engine.players.values():
+                    while True:
+                        bet_amount = int(input(f"{player.name}, how many chips do you want to bet? "))
+                        try:
+                            self.engine.bet(player.name, bet_amount)
+                            break
+                        except InvalidAction:
+                            print(f"You don't have enough chips. You have {player.chips} chips left.")
+                events = self.engine.apply("deal")
+                print(f"Dealer's hand: {self.engine.dealer.hands[0].cards[0]}, [hidden card]")
+                self.show(events)
+                self.play_player_hands()
+                for player in self.engine.players.values():
+                    print(f"{player.name} has {player.chips} chips left.")
+                self.engine.new_round()
+                play_again = input("Do you want to play again? (y/n) ")
+                if play_again.lower() == "n":
+                    break
+            break
+        print("Thanks for playing!")
+
+
+if __name__ == "__main__":
+    BlackjackGame().play_game()
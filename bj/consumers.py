@@ -1,460 +1,233 @@
-import asyncio
 import json
-import traceback
+import sys
+import time
+from urllib.parse import parse_qsl
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.layers import get_channel_layer
 
-from blackjack_django.asgi import Shoe, Player, Dealer, User
+from bj import metrics
+from bj.engine import InvalidAction
+from bj.lobby import LOBBY_GROUP, matches, parse_query
+from bj.log import get_room_log
+from bj.protocol import batch_frames, decode_binary_message, encode_binary_frame, encode_op, negotiate
+from bj.rooms import get_worker
+from bj.serialization import dumps
 
-channel_layer = get_channel_layer()
+# Actions forwarded to the room as they are, with the hand they apply to.
+ACTIONS = ("hit", "stand", "split", "double", "hint")
+MESSAGE_TYPES = ("join", "resume", "deal", "batch", "profile") + ACTIONS
+MAX_BATCH = 64
 
 
 class BlackjackGameConsumer(AsyncWebsocketConsumer):
-    room_shoes = {}
-    timer_task = {}
-    room_players = {}
-    room_finished_hands = {}
-    dealer_hand = {}
-
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.player = None
-        self.dealer = Dealer()
-        self.shoe = None
-        self.bet = None
+        self.worker = None
+        # The first seat taken, which messages without a "seat" act for, and
+        # every seat held.
+        self.player_name = None
+        self.seats = set()
+        self.protocol = 1
+        self.binary = False
+        self.batch_frames = False
 
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = 'blackjack_%s' % self.room_name
-
-        if self.room_name not in self.room_shoes:
-            self.room_shoes[self.room_name] = Shoe(num_decks=2)
-
-        self.shoe = self.room_shoes[self.room_name]
+        self.worker = get_worker()
+        self.protocol, self.binary, subprotocol = negotiate(self.scope)
+        self.batch_frames = batch_frames(self.scope)
 
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
-
-        await self.send(text_data=json.dumps({
-            'type': 'connection_good',
-            'message': 'You are now connected to room %s' % self.room_name,
-            'channel_name': self.channel_name,
-            'cards_remaining': self.shoe.cards_remaining()
-        }))
+        await self.accept(subprotocol)
+        await self.submit("connect", protocol=self.protocol, binary=self.binary)
 
     async def disconnect(self, close_code):
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.worker is not None:
+            await self.submit("disconnect")
+
+    async def submit(self, action_type, seat=None, **params):
+        await self.worker.submit(self.room_name, action_type, seat or self.player_name, self.channel_name, **params)
+
+    def seat(self, message):
+        seat = message.get("seat", self.player_name)
+        if seat is None:
+            raise InvalidAction("Join first")
+        if seat not in self.seats:
+            raise InvalidAction("Not seated as %s" % seat)
+        return seat
+
+    def batch_action(self, message):
+        # A batch item as the room's (type, player, params).
+        action_type = message["type"]
+        if action_type == "join":
+            return "join", message["name"], {"chips": message["chips"]}
+        # The room checks the seat itself, since a batch can join one first.
+        seat = message.get("seat", self.player_name)
+        if seat is None:
+            raise InvalidAction("Join first")
+        if action_type == "deal":
+            return "bet", seat, {"amount": message["bet"]}
+        # Hand actions, and anything else for the room to reject in its reply.
+        return action_type, seat, {"hand_index": message.get("hand", 0)}
 
     async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        action_type = None
         try:
-            message = json.loads(text_data)
+            message = json.loads(text_data) if bytes_data is None else decode_binary_message(bytes_data)
             action_type = message["type"]
 
             if action_type == "join":
-                if self.player is not None:
-                    return
-
-                player_name = message["name"]
-                player_chips = message["chips"]
+                await self.worker.submit(self.room_name, "join", message["name"], self.channel_name,
+                                         chips=message["chips"])
 
-                self.player = Player(player_name)
-                self.player.chips = player_chips
-                self.player.channel = self.channel_name
+            elif action_type == "resume":
+                # Takes back a seat after a dropped connection, with the token
+                # the join reply carried.
+                await self.submit("resume", token=message["token"])
 
-                room_name = self.room_name
-
-                if room_name not in self.room_players:
-                    self.room_players[room_name] = []
-
-                self.room_players[room_name].append(self.player)
-
-                print("Player joined:", player_name)
-                print("Room players:", self.room_players)
+            elif action_type == "deal":
+                # The room deals once its betting window closes.
+                await self.submit("bet", self.seat(message), amount=message["bet"])
+
+            elif action_type in ACTIONS:
+                await self.submit(action_type, self.seat(message), hand_index=message.get("hand", 0))
+
+            elif action_type == "batch":
+                # Actions for any of this connection's seats, applied by the
+                # room in one pass and answered with one batch_result; the
+                # room checks each seat.
+                actions = message["actions"]
+                if not isinstance(actions, list) or not 0 < len(actions) <= MAX_BATCH:
+                    raise ValueError("A batch holds 1 to %d actions" % MAX_BATCH)
+
+                await self.submit("batch", actions=[self.batch_action(action) for action in actions])
+
+            elif action_type == "profile":
+                # Admins only, see bj.profiling.
+                user = self.scope.get("user")
+                if user is None or not user.is_staff:
+                    await self.send_error("Not allowed")
+                    return
 
-                await self.send(json.dumps({
-                    "type": "join",
-                    "name": player_name,
-                    "chips": player_chips
-                }))
+                await self.submit("profile", kind=message.get("kind", "cpu"), rounds=message.get("rounds", 1))
 
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'player_join',
-                        'player_name': player_name
-                    }
-                )
-            elif action_type == "deal":
-                print('players deal')
-                print(self.player)
-                self.room_finished_hands[self.room_name] = set()
-                print(len(self.room_finished_hands[self.room_name]))
-
-                if self.room_name not in self.timer_task or not self.timer_task[self.room_name]:
-                    time_limit = 10
-                    self.timer_task[self.room_name] = asyncio.create_task(asyncio.sleep(time_limit))
-
-                await self.timer_task[self.room_name]
-                if self.room_name not in self.dealer_hand or self.dealer_hand[self.room_name].hands[0].get_value() == 0:
-                    self.dealer.hands[0].initial_cards(self.shoe)
-                    self.dealer_hand[self.room_name] = self.dealer
-                    print('-' * 20)
-                    print(self.dealer.get_hand())
-                    print('-' * 20)
-                else:
-                    self.dealer = self.dealer_hand[self.room_name]
-                    print('hits here')
-                    print('-' * 20)
-                    print(self.dealer.get_hand())
-                    print('-' * 20)
-                await self.execute_deal(message)
-
-            elif action_type == "hit" or action_type == "stand" or action_type == "split" or action_type == "double":
-                # if self.room_name not in self.timer_task or not self.timer_task[self.room_name]:
-                #     time_limit = 5
-                #     self.timer_task[self.room_name] = asyncio.create_task(asyncio.sleep(time_limit))
-                # await self.timer_task[self.room_name]
-
-                if action_type == "hit":
-                    hand_index = message.get("hand", 0)
-                    print()
-                    await self.play_hand(hand_index)
-
-                elif action_type == "stand":
-                    hand_index = message.get("hand", 0)
-                    if hand_index >= len(self.player.hands):
-                        await self.send_error("Invalid hand index")
-                    elif hand_index + 1 < len(self.player.hands):
-                        await self.send_game_state()
-                        self.room_finished_hands[self.room_name].add(self.player.hands[hand_index])
-                        await self.send(json.dumps({"type": "hand_index", "hand_index": hand_index + 1}))
-                        print('while stand player increase hi')
-                        print(hand_index)
-
-                    else:
-                        # self.room_finished_hands[self.room_name] = self.room_finished_hands.get(self.room_name, set())
-                        self.room_finished_hands[self.room_name].add(self.player.hands[hand_index])
-                        if len(self.room_finished_hands[self.room_name]) == sum(
-                                len(player.hands) for player in self.room_players[self.room_name]):
-                            await self.play_dealer_turn()
-
-                elif action_type == "split":
-                    hand_index = message.get("hand", 0)
-                    if hand_index >= len(self.player.hands):
-                        await self.send_error("Invalid hand index")
-                    else:
-                        await self.split_hand(hand_index)
-                        await self.play_round(hand_index=hand_index)
-                        await self.send_cards()
-                        print(len(self.player.hands))
-
-                elif action_type == "double":
-                    hand_index = message.get("hand", 0)
-                    if hand_index >= len(self.player.hands):
-                        await self.send_error("Invalid hand index")
-                    else:
-                        await self.double_down(hand_index)
             else:
                 await self.send_error("Invalid action type")
 
+        except InvalidAction as e:
+            await self.send_error(str(e))
+
         except Exception as e:
-            error_message = str(e)
-            traceback_info = traceback.format_exc()
-            await self.send_error(error_message)
-            await self.send_message(f"Error details:\n{traceback_info}")
-
-    async def player_join(self, event):
-        player_name = event['player_name']
-        await self.send(text_data=json.dumps({
-            'type': 'player_join',
-            'player_name': player_name
-        }))
-
-    async def execute_deal(self, message):
-        self.bet = message["bet"]
-        hand_index = message.get("hand", 0)
-        if self.player.bet(self.bet) is None:
-            await self.send_error("You don't have enough chips")
+            # The traceback goes to the server log, not to the room.
+            get_room_log(self.room_name).error("receive failed", exc_info=sys.exc_info(), channel=self.channel_name,
+                                               type=action_type)
+            await self.send_error(str(e))
+
+        finally:
+            # Client-chosen types are bucketed so they can't grow the labels.
+            label = action_type if action_type in MESSAGE_TYPES else "other"
+            metrics.RECEIVE_SECONDS.labels(label).observe(time.perf_counter() - started)
+
+    async def player_joined(self, event):
+        if self.player_name is None:
+            self.player_name = event['player_name']
+        self.seats.add(event['player_name'])
+        if self.protocol == 1:
+            await self.send(dumps({
+                "type": "join",
+                "name": event['player_name'],
+                "chips": event['chips'],
+                "token": event['token']
+            }))
         else:
-            self.player.hands[0].initial_cards(self.shoe)
-            print(f'{self.player.name} has cards:{self.player.hands[0]}')
-            await self.play_round(hand_index=hand_index)
+            await self.send_ops([["joined", event['player_name'], event['chips'], event['token']]])
 
     async def send_error(self, error_message):
-        await self.send(json.dumps({
-            "type": "error",
-            "message": error_message
-        }))
-
-    async def play_round(self, hand_index):
-        if self.player.hands[0].is_blackjack() and hand_index + 1 == len(self.player.hands):
-            self.room_finished_hands[self.room_name].add(self.player.hands[0])
-            await self.send_error('blackjack congrats')
-
-            # await self.send_game_state()
-            # await self.send_cards()
-            # await self.end_game()
-            # await self.reset_game()
-
-        elif self.player.hands[hand_index].is_blackjack() and hand_index + 1 < len(self.player.hands):
-            # blackjack in first pair while split
-            await self.send(json.dumps({"type": "hand_index", "hand_index": hand_index + 1}))
-            # await self.send_cards()
-
-        elif self.player.hands[hand_index].is_splitable():
-            await self.send(json.dumps({
-                "type": "splitable",
+        if self.protocol == 1:
+            await self.send(dumps({
+                "type": "error",
+                "message": error_message
             }))
-        await self.send_cards()
-        await self.send_game_state()
-
-    async def play_hand(self, hand_index):
-        if hand_index >= len(self.player.hands):
-            await self.send_error("Invalid hand index")
-
-        self.player.hit(hand_index, self.shoe)
-        print('hittttttttt')
-        hand = self.player.hands[hand_index]
-        await self.send_cards()
-        if hand.is_busted():
-            await self.send_error("This hand is already busted")
-            # self.room_finished_hands[self.room_name] = self.room_finished_hands.get(self.room_name, set())
-            self.room_finished_hands[self.room_name].add(hand)
-            print('hits busted')
-
-            if hand_index + 1 != len(self.player.hands):
-                await self.send_game_state()
-                await self.send(json.dumps({"type": "hand_index", "hand_index": hand_index + 1}))
-                print('while add card in split increase hi')
-
-            if len(self.room_finished_hands[self.room_name]) == sum(
-                    len(player.hands) for player in self.room_players[self.room_name]):
-                print('true')
-                await self.play_dealer_turn()
-            else:
-                await self.send(json.dumps({"type": "wait_for_players"}))
-
-    async def play_dealer_turn(self):
-        while self.dealer.should_hit():
-            self.dealer.hit(0, self.shoe)
-
-        await self.send_game_state()
-        print('room')
-        print(self.room_name)
-        print('---')
-        self.timer_task[self.room_name] = {}
-        await self.determine_winner()
-        await self.end_game()
-        await self.reset_game()
-
-    async def double_down(self, hand_index):
-        hand = self.player.hands[hand_index]
-        if self.player.chips >= self.bet:
-            self.player.chips -= self.bet
-            self.bet *= 2
-            self.player.hit(hand_index, self.shoe)
-            await self.send_cards()
-            await self.send_game_state()
-            if hand.is_busted():
-                await self.end_game()
-                # await self.reset_game()
+        else:
+            await self.send_ops([["error", error_message]])
+
+    async def profile_status(self, event):
+        await self.send(dumps({"type": "profile", **{key: value for key, value in event.items() if key != "type"}}))
+
+    async def send_ops(self, ops):
+        if self.binary:
+            await self.send(bytes_data=encode_binary_frame(encode_op(op) for op in ops))
+        else:
+            await self.send(dumps({"v": 2, "ops": ops}))
+
+    async def room_batch(self, event):
+        # The room encodes each batch once per protocol in use; pick ours.
+        if self.protocol == 1:
+            messages = [message for part in self.batch_parts(event.get('segments', ())) for message in part]
+            if len(messages) > 1 and self.batch_frames:
+                await self.send(text_data='{"type": "batch", "messages": [%s]}' % ",".join(messages))
             else:
-                await self.play_dealer_turn()
+                # Plain version 1 clients get one frame per message, as always.
+                for message in messages:
+                    await self.send(text_data=message)
+        elif self.binary:
+            ops = self.batch_parts(event.get('binary', ()))
+            if ops:
+                await self.send(bytes_data=encode_binary_frame(ops))
         else:
-            await self.send_error("You don't have enough chips to double down")
-
-    async def split_hand(self, hand_index):
-        hand = self.player.hands[hand_index]
-        if hand.is_splitable():
-            new_hand = hand.split_hand(self.shoe)
-            self.player.add_hand(new_hand)
-            print(f'new hand: {new_hand} and hand: {hand}')
-
-    async def send_game_state(self):
-        player_hands = []
-        for hand in self.player.hands:
-            player_hands.append({
-                "cards": [str(card) for card in hand.cards],
-                "value": hand.get_value(),
-                "busted": hand.is_busted(),
-                "blackjack": hand.is_blackjack(),
-            })
-
-        dealer_hand = {
-            "cards": [str(card) for card in self.dealer.hands[0].cards],
-            "value": self.dealer.hands[0].get_value(),
-            "busted": self.dealer.hands[0].is_busted(),
-            "blackjack": self.dealer.hands[0].is_blackjack()
-        }
-
-        game_state = {
-            "type": "game_state",
-            "player_hands": player_hands,
-            "dealer_hand": dealer_hand,
-            "chips": self.player.chips
-        }
-
-        await self.send(json.dumps(game_state))
-
-        if self.shoe.cards_remaining() < 30:
-            self.shoe = Shoe(num_decks=2)
-
-    async def determine_winner(self):
-        dealer_hand = self.dealer.get_hand()
-        dealer_value = dealer_hand.get_value()
-        for player in self.room_players[self.room_name]:
-            for hand in player.hands:
-                player_value = hand.get_value()
-                bet = self.bet
-
-                if hand.is_blackjack() and not dealer_hand.is_blackjack():
-                    # Player wins with blackjack
-                    player.chips += bet * 2.5
-                    message = f"{player.name} wins with {hand} ({player_value}) = Blackjack!"
-                elif not hand.is_blackjack() and dealer_hand.is_blackjack():
-                    # Dealer wins with blackjack
-                    player.chips -= bet
-                    message = f"Dealer has blackjack with {dealer_hand} ({dealer_value})"
-                elif hand.is_blackjack() and dealer_hand.is_blackjack():
-                    # Tie with both having blackjack
-                    player.chips += bet
-                    message = f"{player.name} pushes with {hand} ({player_value})"
-                elif player_value > 21:
-                    # Player busts
-                    message = f"{player.name} busts with {hand} ({player_value})"
-                elif dealer_value > 21:
-                    # Dealer busts, player wins
-                    player.chips += bet * 2
-                    message = f"{player.name} wins with {hand} ({player_value})"
-                elif player_value == dealer_value:
-                    # Tie with equal values
-                    player.chips += bet
-                    message = f"{player.name} ties with {hand} ({player_value})"
-                elif player_value > dealer_value:
-                    # Player wins with higher value
-                    player.chips += bet * 2
-                    message = f"{player.name} wins with {hand} ({player_value})"
-                else:
-                    # Player loses
-                    message = f"{player.name} loses with {hand} ({player_value})"
-
-
-                await self.send_message_to_channel(player.channel, message)
-
-    async def send_message_to_channel(self, channel, message):
-        winner = {
-            'type': 'winner',
-            'message': message
-        }
-        await self.channel_layer.send(
-            channel,
-            {
-                "type": "winner",
-                "message": json.dumps(winner)
-            }
-        )
-
-    async def message(self, event):
-        print(event['message'])
-        await self.send(text_data=event['message'])
-
-    async def winner(self, event):
-        print(event['message'])
-        await self.send(text_data=event['message'])
-
-    async def send_cards(self):
-        card_data = {
-            "type": "cards",
-            "player_name": self.player.name,
-            "player_cards": [],
-            "dealer_card": str(self.dealer.getFirstCard())
-        }
-
-        for hand in self.player.hands:
-            hand_cards = [str(card) for card in hand.cards]
-            card_data["player_cards"].append(hand_cards)
-
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'cards_message',
-                'message': json.dumps(card_data)
-            }
-        )
-
-    async def cards_message(self, event):
-        await self.send(text_data=event['message'])
-
-    async def reset_game(self):
-        self.dealer_hand[self.room_name].clear_hands()
-        for player in self.room_players[self.room_name]:
-            self.player = player
-            self.player.clear_hands()
-            print(self.shoe)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'reset_message'
-                }
-            )
-
-    async def reset_message(self, event):
-        await self.send(json.dumps({"type": "reset"}))
-
-    async def end_game(self):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'end_game_message',
-                'dealer_cards': [str(card) for card in self.dealer.hands[0].cards],
-                'dealer_value': self.dealer.hands[0].get_value(),
-                'dealer_busted': self.dealer.hands[0].is_busted(),
-                'dealer_blackjack': self.dealer.hands[0].is_blackjack(),
-                'player_chips': self.player.chips
-            }
-        )
-
-    async def end_game_message(self, event):
-        await self.send(json.dumps({
-            "type": "end_game",
-            "dealer_cards": event['dealer_cards'],
-            "dealer_value": event['dealer_value'],
-            "dealer_busted": event['dealer_busted'],
-            "dealer_blackjack": event['dealer_blackjack'],
-            "player_chips": event['player_chips']
-        }))
-
-    async def send_message(self, message):
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'message',
-                'message': json.dumps(message)
-            }
-        )
-
-    async def send_all(self, message):
-        await self.channel_layer.group_send("blackjack", {
-            "type": "chat_message",
-            "message": message
-        })
-
-    async def chat_message(self, event):
-        message = event["message"]
-        await self.send(json.dumps({
-            "type": "message",
-            "message": message
-        }))
-
-    async def add_to_group(self, group_name):
-        await self.channel_layer.group_add(
-            group_name,
-            self.channel_name
-        )
-
-    async def remove_from_group(self, group_name):
-        await self.channel_layer.group_discard(
-            group_name,
-            self.channel_name
-        )
+            ops = self.batch_parts(event.get('delta', ()))
+            if ops:
+                await self.send(text_data='{"v":2,"ops":[%s]}' % ",".join(ops))
+
+    def batch_parts(self, segments):
+        parts = []
+        for segment in segments:
+            part = segment if not isinstance(segment, dict) else segment.get(self.channel_name)
+            if part:
+                parts.append(part)
+        return parts
+
+
+class LobbyConsumer(AsyncWebsocketConsumer):
+    """
+    Pages through the room index and then streams changes to it. A "list"
+    message ({"type": "list", "after": ..., "limit": ..., "phase": ...,
+    "prefix": ..., "min_players": ..., "max_players": ...}, or the same as a
+    query string on connect) returns a page and narrows later updates to
+    rooms matching its filters.
+    """
+
+    async def connect(self):
+        self.lobby = get_worker().lobby
+        self.filters = None
+        await self.channel_layer.group_add(LOBBY_GROUP, self.channel_name)
+        await self.accept()
+        await self.send_page(dict(parse_qsl(self.scope.get("query_string", b"").decode())))
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(LOBBY_GROUP, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message = json.loads(text_data)
+            if not isinstance(message, dict) or message.get("type") != "list":
+                raise ValueError("Invalid action type")
+            await self.send_page(message)
+        except (TypeError, ValueError) as e:
+            await self.send(dumps({"type": "error", "message": str(e)}))
+
+    async def send_page(self, query):
+        after, limit, self.filters = parse_query(query)
+        await self.send(dumps(self.lobby.page(after, limit, self.filters)))
+
+    async def lobby_update(self, event):
+        if self.filters is None:
+            await self.send(event["text"])
+            return
+        # Rooms that stopped matching are reported as gone.
+        rooms = {name: entry if entry is not None and matches(entry, self.filters) else None
+                 for name, entry in event["rooms"].items()}
+        await self.send(dumps({"type": "lobby", "rooms": rooms}))
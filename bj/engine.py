@@ -0,0 +1,288 @@
+"""
+I/O-free blackjack round engine.
+
+BlackjackEngine is the state of one table. Each action method (or apply())
+validates the action, updates the state and returns a list of event dicts
+describing what happened; invalid actions raise InvalidAction, before
+anything has changed. Frontends (the CLI in bj.cli and
+BlackjackGameConsumer) render those events however they like.
+
+A table seats up to max_seats players. If the shoe runs out part way
+through a round, play carries on from a freshly shuffled one, and apply()
+reports that with a "shuffle" event ahead of the action's others. Split
+hands are played out like any other and never count as blackjacks.
+"""
+from bj.blackjack import BLACKJACK_PAYOUT, RESHUFFLE_AT, Dealer, Player, Shoe
+
+BETTING = "betting"
+PLAYING = "playing"
+SETTLED = "settled"
+MAX_SEATS = 7
+# Most chips a player can sit down with.
+MAX_CHIPS = 10 ** 9
+
+
+class InvalidAction(Exception):
+    pass
+
+
+def settle_hand(player_name, hand, dealer_hand):
+    """Return (outcome, amount returned to the player, message) for a hand."""
+    player_value = hand.value
+    dealer_value = dealer_hand.value
+    if hand.is_blackjack() and not dealer_hand.is_blackjack():
+        return "blackjack", hand.bet * (1 + BLACKJACK_PAYOUT), \
+            f"{player_name} wins with {hand} ({player_value}) = Blackjack!"
+    elif not hand.is_blackjack() and dealer_hand.is_blackjack():
+        return "lose", 0, f"Dealer has blackjack with {dealer_hand} ({dealer_value})"
+    elif hand.is_blackjack() and dealer_hand.is_blackjack():
+        return "push", hand.bet, f"{player_name} pushes with {hand} ({player_value})"
+    elif player_value > 21:
+        return "bust", 0, f"{player_name} busts with {hand} ({player_value})"
+    elif dealer_value > 21:
+        return "win", hand.bet * 2, f"{player_name} wins with {hand} ({player_value})"
+    elif player_value == dealer_value:
+        return "push", hand.bet, f"{player_name} ties with {hand} ({player_value})"
+    elif player_value > dealer_value:
+        return "win", hand.bet * 2, f"{player_name} wins with {hand} ({player_value})"
+    else:
+        return "lose", 0, f"{player_name} loses with {hand} ({player_value})"
+
+
+class BlackjackEngine:
+    def __init__(self, num_decks=2, shoe=None, dealer=None, reshuffle_at=RESHUFFLE_AT, max_seats=MAX_SEATS,
+                 max_chips=MAX_CHIPS):
+        self.shoe = shoe or Shoe(num_decks)
+        self.dealer = dealer or Dealer()
+        self.reshuffle_at = reshuffle_at
+        self.max_seats = max_seats
+        self.max_chips = max_chips
+        self.reshuffled = False
+        self.players = {}
+        self.phase = BETTING
+        # Seats in the current round mapped to the index of the hand they are
+        # playing, plus a count of unfinished hands so the dealer's turn is
+        # detected without rescanning every seat.
+        self.turns = {}
+        self.pending_hands = 0
+
+    def apply(self, action_type, player_name=None, **params):
+        action = self.actions.get(action_type)
+        if action is None:
+            raise InvalidAction("Invalid action type")
+        self.reshuffled = False
+        if player_name is None:
+            events = action(self, **params)
+        else:
+            events = action(self, player_name, **params)
+        if self.reshuffled:
+            events.insert(0, {"type": "shuffle", "cards_remaining": self.shoe.cards_remaining()})
+        return events
+
+    def deal_card(self):
+        # Cards are dealt through the engine (Hand methods take it in place of
+        # a shoe) so that an empty shoe is reshuffled instead of running out.
+        if not self.shoe.cards_remaining():
+            self.shoe.shuffle()
+            self.reshuffled = True
+        return self.shoe.deal_card()
+
+    def get_player(self, player_name):
+        player = self.players.get(player_name)
+        if player is None:
+            raise InvalidAction("Unknown player %s" % player_name)
+        return player
+
+    def get_turn(self, player_name, hand_index):
+        if self.phase != PLAYING:
+            raise InvalidAction("No round in progress")
+        player = self.get_player(player_name)
+        if self.turns.get(player_name) != hand_index or hand_index >= len(player.hands):
+            raise InvalidAction("Invalid hand index")
+        return player, player.hands[hand_index]
+
+    def join(self, player_name, chips):
+        if player_name in self.players:
+            raise InvalidAction("Player %s already joined" % player_name)
+        if len(self.players) >= self.max_seats:
+            raise InvalidAction("The table is full")
+        if isinstance(chips, bool) or not isinstance(chips, (int, float)) or not 0 < chips <= self.max_chips:
+            raise InvalidAction("Chips must be more than 0 and at most %d" % self.max_chips)
+        player = Player(player_name)
+        player.chips = chips
+        self.players[player_name] = player
+        return [{"type": "player_join", "player_name": player_name, "chips": chips}]
+
+    def leave(self, player_name):
+        player = self.get_player(player_name)
+        events = []
+        if self.phase == BETTING and player.hands[0].bet:
+            # Like an undealt round, leaving before the deal returns the bet.
+            player.chips += player.hands[0].bet
+            player.hands[0].bet = 0
+        if player_name in self.turns:
+            while self.turns[player_name] < len(player.hands):
+                events += self.finish_hand(player, self.turns[player_name])
+            del self.turns[player_name]
+        del self.players[player_name]
+        events.append({"type": "player_leave", "player_name": player_name, "chips": player.chips})
+        return events
+
+    def bet(self, player_name, amount):
+        if self.phase != BETTING:
+            raise InvalidAction("Bets are closed")
+        player = self.get_player(player_name)
+        hand = player.hands[0]
+        if hand.bet:
+            raise InvalidAction("Bet already placed")
+        if amount <= 0 or player.bet(amount) is None:
+            raise InvalidAction("You don't have enough chips")
+        hand.bet = amount
+        return [{"type": "bet", "player_name": player_name, "bet": amount, "chips": player.chips}]
+
+    def deal(self):
+        if self.phase != BETTING:
+            raise InvalidAction("Round already dealt")
+        seated = [player for player in self.players.values() if player.hands[0].bet]
+        if not seated:
+            raise InvalidAction("No bets placed")
+
+        events = []
+        if self.shoe.cards_remaining() < self.reshuffle_at:
+            self.shoe.shuffle()
+            events.append({"type": "shuffle", "cards_remaining": self.shoe.cards_remaining()})
+
+        for player in seated:
+            player.hands[0].initial_cards(self)
+        dealer_hand = self.dealer.hands[0]
+        dealer_hand.initial_cards(self)
+        self.phase = PLAYING
+        self.turns = {player.name: 0 for player in seated}
+        self.pending_hands = len(seated)
+
+        for player in seated:
+            hand = player.hands[0]
+            events.append({"type": "deal", "player_name": player.name, "cards": list(hand.cards),
+                           "dealer_card": dealer_hand.cards[0]})
+            if hand.is_blackjack():
+                events.append({"type": "blackjack", "player_name": player.name, "hand_index": 0})
+                events += self.finish_hand(player, 0)
+            elif hand.is_splitable():
+                events.append({"type": "splitable", "player_name": player.name, "hand_index": 0})
+        return events
+
+    def hit(self, player_name, hand_index=0):
+        player, hand = self.get_turn(player_name, hand_index)
+        card = self.deal_card()
+        hand.add_card(card)
+        events = [{"type": "card", "player_name": player_name, "hand_index": hand_index, "card": card}]
+        if hand.is_busted():
+            events.append({"type": "bust", "player_name": player_name, "hand_index": hand_index})
+            events += self.finish_hand(player, hand_index)
+        return events
+
+    def stand(self, player_name, hand_index=0):
+        player, _ = self.get_turn(player_name, hand_index)
+        return self.finish_hand(player, hand_index)
+
+    def split(self, player_name, hand_index=0):
+        player, hand = self.get_turn(player_name, hand_index)
+        if not hand.is_splitable():
+            raise InvalidAction("This hand can't be split")
+        if player.bet(hand.bet) is None:
+            raise InvalidAction("You don't have enough chips to split")
+        new_hand = hand.split_hand(self)
+        new_hand.bet = hand.bet
+        player.add_hand(new_hand)
+        self.pending_hands += 1
+        events = [{"type": "split", "player_name": player_name, "hand_index": hand_index,
+                   "new_hand_index": len(player.hands) - 1, "chips": player.chips}]
+        if hand.is_splitable():
+            events.append({"type": "splitable", "player_name": player_name, "hand_index": hand_index})
+        return events
+
+    def double(self, player_name, hand_index=0):
+        player, hand = self.get_turn(player_name, hand_index)
+        if len(hand.cards) != 2:
+            raise InvalidAction("You can only double down on two cards")
+        if player.bet(hand.bet) is None:
+            raise InvalidAction("You don't have enough chips to double down")
+        hand.bet *= 2
+        card = self.deal_card()
+        hand.add_card(card)
+        events = [
+            {"type": "double", "player_name": player_name, "hand_index": hand_index, "bet": hand.bet,
+             "chips": player.chips},
+            {"type": "card", "player_name": player_name, "hand_index": hand_index, "card": card},
+        ]
+        if hand.is_busted():
+            events.append({"type": "bust", "player_name": player_name, "hand_index": hand_index})
+        return events + self.finish_hand(player, hand_index)
+
+    def finish_hand(self, player, hand_index):
+        next_index = hand_index + 1
+        self.turns[player.name] = next_index
+        self.pending_hands -= 1
+        events = []
+        if next_index < len(player.hands):
+            events.append({"type": "hand_index", "player_name": player.name, "hand_index": next_index})
+            if player.hands[next_index].is_splitable():
+                events.append({"type": "splitable", "player_name": player.name, "hand_index": next_index})
+        elif self.pending_hands:
+            events.append({"type": "wait_for_players", "player_name": player.name})
+        if not self.pending_hands:
+            events += self.play_dealer()
+        return events
+
+    def play_dealer(self):
+        dealer_hand = self.dealer.hands[0]
+        events = []
+        if any(not hand.is_busted() and not hand.is_blackjack()
+               for name in self.turns for hand in self.players[name].hands):
+            while self.dealer.should_hit():
+                card = self.deal_card()
+                dealer_hand.add_card(card)
+                events.append({"type": "dealer_card", "card": card})
+        return events + self.settle()
+
+    def settle(self):
+        dealer_hand = self.dealer.hands[0]
+        events = []
+        for name in self.turns:
+            player = self.players[name]
+            for hand_index, hand in enumerate(player.hands):
+                outcome, payout, message = settle_hand(name, hand, dealer_hand)
+                player.chips += payout
+                events.append({"type": "result", "player_name": name, "hand_index": hand_index,
+                               "cards": list(hand.cards), "value": hand.value, "bet": hand.bet,
+                               "outcome": outcome, "payout": payout, "chips": player.chips, "message": message})
+        self.phase = SETTLED
+        events.append({"type": "round_end", "dealer_cards": list(dealer_hand.cards), "dealer_value": dealer_hand.value,
+                       "dealer_busted": dealer_hand.is_busted(), "dealer_blackjack": dealer_hand.is_blackjack()})
+        return events
+
+    def new_round(self):
+        if self.phase == PLAYING:
+            raise InvalidAction("Round still in progress")
+        for player in self.players.values():
+            if player.hands[0].bet and self.phase == BETTING:
+                # Bets placed for a round that was never dealt are returned.
+                player.chips += player.hands[0].bet
+            player.clear_hands()
+        self.dealer.clear_hands()
+        self.turns = {}
+        self.pending_hands = 0
+        self.phase = BETTING
+        return [{"type": "reset"}]
+
+    actions = {
+        "join": join,
+        "leave": leave,
+        "bet": bet,
+        "deal": deal,
+        "hit": hit,
+        "stand": stand,
+        "split": split,
+        "double": double,
+        "new_round": new_round,
+    }
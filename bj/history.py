@@ -0,0 +1,164 @@
+"""
+Write-behind persistence of bankrolls and round history.
+
+Rooms hand settled rounds to a HistoryWriter, which only puts them on a
+queue. A background thread drains the queue in batches and writes each
+batch in one transaction with bulk_create/bulk_update, so settlement never
+waits on the database and the cost of a write is shared by every round in
+the batch.
+
+Chips written by a round that is still queued are kept in memory and take
+precedence over the database when a player rejoins.
+"""
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from bj import metrics
+
+logger = logging.getLogger(__name__)
+
+writer = None
+
+metrics.Gauge("blackjack_history_queue", "Rounds and players waiting to be written",
+              lambda: writer.queue.qsize() if writer else 0)
+WRITE_SECONDS = metrics.Histogram("blackjack_history_write_seconds", "Time to write one batch of history")
+
+
+def get_history_writer():
+    global writer
+    if writer is None and settings.BLACKJACK_HISTORY:
+        writer = HistoryWriter(settings.BLACKJACK_HISTORY_BATCH_SIZE, settings.BLACKJACK_HISTORY_FLUSH_INTERVAL)
+        writer.start()
+    return writer
+
+
+class HistoryWriter:
+    def __init__(self, batch_size=500, flush_interval=0.5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        # Player name -> chips for rounds that are queued but not yet written.
+        self.pending_chips = {}
+        self.rounds_written = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="bj-history", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record_round(self, room, number, events):
+        """Queue a round from the result and round_end events that settled it."""
+        results = []
+        chips = {}
+        for event in events:
+            if event["type"] == "result":
+                results.append((event["player_name"], event["hand_index"], event["cards"], event["value"],
+                                event["bet"], event["outcome"], event["payout"]))
+                chips[event["player_name"]] = event["chips"]
+            elif event["type"] == "round_end":
+                dealer_cards, dealer_value = event["dealer_cards"], event["dealer_value"]
+        with self.lock:
+            self.pending_chips.update(chips)
+        self.queue.put((room, number, dealer_cards, dealer_value, timezone.now(), results, chips))
+
+    def record_player(self, name, chips):
+        with self.lock:
+            self.pending_chips[name] = chips
+        self.queue.put((None, None, None, None, None, [], {name: chips}))
+
+    def bankroll(self, name):
+        """Chips for a returning player, or None for a new one. Blocks on the database."""
+        from bj.models import Player
+
+        with self.lock:
+            chips = self.pending_chips.get(name)
+        if chips is not None:
+            return chips
+        return Player.objects.filter(name=name).values_list("chips", flat=True).first()
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self.write(batch)
+                        return
+                    batch.append(item)
+                self.write(batch)
+        finally:
+            close_old_connections()
+
+    def write(self, batch):
+        from bj.models import Hand, Player, Round
+
+        close_old_connections()
+        started = time.perf_counter()
+        chips = {}
+        for item in batch:
+            chips.update(item[6])
+        try:
+            with transaction.atomic():
+                players = Player.objects.in_bulk(list(chips), field_name="name")
+                Player.objects.bulk_create(
+                    [Player(name=name, chips=chips[name]) for name in chips if name not in players],
+                    ignore_conflicts=True)
+                players = Player.objects.in_bulk(list(chips), field_name="name")
+                now = timezone.now()
+                for name, player in players.items():
+                    player.chips = chips[name]
+                    player.updated_at = now
+                Player.objects.bulk_update(list(players.values()), ["chips", "updated_at"])
+
+                rounds = [item for item in batch if item[0] is not None]
+                saved = Round.objects.bulk_create([
+                    Round(room=room, number=number, dealer_cards=", ".join(map(str, dealer_cards)),
+                          dealer_value=dealer_value, finished_at=finished_at)
+                    for room, number, dealer_cards, dealer_value, finished_at, _, _ in rounds
+                ])
+                Hand.objects.bulk_create([
+                    Hand(round=round, player=players[name], hand_index=hand_index, cards=", ".join(map(str, cards)),
+                         value=value, bet=bet, outcome=outcome, payout=payout)
+                    for round, item in zip(saved, rounds)
+                    for name, hand_index, cards, value, bet, outcome, payout in item[5]
+                ])
+        except Exception:
+            if len(batch) > 1:
+                # Retry item by item, so a bad item only loses itself.
+                for item in batch:
+                    self.write([item])
+                return
+            logger.exception("history write failed", extra={"fields": {"rounds": len(batch)}})
+            return
+        self.rounds_written += len(rounds)
+        WRITE_SECONDS.observe(time.perf_counter() - started)
+
+        with self.lock:
+            for name, value in chips.items():
+                if self.pending_chips.get(name) == value:
+                    del self.pending_chips[name]
@@ -0,0 +1,247 @@
+"""
+Load generator for the blackjack WebSocket endpoint.
+
+Bots join a room and play rounds the way the browser client does: bet
+(the "deal" message), then hit below STAND_ON and stand otherwise. They
+connect either to the ASGI application in-process through Channels'
+WebsocketCommunicator, or to a real server (e.g. Daphne) over TCP with
+the small WebSocket client below.
+
+Action latency is the time from sending hit or stand to the first private
+reply it causes. Messages are counted after unpacking batch frames. Memory
+per room is the growth of the server's resident set size over a run; in
+process that includes the bots' own connections.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+
+from channels.testing import WebsocketCommunicator
+
+STAND_ON = 17
+REPLIES = {"game_state", "wait_for_players", "hand_index", "winner", "error"}
+
+
+class CommunicatorConnection:
+    def __init__(self, application, path, timeout=30):
+        self.communicator = WebsocketCommunicator(application, path)
+        self.timeout = timeout
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(self.timeout)
+        if not connected:
+            raise ConnectionError("Connection rejected")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self):
+        return await self.communicator.receive_from(self.timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketConnection:
+    """Minimal RFC 6455 client, enough to drive the server over a real socket."""
+
+    def __init__(self, host, port, path, timeout=30):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            "GET /%s HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            "Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % (
+                self.path.lstrip("/"), self.host, self.port, key)).encode())
+        response = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), self.timeout)
+        if not response.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError(response.split(b"\r\n", 1)[0].decode())
+
+    def write_frame(self, opcode, payload):
+        header = bytearray([0x80 | opcode])
+        if len(payload) < 126:
+            header.append(0x80 | len(payload))
+        elif len(payload) < 1 << 16:
+            header.append(0x80 | 126)
+            header += struct.pack(">H", len(payload))
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack(">Q", len(payload))
+        mask = os.urandom(4)
+        header += mask
+        self.writer.write(bytes(header) + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload)))
+
+    async def send(self, text):
+        self.write_frame(0x1, text.encode())
+        await self.writer.drain()
+
+    async def receive(self):
+        while True:
+            head = await asyncio.wait_for(self.reader.readexactly(2), self.timeout)
+            opcode, length = head[0] & 0x0f, head[1] & 0x7f
+            if length == 126:
+                length, = struct.unpack(">H", await self.reader.readexactly(2))
+            elif length == 127:
+                length, = struct.unpack(">Q", await self.reader.readexactly(8))
+            payload = await self.reader.readexactly(length)
+            if opcode == 0x1:
+                return payload.decode()
+            elif opcode == 0x2:
+                return payload
+            elif opcode == 0x8:
+                raise ConnectionError("Connection closed by server")
+            elif opcode == 0x9:
+                self.write_frame(0xa, payload)
+
+    async def close(self):
+        if self.writer is not None:
+            self.write_frame(0x8, struct.pack(">H", 1000))
+            self.writer.close()
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.frames = 0
+        self.messages = 0
+        self.rounds = 0
+        self.actions = 0
+        self.errors = 0
+
+
+class Bot:
+    def __init__(self, connection, name, rounds, stats, bet=10, chips=10 ** 6, think=0, rng=random):
+        self.connection = connection
+        self.name = name
+        self.rounds = rounds
+        self.stats = stats
+        self.bet = bet
+        self.chips = chips
+        # Up to this many seconds are spent deciding each action.
+        self.think = think
+        self.rng = rng
+
+    async def receive(self):
+        frame = json.loads(await self.connection.receive())
+        messages = frame["messages"] if frame.get("type") == "batch" else [frame]
+        self.stats.frames += 1
+        self.stats.messages += len(messages)
+        return messages
+
+    async def run(self):
+        await self.connection.connect()
+        try:
+            await self.connection.send(json.dumps({"type": "join", "name": self.name, "chips": self.chips}))
+            while not any(message["type"] == "join" for message in await self.receive()):
+                pass
+            for _ in range(self.rounds):
+                await self.play_round()
+        finally:
+            await self.connection.close()
+
+    async def play_round(self):
+        await self.connection.send(json.dumps({"type": "deal", "bet": self.bet}))
+        hand = None
+        sent = None
+        finished = False
+        while True:
+            messages = await self.receive()
+            received = time.perf_counter()
+            for message in messages:
+                message_type = message["type"]
+                if sent is not None and message_type in REPLIES:
+                    self.stats.latencies.append(received - sent)
+                    sent = None
+                if message_type == "game_state":
+                    hand = message["player_hands"][0]
+                elif message_type in ("winner", "wait_for_players", "error"):
+                    finished = True
+                elif message_type == "reset":
+                    self.stats.rounds += 1
+                    return
+
+            if hand is not None and not finished and sent is None and not hand["busted"] and not hand["blackjack"]:
+                action = "hit" if hand["value"] < STAND_ON else "stand"
+                finished = action == "stand"
+                if self.think:
+                    await asyncio.sleep(self.rng.uniform(0, self.think))
+                sent = time.perf_counter()
+                self.stats.actions += 1
+                await self.connection.send(json.dumps({"type": action, "hand": 0}))
+
+
+class Report:
+    def __init__(self, transport, rooms, clients_per_room, stats, elapsed, memory_per_room):
+        self.transport = transport
+        self.rooms = rooms
+        self.clients_per_room = clients_per_room
+        self.stats = stats
+        self.elapsed = elapsed
+        self.memory_per_room = memory_per_room
+
+    def percentile(self, fraction):
+        latencies = sorted(self.stats.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    def as_dict(self):
+        return {
+            "transport": self.transport,
+            "rooms": self.rooms,
+            "clients": self.rooms * self.clients_per_room,
+            "rounds": self.stats.rounds,
+            "actions": self.stats.actions,
+            "errors": self.stats.errors,
+            "p50_ms": self.percentile(0.5) * 1e3,
+            "p99_ms": self.percentile(0.99) * 1e3,
+            "messages_per_s": self.stats.messages / self.elapsed,
+            "frames_per_s": self.stats.frames / self.elapsed,
+            "memory_per_room_kb": self.memory_per_room / 1024 if self.memory_per_room is not None else None,
+            "elapsed_s": self.elapsed,
+        }
+
+
+async def run_bots(connect, transport, rooms, clients_per_room, rounds, seed=0, memory=None, prefix="load",
+                   think=0):
+    """
+    Play rounds with rooms * clients_per_room bots. connect(path) returns a
+    connection and memory() the bytes currently used by the server; its
+    growth over the run is reported per room. Rooms are named prefix0,
+    prefix1, ... and must not be in use.
+    """
+    rng = random.Random(seed)
+    stats = Stats()
+    bots = [
+        Bot(connect("blackjack/%s%d/?batch=1" % (prefix, room)), "bot%d_%d" % (room, seat), rounds, stats,
+            bet=rng.choice((5, 10, 25)), think=think, rng=random.Random(rng.random()))
+        for room in range(rooms) for seat in range(clients_per_room)
+    ]
+    before = memory() if memory else None
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(bot.run()) for bot in bots]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    stats.errors = sum(isinstance(result, Exception) for result in results)
+    memory_per_room = (memory() - before) / rooms if memory else None
+    return Report(transport, rooms, clients_per_room, stats, elapsed, memory_per_room)
+
+
+def process_memory(pid=None):
+    """Resident set size of a process, by default this one (Linux only)."""
+    pid = pid or os.getpid()
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
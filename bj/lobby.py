@@ -0,0 +1,172 @@
+"""
+Index of the rooms every worker hosts, for the lobby.
+
+Each RoomWorker keeps a Lobby. Its rooms report a summary (players,
+connected clients, phase, rounds played) when it changes, which only marks
+the room as changed. Every settings.BLACKJACK_LOBBY_INTERVAL seconds the
+changes go out once to the LOBBY_GROUP channel-layer group, already encoded
+for clients: workers merge them into their copy of the index and lobby
+consumers forward the text as it is, so a room change costs the same
+however many people watch the lobby. Every BLACKJACK_LOBBY_RESYNC seconds a
+worker sends all of its rooms to the WORKER_GROUP group instead, which
+brings workers that started later up to date; only workers are in that
+group.
+
+Entries are [room, players, clients, phase, rounds]. In updates, rooms map
+to their entry, or null once they are gone.
+"""
+import asyncio
+import time
+from bisect import bisect_left, bisect_right, insort
+
+from bj.serialization import dumps
+
+LOBBY_GROUP = "blackjack_lobby"
+WORKER_GROUP = "blackjack_lobby_workers"
+INTERVAL = 1.0
+RESYNC = 30
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def parse_query(query):
+    """
+    Return (after, limit, filters or None) from GET parameters or a lobby
+    message. Values of the wrong type raise ValueError.
+    """
+    limit = max(1, min(integer(query, "limit", PAGE_SIZE), MAX_PAGE_SIZE))
+    filters = {
+        "phase": text(query, "phase"),
+        "prefix": text(query, "prefix") or "",
+        "min_players": integer(query, "min_players", 0),
+        "max_players": integer(query, "max_players", None),
+    }
+    if filters == {"phase": None, "prefix": "", "min_players": 0, "max_players": None}:
+        filters = None
+    return text(query, "after"), limit, filters
+
+
+def text(query, key):
+    value = query.get(key)
+    if value is None or value == "":
+        return None
+    if not isinstance(value, str):
+        raise ValueError("%s must be a string" % key)
+    return value
+
+
+def integer(query, key, default):
+    value = query.get(key)
+    if value is None or value == "":
+        return default
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError
+        return int(value)
+    except ValueError:
+        raise ValueError("%s must be an integer" % key) from None
+
+
+def matches(entry, filters):
+    name, players, _, phase, _ = entry
+    return (name.startswith(filters["prefix"]) and players >= filters["min_players"]
+            and (filters["max_players"] is None or players <= filters["max_players"])
+            and (filters["phase"] is None or phase == filters["phase"]))
+
+
+class Lobby:
+    def __init__(self, worker_id, channel_layer, scheduler, interval=INTERVAL, resync=RESYNC):
+        self.worker_id = worker_id
+        self.channel_layer = channel_layer
+        self.scheduler = scheduler
+        self.interval = interval
+        self.resync = resync
+        # Every known room mapped to (owning worker, entry), and their names
+        # in order for paging.
+        self.rooms = {}
+        self.names = []
+        # This worker's rooms, and those changed since the last publish.
+        self.local = {}
+        self.changed = set()
+        self.next_resync = 0
+        self.timer = None
+
+    def start(self):
+        if self.timer is None:
+            self.timer = self.scheduler.call_later(0, self.tick)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def update(self, room_name, players, clients, phase, rounds):
+        self.local[room_name] = [room_name, players, clients, phase, rounds]
+        self.changed.add(room_name)
+
+    def remove(self, room_name):
+        if self.local.pop(room_name, None) is not None:
+            self.changed.add(room_name)
+
+    def tick(self):
+        self.timer = self.scheduler.call_later(self.interval, self.tick)
+        now = time.monotonic()
+        full = now >= self.next_resync
+        if full:
+            self.next_resync = now + self.resync
+            rooms = dict(self.local)
+        elif self.changed:
+            rooms = {name: self.local.get(name) for name in self.changed}
+        else:
+            return
+        self.changed = set()
+        self.apply(self.worker_id, rooms, full)
+        asyncio.get_running_loop().create_task(self.publish(rooms, full))
+
+    async def publish(self, rooms, full):
+        message = {"type": "lobby.update", "worker": self.worker_id, "full": full, "rooms": rooms}
+        if full:
+            await self.channel_layer.group_send(WORKER_GROUP, message)
+        else:
+            message["text"] = dumps({"type": "lobby", "rooms": rooms})
+            await self.channel_layer.group_send(LOBBY_GROUP, message)
+
+    def apply(self, worker_id, rooms, full=False):
+        if full:
+            for name in [name for name, (owner, _) in self.rooms.items() if owner == worker_id and name not in rooms]:
+                self.discard(name)
+        for name, entry in rooms.items():
+            if entry is None:
+                self.discard(name)
+            else:
+                if name not in self.rooms:
+                    insort(self.names, name)
+                self.rooms[name] = (worker_id, entry)
+
+    def discard(self, room_name):
+        if self.rooms.pop(room_name, None) is not None:
+            del self.names[bisect_left(self.names, room_name)]
+
+    def page(self, after=None, limit=PAGE_SIZE, filters=None):
+        """Up to limit entries after the room named after, in name order."""
+        names = self.names
+        start = bisect_right(names, after) if after else 0
+        prefix = filters["prefix"] if filters else ""
+        if prefix:
+            start = max(start, bisect_left(names, prefix))
+        entries = []
+        for index in range(start, len(names)):
+            name = names[index]
+            if prefix and not name.startswith(prefix):
+                break
+            entry = self.rooms[name][1]
+            if filters is None or matches(entry, filters):
+                entries.append(entry)
+                if len(entries) == limit:
+                    break
+        return {
+            "type": "rooms",
+            "rooms": entries,
+            "next": entries[-1][0] if len(entries) == limit else None,
+            "total": len(names),
+        }
@@ -0,0 +1,162 @@
+"""
+Structured logging that stays off the event loop.
+
+Records from the "bj" logger go through a QueueHandler to a QueueListener
+thread, which formats them as one JSON object per line and does the I/O.
+Records are queued unformatted, so logging on the hot path costs a queue
+put.
+
+Rooms log through a RoomLog. Its debug events are sampled, one in
+`sample` (settings.BLACKJACK_LOG_SAMPLE, overridden per room by
+BLACKJACK_LOG_ROOMS or set_sample(); 1 logs everything, 0 nothing), and
+its warnings and errors are rate limited per room, with the number of
+suppressed records reported on the next one that gets through.
+"""
+import atexit
+import json
+import logging
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+from django.conf import settings
+
+logger = logging.getLogger("bj")
+listener = None
+room_logs = {}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", ()))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # QueueHandler.prepare formats the record on the calling thread; leave
+    # that to the listener.
+    def prepare(self, record):
+        return record
+
+
+def start():
+    global listener
+    if listener is not None:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    if settings.BLACKJACK_LOG_FILE:
+        handler = WatchedFileHandler(settings.BLACKJACK_LOG_FILE)
+    handler.setFormatter(JsonFormatter())
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=False)
+    logger.addHandler(DeferredQueueHandler(records))
+    logger.setLevel(settings.BLACKJACK_LOG_LEVEL)
+    logger.propagate = False
+    listener.start()
+    atexit.register(stop)
+
+
+def stop():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+def make_record(name, level, event, exc_info, fields):
+    # LogRecord.__init__ looks up the thread, process and caller, which is
+    # most of the cost of a record; rooms don't need them.
+    record = logging.LogRecord.__new__(logging.LogRecord)
+    created = time.time()
+    record.__dict__.update(
+        name=name, msg=event, args=None, levelname=logging.getLevelName(level), levelno=level, pathname="",
+        filename="", module="", lineno=0, funcName=None, created=created, msecs=created % 1 * 1000,
+        relativeCreated=0, thread=None, threadName=None, processName=None, process=None, exc_info=exc_info,
+        exc_text=None, stack_info=None, fields=fields,
+    )
+    return record
+
+
+class RoomLog:
+    def __init__(self, room_name, sample=None, rate=None, burst=None):
+        self.room_name = room_name
+        self.logger = logger
+        self.sample = settings.BLACKJACK_LOG_ROOMS.get(room_name, settings.BLACKJACK_LOG_SAMPLE) \
+            if sample is None else sample
+        self.count = 0
+        # Token bucket for warnings and errors.
+        self.rate = settings.BLACKJACK_LOG_RATE if rate is None else rate
+        self.burst = self.tokens = (burst or max(1, self.rate))
+        self.refilled = time.monotonic()
+        self.suppressed = 0
+
+    def set_sample(self, sample):
+        self.sample = sample
+        self.count = 0
+
+    def emit(self, level, event, exc_info, fields):
+        fields["room"] = self.room_name
+        self.logger.handle(make_record(self.logger.name, level, event, exc_info, fields))
+
+    def debug(self, event, **fields):
+        if not self.sample:
+            return
+        self.count += 1
+        if self.count % self.sample:
+            return
+        if self.sample > 1:
+            fields["sampled"] = self.sample
+        # The sample rate rather than the logger's level decides which room
+        # debug events are kept, so one room can be logged in full.
+        self.emit(logging.DEBUG, event, None, fields)
+
+    def info(self, event, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.emit(logging.INFO, event, None, fields)
+
+    def limited(self, level, event, exc_info, fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return
+        self.tokens -= 1
+        if self.suppressed:
+            fields["suppressed"] = self.suppressed
+            self.suppressed = 0
+        self.emit(level, event, exc_info, fields)
+
+    def warning(self, event, **fields):
+        self.limited(logging.WARNING, event, None, fields)
+
+    def error(self, event, exc_info=None, **fields):
+        self.limited(logging.ERROR, event, exc_info, fields)
+
+
+def get_room_log(room_name):
+    room_log = room_logs.get(room_name)
+    if room_log is None:
+        room_log = room_logs[room_name] = RoomLog(room_name)
+    return room_log
+
+
+def drop_room_log(room_name):
+    room_logs.pop(room_name, None)
+
+
+def set_sample(room_name, sample):
+    """Change how much of a room's debug log is kept, e.g. 1 to see all of it."""
+    get_room_log(room_name).set_sample(sample)
@@ -0,0 +1,94 @@
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from bj.blackjack import Hand, Player, Shoe, card_from_code, rank_values
+from bj.rng import FastShuffle
+
+
+class LegacyCard:
+    # The object model before __slots__: every instance carries a __dict__.
+    def __init__(self, suit, rank):
+        self.suit = suit
+        self.rank = rank
+        self.value = rank_values[rank]
+        self.code = 0
+        self.label = f"{rank} of {suit}"
+
+
+class LegacyHand:
+    def __init__(self):
+        self.cards = []
+        self.hard_value = 0
+        self.num_aces = 0
+        self.soft = False
+        self.value = 0
+        self.bet = 0
+        self.fragment = None
+
+    def add_card(self, card):
+        self.cards.append(card)
+        self.hard_value += card.value
+        self.value = self.hard_value
+
+
+class LegacyPlayer:
+    def __init__(self, name):
+        self.name = name
+        self.hands = [LegacyHand()]
+        self.chips = 0
+
+
+def seat(player_class, hand_class, card, players, hands, cards):
+    seated = []
+    for index in range(players):
+        player = player_class("player%d" % index)
+        player.chips = 1000
+        player.channel = "specific.inmemory!%012d" % index
+        player.hands = [hand_class() for _ in range(hands)]
+        for hand in player.hands:
+            hand.bet = 10
+            for _ in range(cards):
+                hand.add_card(card())
+        seated.append(player)
+    return seated
+
+
+class Command(BaseCommand):
+    help = "Measure memory per seated player with the old and current object models"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--players", type=int, default=10_000)
+        parser.add_argument("--hands", type=int, default=1, help="Hands held by each player")
+        parser.add_argument("--cards", type=int, default=3, help="Cards in each hand")
+
+    def handle(self, *args, **options):
+        shoe = Shoe(8, FastShuffle(0))
+        legacy_cards = {}
+
+        def legacy_card():
+            # Cards were shared per code before, too (bj.blackjack's cache).
+            if not shoe.cards_remaining():
+                shoe.shuffle()
+            code = shoe.deal_code()
+            if code not in legacy_cards:
+                card = card_from_code(code)
+                legacy_cards[code] = LegacyCard(card.suit, card.rank)
+            return legacy_cards[code]
+
+        def card():
+            if not shoe.cards_remaining():
+                shoe.shuffle()
+            return shoe.deal_card()
+
+        self.stdout.write("%(players)d players, %(hands)d hands of %(cards)d cards" % options)
+        for label, player_class, hand_class, deal in (
+            ("before", LegacyPlayer, LegacyHand, legacy_card),
+            ("after", Player, Hand, card),
+        ):
+            tracemalloc.start()
+            seated = seat(player_class, hand_class, deal, options["players"], options["hands"], options["cards"])
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write("  %-7s %6.0f bytes/player" % (label + ":", size / len(seated)))
+            del seated
@@ -0,0 +1,74 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from bj.blackjack import Dealer, Hand, Player, Shoe
+from bj.rng import FastShuffle
+from bj.serialization import game_state, orjson
+
+
+def legacy_game_state(player, dealer_hand):
+    # The encoding used before bj.serialization: cards rendered on every
+    # message and the whole document passed through json.dumps.
+    player_hands = []
+    for hand in player.hands:
+        player_hands.append({
+            "cards": [f"{card.rank} of {card.suit}" for card in hand.cards],
+            "value": hand.get_value(),
+            "busted": hand.is_busted(),
+            "blackjack": hand.is_blackjack(),
+        })
+    return json.dumps({
+        "type": "game_state",
+        "player_hands": player_hands,
+        "dealer_hand": {
+            "cards": [f"{card.rank} of {card.suit}" for card in dealer_hand.cards],
+            "value": dealer_hand.get_value(),
+            "busted": dealer_hand.is_busted(),
+            "blackjack": dealer_hand.is_blackjack()
+        },
+        "chips": player.chips
+    })
+
+
+class Command(BaseCommand):
+    help = "Time encoding of a game_state message with the old and current serializers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--number", type=int, default=100_000)
+        parser.add_argument("--hands", type=int, default=2, help="Hands held by the player")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        shoe = Shoe(2, FastShuffle(options["seed"]))
+        player = Player("player")
+        player.chips = 500
+        for _ in range(options["hands"] - 1):
+            player.add_hand(Hand())
+        for hand in player.hands:
+            hand.initial_cards(shoe)
+        dealer = Dealer()
+        dealer.hands[0].initial_cards(shoe)
+        dealer_hand = dealer.hands[0]
+
+        # The same message, but for the seat's name, which the old one lacked.
+        current = json.loads(game_state(player, dealer_hand))
+        del current["player_name"]
+        assert current == json.loads(legacy_game_state(player, dealer_hand))
+
+        def uncached():
+            for hand in player.hands:
+                hand.fragment = None
+            dealer_hand.fragment = None
+            return game_state(player, dealer_hand)
+
+        number = options["number"]
+        self.stdout.write("encoder: %s" % ("orjson" if orjson is not None else "json"))
+        for label, encode in (
+            ("before", lambda: legacy_game_state(player, dealer_hand)),
+            ("after, hands changed", uncached),
+            ("after, hands cached", lambda: game_state(player, dealer_hand)),
+        ):
+            best = min(timeit.repeat(encode, number=number, repeat=5))
+            self.stdout.write("  %-22s %.2f us/message" % (label + ":", best / number * 1e6))
@@ -0,0 +1,44 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from bj.blackjack import Shoe
+from bj.rng import FastShuffle, SystemShuffle
+
+
+class Command(BaseCommand):
+    help = "Time every room reshuffling its shoe at once with each shuffle source"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10_000)
+        parser.add_argument("--decks", type=int, default=2)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rooms, decks = options["rooms"], options["decks"]
+        system = SystemShuffle()
+        sources = (
+            # The process-wide Mersenne Twister shoes used before bj.rng.
+            ("random (MT)", lambda room: random.Random(options["seed"] + room)),
+            ("system", lambda room: system),
+            ("fast", lambda room: FastShuffle([options["seed"], room])),
+        )
+        self.stdout.write("%d rooms, %d decks" % (rooms, decks))
+        for label, make in sources:
+            shoes = [Shoe(decks, make(room)) for room in range(rooms)]
+            reads = system.reads
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                for shoe in shoes:
+                    shoe.shuffle()
+                best = min(best, time.perf_counter() - started)
+            self.stdout.write("  %-12s %7.2f us/shoe %8.1f ms for all rooms" % (
+                label + ":", best / rooms * 1e6, best * 1e3))
+            if make(0) is system:
+                # Small runs can fit in the buffer already read, with no new reads.
+                read = system.reads - reads
+                self.stdout.write("  %-12s %7s shoes per os.urandom read" % (
+                    "", "%.1f" % (rooms * options["repeat"] / read) if read else "n/a"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from bj.strategy import DEFAULT_TABLE_FILE, save_tables
+
+
+class Command(BaseCommand):
+    help = "Compute dealer outcome and basic strategy tables and write them to disk"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--decks", type=int, nargs="+", default=[1, 2, 6, 8])
+        parser.add_argument("--output", default=DEFAULT_TABLE_FILE)
+
+    def handle(self, *args, **options):
+        save_tables(options["output"], options["decks"])
+        self.stdout.write("Wrote strategy tables for %s decks to %s" % (
+            ", ".join(str(num_decks) for num_decks in options["decks"]), options["output"]))
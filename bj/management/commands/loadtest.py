@@ -0,0 +1,151 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bj.loadtest import CommunicatorConnection, SocketConnection, process_memory, run_bots
+
+# Scenarios run by --suite: (name, rooms, clients per room, rounds).
+SUITE = (
+    ("single room", 1, 6, 20),
+    ("100 rooms", 100, 4, 5),
+    ("1000 clients", 500, 2, 3),
+    ("2000 clients", 500, 4, 2),
+)
+METRICS = ("p50_ms", "p99_ms", "messages_per_s", "memory_per_room_kb")
+
+
+class Command(BaseCommand):
+    help = "Play rounds with simulated WebSocket clients and report latency, throughput and memory"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transport", choices=["inprocess", "daphne"], default="inprocess")
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--clients-per-room", type=int, default=4)
+        parser.add_argument("--rounds", type=int, default=5)
+        parser.add_argument("--suite", action="store_true", help="Run the fixed SUITE of scenarios instead")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--bet-window", type=float, default=0.05)
+        parser.add_argument("--think", type=float, default=0, help="Maximum seconds a bot waits before acting")
+        parser.add_argument("--url", default=None,
+                            help="host:port of a running server for --transport daphne, else one is started")
+        parser.add_argument("--output", default=None, help="Write the results as JSON")
+        parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare with")
+
+    def handle(self, *args, **options):
+        if options["suite"]:
+            scenarios = SUITE
+        else:
+            scenarios = (("custom", options["rooms"], options["clients_per_room"], options["rounds"]),)
+
+        if options["transport"] == "inprocess":
+            results = self.run_inprocess(scenarios, options)
+        else:
+            results = self.run_daphne(scenarios, options)
+
+        baseline = {}
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = {result["scenario"]: result for result in json.load(f)}
+        for result in results:
+            self.report(result, baseline.get(result["scenario"]))
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+    def run_inprocess(self, scenarios, options):
+        from channels.routing import URLRouter
+
+        import bj.routing
+
+        # Settings are read when the room worker starts, which is on the
+        # first connection below.
+        settings.BLACKJACK_BET_WINDOW = options["bet_window"]
+        settings.BLACKJACK_HISTORY = False
+        settings.BLACKJACK_ROUND_LOG_DIR = ""
+        # Rooms get their own seeded shoe so runs deal alike.
+        settings.BLACKJACK_SHUFFLE = "fast"
+        settings.BLACKJACK_SHUFFLE_SEED = options["seed"]
+        application = URLRouter(bj.routing.websocket_urlpatterns)
+
+        async def run():
+            results = []
+            for index, (name, rooms, clients_per_room, rounds) in enumerate(scenarios):
+                report = await run_bots(partial(CommunicatorConnection, application), "inprocess", rooms,
+                                        clients_per_room, rounds, options["seed"], process_memory,
+                                        prefix="load%d_%d_" % (os.getpid(), index), think=options["think"])
+                results.append(dict(report.as_dict(), scenario=name))
+            return results
+
+        return asyncio.run(run())
+
+    def run_daphne(self, scenarios, options):
+        server = None
+        if options["url"]:
+            host, port = options["url"].rsplit(":", 1)
+            port = int(port)
+            memory = None
+        else:
+            host, port = "127.0.0.1", free_port()
+            env = dict(os.environ, BLACKJACK_BET_WINDOW=str(options["bet_window"]), BLACKJACK_HISTORY="0",
+                       BLACKJACK_ROUND_LOG_DIR="", BLACKJACK_SHUFFLE="fast",
+                       BLACKJACK_SHUFFLE_SEED=str(options["seed"]),
+                       DJANGO_SETTINGS_MODULE=os.environ["DJANGO_SETTINGS_MODULE"])
+            server = subprocess.Popen(
+                [sys.executable, "-m", "daphne", "-b", host, "-p", str(port), "blackjack_django.asgi:application"],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_port(host, port)
+            memory = partial(process_memory, server.pid)
+
+        async def run():
+            results = []
+            for index, (name, rooms, clients_per_room, rounds) in enumerate(scenarios):
+                report = await run_bots(partial(SocketConnection, host, port), "daphne", rooms, clients_per_room,
+                                        rounds, options["seed"], memory, prefix="load%d_%d_" % (os.getpid(), index),
+                                        think=options["think"])
+                results.append(dict(report.as_dict(), scenario=name))
+            return results
+
+        try:
+            return asyncio.run(run())
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    def report(self, result, baseline=None):
+        self.stdout.write("%s (%s): %d rooms, %d clients, %d rounds, %d actions, %d errors in %.2fs" % (
+            result["scenario"], result["transport"], result["rooms"], result["clients"], result["rounds"],
+            result["actions"], result["errors"], result["elapsed_s"]))
+        for metric in METRICS:
+            value = result[metric]
+            if value is None:
+                continue
+            line = "  %-20s %10.2f" % (metric + ":", value)
+            if baseline and baseline.get(metric):
+                line += "  (%+.1f%%)" % ((value / baseline[metric] - 1) * 100)
+            self.stdout.write(line)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError("Server did not start on %s:%d" % (host, port))
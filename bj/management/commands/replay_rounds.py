@@ -0,0 +1,49 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from bj.roundlog import verify
+
+
+class Command(BaseCommand):
+    help = "Replay round logs through the engine and check every settlement against the log"
+
+    def add_arguments(self, parser):
+        parser.add_argument("paths", nargs="*", help="Log files, defaults to every log in BLACKJACK_ROUND_LOG_DIR")
+        parser.add_argument("--round", type=int, default=None, help="Print the events of this round")
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to all cores")
+
+    def handle(self, *args, **options):
+        paths = options["paths"]
+        if not paths:
+            if not settings.BLACKJACK_ROUND_LOG_DIR:
+                raise CommandError("No log files given and BLACKJACK_ROUND_LOG_DIR is not set")
+            paths = sorted(glob.glob(os.path.join(settings.BLACKJACK_ROUND_LOG_DIR, "*.bjlog")))
+
+        started = time.perf_counter()
+        rounds = mismatches = 0
+        # Logs are independent, so they are replayed in parallel.
+        with ProcessPoolExecutor(options["workers"]) as executor:
+            for path, (count, mismatched, selected) in zip(
+                    paths, executor.map(partial(verify, round_number=options["round"]), paths)):
+                rounds += count
+                mismatches += len(mismatched)
+                for replayed in mismatched:
+                    self.stdout.write(self.style.ERROR("%s round %d: logged %r, replayed %r" % (
+                        path, replayed.number, replayed.logged, replayed.replayed)))
+                if selected is not None:
+                    self.stdout.write("%s round %d (%s)" % (
+                        path, selected.number, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(selected.started))))
+                    for event in selected.events:
+                        self.stdout.write("  %s" % event)
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write("Replayed %d rounds from %d logs in %.2fs (%.0f rounds/s), %d mismatches" % (
+            rounds, len(paths), elapsed, rounds / elapsed if elapsed else 0, mismatches))
+        if mismatches:
+            raise CommandError("%d rounds did not replay to the logged settlement" % mismatches)
@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bj.simulation import Rules, simulate_parallel
+
+
+class Command(BaseCommand):
+    help = "Simulate blackjack rounds and report house edge, variance and bust rates"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=1_000_000)
+        parser.add_argument("--decks", type=int, nargs="+", default=[2])
+        parser.add_argument("--s17", action="store_true", help="Dealer stands on soft 17")
+        parser.add_argument("--payout", type=float, default=None, help="Blackjack payout, e.g. 1.5 for 3:2")
+        parser.add_argument("--reshuffle-at", type=int, default=None)
+        parser.add_argument("--batch-size", type=int, default=100_000)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to all cores")
+        parser.add_argument("--chunk-size", type=int, default=1_000_000)
+
+    def handle(self, *args, **options):
+        for option in ("rounds", "batch_size", "workers", "chunk_size"):
+            if options[option] is not None and options[option] < 1:
+                raise CommandError("--%s must be at least 1" % option.replace("_", "-"))
+        for num_decks in options["decks"]:
+            rule_options = {"num_decks": num_decks, "hit_soft_17": not options["s17"]}
+            if options["payout"] is not None:
+                rule_options["blackjack_payout"] = options["payout"]
+            if options["reshuffle_at"] is not None:
+                rule_options["reshuffle_at"] = options["reshuffle_at"]
+            rules = Rules(**rule_options)
+
+            started = time.perf_counter()
+            result = simulate_parallel(options["rounds"], rules, options["batch_size"], options["seed"],
+                                       options["workers"], options["chunk_size"])
+            elapsed = time.perf_counter() - started
+
+            self.stdout.write(str(rules))
+            self.stdout.write("  seed:             %d" % result.seed)
+            self.stdout.write("  rounds:           %d (%.1fM hands/min)" % (
+                result.rounds, result.rounds / elapsed * 60 / 1e6))
+            self.stdout.write("  house edge:       %.4f%% +/- %.4f%%" % (
+                result.house_edge * 100, result.standard_error * 100))
+            self.stdout.write("  variance:         %.4f" % result.variance)
+            self.stdout.write("  player bust rate: %.4f" % result.player_bust_rate)
+            self.stdout.write("  dealer bust rate: %.4f" % result.dealer_bust_rate)
@@ -0,0 +1,138 @@
+"""
+In-process counters, gauges and histograms in the Prometheus text format.
+
+Metrics live in module-level objects and are updated from the event loop
+with plain attribute arithmetic: observing a histogram is one bisect and
+two additions, so instrumentation stays on in production. Gauges that
+describe live state (rooms, players) are callbacks evaluated only when
+/metrics is scraped, on the event loop that owns that state.
+
+Labelled metrics hand out one child per label value; look it up once with
+labels() where the value is fixed, e.g. per action type.
+"""
+from bisect import bisect_left
+
+# Latency buckets in seconds, 50us to 2.5s.
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                             for name, value in zip(names, values))
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s %s" % (self.name, self.kind)]
+        for suffix, labelnames, labelvalues, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, format_labels(labelnames, labelvalues),
+                                        format_value(value)))
+        return "\n".join(lines)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+    new_child = CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield "_total", self.labelnames, values, child.value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        yield "", (), (), self.function()
+
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        bucket_labels = self.labelnames + ("le",)
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                yield "_bucket", bucket_labels, values + ("+Inf" if bound == float("inf") else repr(bound),), \
+                    cumulative
+            yield "_sum", self.labelnames, values, child.sum
+            yield "_count", self.labelnames, values, cumulative
+
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+RECEIVE_SECONDS = Histogram("blackjack_receive_seconds", "Time to handle a WebSocket message in the consumer", ["type"])
+ACTION_SECONDS = Histogram("blackjack_action_seconds", "Time for a room to apply an action", ["action"])
+ACTION_ERRORS = Counter("blackjack_action_errors", "Actions rejected by a room", ["action"])
+SEND_SECONDS = Histogram("blackjack_channel_send_seconds", "Time for a room's channel-layer sends", ["kind"])
+BATCH_MESSAGES = Histogram("blackjack_batch_messages", "Messages and ops coalesced into one room batch",
+                           buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+SENT_BYTES = Counter("blackjack_sent_bytes", "Encoded bytes sent by rooms", ["protocol"])
+SHUFFLE_SECONDS = Histogram("blackjack_shuffle_seconds", "Time to shuffle a shoe")
+ROUNDS = Counter("blackjack_rounds", "Rounds settled")
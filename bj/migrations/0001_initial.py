@@ -0,0 +1,62 @@
+# Generated by Django 4.2 on 2026-10-18 10:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Hand',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hand_index', models.PositiveSmallIntegerField()),
+                ('cards', models.CharField(max_length=255)),
+                ('value', models.PositiveSmallIntegerField()),
+                ('bet', models.FloatField()),
+                ('outcome', models.CharField(choices=[('blackjack', 'blackjack'), ('win', 'win'), ('push', 'push'), ('lose', 'lose'), ('bust', 'bust')], max_length=10)),
+                ('payout', models.FloatField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Player',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('chips', models.FloatField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Round',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room', models.CharField(max_length=100)),
+                ('number', models.PositiveIntegerField()),
+                ('dealer_cards', models.CharField(max_length=255)),
+                ('dealer_value', models.PositiveSmallIntegerField()),
+                ('finished_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='round',
+            index=models.Index(fields=['room', 'number'], name='bj_round_room_e32f98_idx'),
+        ),
+        migrations.AddField(
+            model_name='hand',
+            name='player',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hands', to='bj.player'),
+        ),
+        migrations.AddField(
+            model_name='hand',
+            name='round',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hands', to='bj.round'),
+        ),
+    ]
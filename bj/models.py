@@ -1,3 +1,41 @@
 from django.db import models
 
-# Create your models here.
+
+class Player(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    chips = models.FloatField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class Round(models.Model):
+    room = models.CharField(max_length=100)
+    number = models.PositiveIntegerField()
+    dealer_cards = models.CharField(max_length=255)
+    dealer_value = models.PositiveSmallIntegerField()
+    finished_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["room", "number"])]
+
+    def __str__(self):
+        return "%s #%d" % (self.room, self.number)
+
+
+class Hand(models.Model):
+    OUTCOMES = [(outcome, outcome) for outcome in ("blackjack", "win", "push", "lose", "bust")]
+
+    round = models.ForeignKey(Round, related_name="hands", on_delete=models.CASCADE)
+    player = models.ForeignKey(Player, related_name="hands", on_delete=models.CASCADE)
+    hand_index = models.PositiveSmallIntegerField()
+    cards = models.CharField(max_length=255)
+    value = models.PositiveSmallIntegerField()
+    bet = models.FloatField()
+    outcome = models.CharField(max_length=10, choices=OUTCOMES)
+    payout = models.FloatField()
+
+    def __str__(self):
+        return "%s: %s" % (self.player_id, self.cards)
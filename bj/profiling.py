@@ -0,0 +1,132 @@
+"""
+Profiling one room at a time without restarting the server.
+
+The "profile" room action (an admin's {"type": "profile", "kind": "cpu",
+"rounds": 5} WebSocket message, or the form at /profiles) runs the room's
+actions under cProfile ("cpu") or tracemalloc ("memory") for its next
+rounds, or stops the running profile early ("stop"). The result is written
+to settings.BLACKJACK_PROFILE_DIR and can be downloaded from /profiles:
+pstats data for cpu profiles, a text report of the biggest allocation
+sites and of the memory each action type kept for memory profiles.
+
+Profiling replaces the room's process method with a wrapped one for as long
+as it runs; rooms that aren't profiled run the plain method, so profiling
+costs nothing while it is off.
+
+cProfile and tracemalloc are process-wide, so a worker profiles one room at
+a time, and whatever other tasks run while the room awaits in the middle of
+an action is counted too.
+"""
+import cProfile
+import os
+import time
+import tracemalloc
+
+KINDS = ("cpu", "memory")
+FRAMES = 10
+TOP = 50
+
+active = None
+
+
+def profile_path(directory, name):
+    """Path of a profile in directory, or None if name isn't one."""
+    name = os.path.basename(name)
+    path = os.path.join(directory, name)
+    if not name.endswith((".prof", ".txt")) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def list_profiles(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted((name for name in os.listdir(directory) if profile_path(directory, name)),
+                  key=lambda name: os.path.getmtime(os.path.join(directory, name)), reverse=True)
+
+
+class RoomProfile:
+    def __init__(self, room, kind, rounds, directory, requester=None):
+        if kind not in KINDS:
+            raise ValueError("Unknown profile kind %r" % kind)
+        if rounds < 1:
+            raise ValueError("Profile at least one round")
+        self.room = room
+        self.kind = kind
+        self.until = room.rounds_played + rounds
+        self.directory = directory
+        self.requester = requester
+        self.started = time.time()
+        self.profiler = None
+        self.snapshot = None
+        self.tracing = False
+        # Action type -> [actions, bytes still allocated after them].
+        self.retained = {}
+
+    def start(self):
+        global active
+        if active is not None:
+            raise ValueError("Already profiling room %s" % active.room.room_name)
+        active = self
+        if self.kind == "cpu":
+            self.profiler = cProfile.Profile()
+        else:
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing:
+                tracemalloc.start(FRAMES)
+            self.snapshot = tracemalloc.take_snapshot()
+        process = self.room.process
+
+        async def profiled(action_type, player_name, reply_channel, params):
+            await self.run(process, action_type, player_name, reply_channel, params)
+
+        self.room.process = profiled
+        self.room.profile = self
+
+    async def run(self, process, action_type, *args):
+        if self.profiler is not None:
+            self.profiler.enable()
+            try:
+                await process(action_type, *args)
+            finally:
+                self.profiler.disable()
+        else:
+            before = tracemalloc.get_traced_memory()[0]
+            try:
+                await process(action_type, *args)
+            finally:
+                entry = self.retained.setdefault(action_type, [0, 0])
+                entry[0] += 1
+                entry[1] += tracemalloc.get_traced_memory()[0] - before
+        if self.room.profile is self and self.room.rounds_played >= self.until:
+            await self.room.finish_profile()
+
+    def finish(self):
+        """Put the room back as it was and write the results; returns the file name."""
+        global active
+        del self.room.process
+        self.room.profile = None
+        active = None
+        os.makedirs(self.directory, exist_ok=True)
+        name = "%s-%s-%s" % (self.room.room_name, self.kind, time.strftime("%Y%m%d-%H%M%S"))
+        if self.profiler is not None:
+            name += ".prof"
+            self.profiler.dump_stats(os.path.join(self.directory, name))
+        else:
+            name += ".txt"
+            snapshot = tracemalloc.take_snapshot()
+            if self.tracing:
+                tracemalloc.stop()
+            with open(os.path.join(self.directory, name), "w") as f:
+                self.write_memory_report(f, snapshot)
+        return name
+
+    def write_memory_report(self, f, snapshot):
+        f.write("Room %s, %.1fs, rounds up to %d\n\n" % (
+            self.room.room_name, time.time() - self.started, self.room.rounds_played))
+        f.write("Memory kept per action (bytes):\n")
+        for action_type, (count, size) in sorted(self.retained.items(), key=lambda item: -item[1][1]):
+            f.write("  %-12s %8d actions %12d total %10.1f each\n" % (action_type, count, size, size / count))
+        f.write("\nLargest growth by line, whole process:\n")
+        for stat in snapshot.compare_to(self.snapshot, "lineno")[:TOP]:
+            f.write("  %s\n" % stat)
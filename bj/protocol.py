@@ -0,0 +1,171 @@
+"""
+Wire protocol versions for BlackjackGameConsumer.
+
+Version 1 is the original one message per change JSON protocol. Clients
+that connect with ?batch=1 get the messages of each room flush in one
+{"type": "batch", "messages": [...]} frame instead. Version 2
+sends a snapshot of the room on connect and afterwards only small delta ops,
+each a list whose first item is the op name, e.g. ["card", "ann", 0, 37].
+Cards are integer codes (suit_index * 13 + rank_index, see Card.code).
+
+Version 2 frames are either JSON text, {"v": 2, "ops": [...]}, or binary:
+one version byte followed by the ops in the compact tagged encoding below,
+with op names replaced by their index in OPS.
+
+The reply to a join (a "join" message, or a "joined" op) carries a session
+token. A client whose connection dropped connects again and sends
+{"type": "resume", "token": ...} to take its seat back.
+
+A connection may hold several seats. {"type": "batch", "actions": [...]}
+carries actions for any of them, each with a "seat" naming the player it is
+for, and is answered with one "batch_result" message (a "results" op) that
+lists null for each action applied and the error for each that wasn't.
+
+Clients choose at connect time with a WebSocket subprotocol
+("blackjack.v2" or "blackjack.v2.binary") or, for clients that can't set
+one, a ?protocol=2&format=binary query string. Anything else gets version 1.
+"""
+import struct
+from urllib.parse import parse_qs
+
+PROTOCOL_VERSION = 2
+SUBPROTOCOLS = {
+    "blackjack.v2": (2, False),
+    "blackjack.v2.binary": (2, True),
+}
+
+OPS = (
+    "snapshot", "joined", "join", "leave", "bet", "chips", "shuffle", "deal", "dealer", "card", "split", "turn",
+    "result", "reset", "error", "hint", "results",
+)
+OP_CODES = {op: code for code, op in enumerate(OPS)}
+
+NONE, FALSE, TRUE, INT, FLOAT, STR, LIST, DICT = range(8)
+
+
+def negotiate(scope):
+    """Return (version, binary, accepted subprotocol) for a websocket scope."""
+    for subprotocol in scope.get("subprotocols", ()):
+        if subprotocol in SUBPROTOCOLS:
+            return SUBPROTOCOLS[subprotocol] + (subprotocol,)
+    query = parse_qs(scope.get("query_string", b"").decode())
+    if query.get("protocol") == [str(PROTOCOL_VERSION)]:
+        return PROTOCOL_VERSION, query.get("format") == ["binary"], None
+    return 1, False, None
+
+
+def batch_frames(scope):
+    """Whether a version 1 client asked for batch frames."""
+    return parse_qs(scope.get("query_string", b"").decode()).get("batch") == ["1"]
+
+
+def encode_varint(value, out):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_value(value, out):
+    if value is None:
+        out.append(NONE)
+    elif value is True or value is False:
+        out.append(TRUE if value else FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        encode_varint(value << 1 if value >= 0 else (-value << 1) - 1, out)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += struct.pack("<d", value)
+    elif isinstance(value, str):
+        data = value.encode()
+        out.append(STR)
+        encode_varint(len(data), out)
+        out += data
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        encode_varint(len(value), out)
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        encode_varint(len(value), out)
+        for key, item in value.items():
+            encode_value(key, out)
+            encode_value(item, out)
+    else:
+        raise TypeError("Can't encode %r" % (value,))
+
+
+def decode_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def decode_value(data, position):
+    tag = data[position]
+    position += 1
+    if tag == NONE:
+        return None, position
+    elif tag in (FALSE, TRUE):
+        return tag == TRUE, position
+    elif tag == INT:
+        value, position = decode_varint(data, position)
+        return (value >> 1) ^ -(value & 1), position
+    elif tag == FLOAT:
+        return struct.unpack_from("<d", data, position)[0], position + 8
+    elif tag == STR:
+        length, position = decode_varint(data, position)
+        return bytes(data[position:position + length]).decode(), position + length
+    elif tag == LIST:
+        length, position = decode_varint(data, position)
+        items = []
+        for _ in range(length):
+            item, position = decode_value(data, position)
+            items.append(item)
+        return items, position
+    elif tag == DICT:
+        length, position = decode_varint(data, position)
+        items = {}
+        for _ in range(length):
+            key, position = decode_value(data, position)
+            items[key], position = decode_value(data, position)
+        return items, position
+    raise ValueError("Unknown tag %d" % tag)
+
+
+def encode_op(op):
+    out = bytearray()
+    encode_value([OP_CODES[op[0]], *op[1:]], out)
+    return bytes(out)
+
+
+def encode_binary_frame(encoded_ops):
+    return bytes([PROTOCOL_VERSION]) + b"".join(encoded_ops)
+
+
+def decode_binary_frame(data):
+    if data[0] != PROTOCOL_VERSION:
+        raise ValueError("Unsupported protocol version %d" % data[0])
+    ops = []
+    position = 1
+    while position < len(data):
+        op, position = decode_value(data, position)
+        ops.append([OPS[op[0]], *op[1:]])
+    return ops
+
+
+def encode_binary_message(message):
+    out = bytearray()
+    encode_value(message, out)
+    return bytes(out)
+
+
+def decode_binary_message(data):
+    return decode_value(data, 0)[0]
@@ -0,0 +1,73 @@
+"""
+Shuffle sources for Shoe, which shuffles its card codes in place with
+rng.shuffle(codes).
+
+SystemShuffle is for play. It draws from the OS CSPRNG and reads
+buffer_size bytes at a time, so a single os.urandom call covers dozens of
+shoes. FastShuffle is for simulations, tests and load tests. It is a
+seedable PCG64 generator, and each room or test can have its own
+reproducible stream. It is fast, but predictable to anyone who learns its
+state.
+"""
+import os
+import zlib
+
+import numpy as np
+
+BUFFER_SIZE = 1 << 16
+BACKENDS = ("system", "fast")
+
+
+class SystemShuffle:
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.keys = np.empty(0, np.uint64)
+        self.position = 0
+        self.reads = 0
+
+    def draw(self, count):
+        if self.position + count > len(self.keys):
+            self.keys = np.frombuffer(os.urandom(max(self.buffer_size, count * 8)), np.uint64)
+            self.position = 0
+            self.reads += 1
+        keys = self.keys[self.position:self.position + count]
+        self.position += count
+        return keys
+
+    def shuffle(self, codes):
+        # Ordering the cards by independent uniform 64-bit keys gives every
+        # permutation the same chance as long as no two keys are equal; the
+        # rare draw with a tie (about 1 in 10^14 for eight decks) is thrown
+        # away.
+        while True:
+            keys = self.draw(len(codes))
+            order = np.argsort(keys)
+            ordered = keys[order]
+            if not (ordered[1:] == ordered[:-1]).any():
+                break
+        cards = np.frombuffer(codes, np.uint8)
+        cards[:] = cards[order]
+
+
+class FastShuffle:
+    def __init__(self, seed=None):
+        self.generator = np.random.default_rng(seed)
+
+    def shuffle(self, codes):
+        self.generator.shuffle(np.frombuffer(codes, np.uint8))
+
+
+system_shuffle = SystemShuffle()
+
+
+def make_shuffle(backend, seed=None, key=""):
+    """
+    The shuffle source for backend: the shared SystemShuffle, or a new
+    FastShuffle seeded from seed and key (e.g. a room name) when seed is
+    given, from the OS otherwise.
+    """
+    if backend == "system":
+        return system_shuffle
+    elif backend == "fast":
+        return FastShuffle(None if seed is None else [seed, zlib.crc32(key.encode())])
+    raise ValueError("Unknown shuffle backend %r" % backend)
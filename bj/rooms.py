@@ -0,0 +1,886 @@
+"""
+One asyncio actor task per room, sharded across worker processes.
+
+The actor owns the room's BlackjackEngine (shoe, dealer and seats) and
+applies the actions in its inbox one at a time, so room state is only ever
+touched by a single task. Messages produced while draining the inbox are
+coalesced and sent as one channel-layer message per batch.
+
+Every process runs a RoomWorker. Rooms are pinned to one worker by
+consistent hashing of the room name over settings.BLACKJACK_WORKERS; actions
+for a room owned elsewhere are forwarded to the owner's worker channel.
+Replies always go back through the channel layer, so consumers behave the
+same whether the room is local or not.
+
+Round timing is server side: the first bet opens a betting window after
+which the round is dealt, and a hand left unplayed for the action timeout
+is stood. Timers for all of a worker's rooms share one Scheduler and fire
+by putting the action in the room's inbox like any other.
+
+Every engine action a room applies is appended to its round log (see
+bj.roundlog) when settings.BLACKJACK_ROUND_LOG_DIR is set.
+
+A seat is held by the connections bound to it, and a connection may hold
+several of the table's seats; a "batch" action applies actions for them in
+one pass with a single reply. Joining issues a session token, and a new
+connection that sends it back resumes the seat where it was. When the last
+connection goes, the seat is kept for settings.BLACKJACK_RESUME_GRACE
+seconds and, if the player is in the middle of a round (their hands are
+stood by the action timeout), until the round settles. A name sits in one
+of a worker's rooms at a time; rooms on different workers don't check each
+other.
+
+Rooms are created on first use and evicted once nobody is connected and no
+seat is taken: after settings.BLACKJACK_ROOM_IDLE_TIMEOUT, or sooner, least
+recently used first, while the worker hosts more than BLACKJACK_MAX_ROOMS.
+With BLACKJACK_ROOM_SPILL_DIR set, an evicted room's shoe and round count
+are saved there and picked up again when the room is next used.
+
+Rooms report their player and client counts to the worker's Lobby (see
+bj.lobby) after each batch in which they changed. Admins can profile a room
+while it runs, see bj.profiling.
+"""
+import asyncio
+import bisect
+import hashlib
+import heapq
+import json
+import logging
+import os
+import secrets
+import sys
+import time
+from array import array
+from itertools import groupby
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from bj import metrics
+from bj.blackjack import Shoe
+from bj.engine import BETTING, MAX_CHIPS, PLAYING, BlackjackEngine, InvalidAction
+from bj.history import get_history_writer
+from bj.lobby import INTERVAL as LOBBY_INTERVAL, LOBBY_GROUP, RESYNC as LOBBY_RESYNC, WORKER_GROUP, Lobby
+from bj.log import drop_room_log, get_room_log
+from bj.profiling import RoomProfile
+from bj.protocol import PROTOCOL_VERSION, encode_op
+from bj.rng import make_shuffle, system_shuffle
+from bj.roundlog import RoundLog, get_log_writer
+from bj.serialization import encode_items, encode_messages, game_state
+from bj.scheduler import Scheduler
+from bj.shoepool import get_shoe_pool
+from bj.strategy import hint
+
+BET_WINDOW = 10
+NUM_DECKS = 2
+# Share of the shoe dealt before the cut card comes out.
+PENETRATION = 0.75
+ACTION_TIMEOUT = 30
+# The length of bj.models.Player.name.
+MAX_NAME_LENGTH = 100
+# Actions a batch may contain.
+BATCH_ACTIONS = ("join", "bet", "hit", "stand", "split", "double", "hint")
+RESUME_GRACE = 60
+ROOM_IDLE_TIMEOUT = 300
+MAX_ROOMS = 10000
+
+logger = logging.getLogger(__name__)
+
+worker = None
+
+metrics.Gauge("blackjack_rooms", "Rooms hosted by this worker", lambda: len(worker.rooms) if worker else 0)
+metrics.Gauge("blackjack_players", "Seated players in this worker's rooms",
+              lambda: sum(len(room.engine.players) for room in worker.rooms.values()) if worker else 0)
+metrics.Gauge("blackjack_clients", "Connected clients in this worker's rooms",
+              lambda: sum(len(room.clients) for room in worker.rooms.values()) if worker else 0)
+metrics.Gauge("blackjack_timers", "Pending round timers", lambda: len(worker.scheduler) if worker else 0)
+EVICTIONS = metrics.Counter("blackjack_room_evictions", "Idle rooms evicted", ["reason"])
+
+
+class MeteredShoe(Shoe):
+    def shuffle(self):
+        started = time.perf_counter()
+        super().shuffle()
+        metrics.SHUFFLE_SECONDS.observe(time.perf_counter() - started)
+
+
+def get_worker():
+    global worker
+    if worker is None:
+        worker = RoomWorker(settings.BLACKJACK_WORKER_ID, settings.BLACKJACK_WORKERS,
+                            bet_window=settings.BLACKJACK_BET_WINDOW,
+                            action_timeout=settings.BLACKJACK_ACTION_TIMEOUT,
+                            resume_grace=settings.BLACKJACK_RESUME_GRACE, history=get_history_writer(),
+                            log_dir=settings.BLACKJACK_ROUND_LOG_DIR, log_writer=get_log_writer(),
+                            idle_timeout=settings.BLACKJACK_ROOM_IDLE_TIMEOUT, max_rooms=settings.BLACKJACK_MAX_ROOMS,
+                            spill_dir=settings.BLACKJACK_ROOM_SPILL_DIR,
+                            lobby_interval=settings.BLACKJACK_LOBBY_INTERVAL,
+                            lobby_resync=settings.BLACKJACK_LOBBY_RESYNC, shuffle=settings.BLACKJACK_SHUFFLE,
+                            shuffle_seed=settings.BLACKJACK_SHUFFLE_SEED, shoe_pool=get_shoe_pool(),
+                            penetration=settings.BLACKJACK_PENETRATION, profile_dir=settings.BLACKJACK_PROFILE_DIR,
+                            max_chips=settings.BLACKJACK_MAX_CHIPS)
+        worker.start()
+    return worker
+
+
+def worker_channel(worker_id):
+    return "blackjack.rooms.%s" % worker_id
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=64):
+        self.ring = sorted((self.hash("%s:%d" % (node, i)), node) for node in nodes for i in range(replicas))
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get_node(self, key):
+        return self.ring[bisect.bisect(self.keys, self.hash(key)) % len(self.ring)][1]
+
+
+class RoomWorker:
+    def __init__(self, worker_id, workers, channel_layer=None, bet_window=BET_WINDOW, action_timeout=ACTION_TIMEOUT,
+                 resume_grace=RESUME_GRACE, history=None, log_dir=None, log_writer=None,
+                 idle_timeout=ROOM_IDLE_TIMEOUT, max_rooms=MAX_ROOMS, spill_dir=None, lobby_interval=LOBBY_INTERVAL,
+                 lobby_resync=LOBBY_RESYNC, shuffle="system", shuffle_seed=None, shoe_pool=None,
+                 penetration=PENETRATION, profile_dir="profiles", max_chips=MAX_CHIPS):
+        if not 0 < penetration < 1:
+            raise ValueError("penetration must be between 0 and 1")
+        self.worker_id = worker_id
+        self.ring = HashRing(workers)
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.channel = worker_channel(worker_id)
+        self.scheduler = Scheduler()
+        self.bet_window = bet_window
+        self.action_timeout = action_timeout
+        self.resume_grace = resume_grace
+        self.history = history
+        self.log_dir = log_dir
+        self.log_writer = log_writer
+        self.idle_timeout = idle_timeout
+        self.max_rooms = max_rooms
+        self.spill_dir = spill_dir
+        self.shuffle = shuffle
+        self.shuffle_seed = shuffle_seed
+        self.shoe_pool = shoe_pool
+        self.penetration = penetration
+        self.profile_dir = profile_dir
+        self.max_chips = max_chips
+        self.rooms = {}
+        # Names seated in any of this worker's rooms mapped to the room, so a
+        # saved bankroll is only ever in play at one of its tables. Workers
+        # don't share this, so the same name can still sit in rooms owned by
+        # two workers.
+        self.playing = {}
+        self.lobby = Lobby(worker_id, self.channel_layer, self.scheduler, lobby_interval, lobby_resync)
+        self.task = None
+        self.sweeper = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.serve())
+            self.lobby.start()
+            if self.idle_timeout:
+                self.sweeper = self.scheduler.call_later(min(60, self.idle_timeout / 2), self.sweep)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+            self.sweeper = None
+        self.lobby.stop()
+        for room in self.rooms.values():
+            room.stop()
+
+    def owner(self, room_name):
+        return self.ring.get_node(room_name)
+
+    def get_room(self, room_name):
+        room = self.rooms.get(room_name)
+        if room is None:
+            if len(self.rooms) >= self.max_rooms:
+                self.evict(len(self.rooms) - self.max_rooms + 1, "capacity")
+            engine = self.create_engine(room_name)
+            rounds_played = self.restore(room_name, engine) if self.spill_dir else 0
+            round_log = None
+            if self.log_dir:
+                round_log = RoundLog(os.path.join(self.log_dir, "%s.bjlog" % room_name), self.log_writer)
+            room = self.rooms[room_name] = RoomActor(room_name, engine, channel_layer=self.channel_layer,
+                                                     scheduler=self.scheduler, bet_window=self.bet_window,
+                                                     action_timeout=self.action_timeout,
+                                                     resume_grace=self.resume_grace, history=self.history,
+                                                     round_log=round_log, lobby=self.lobby,
+                                                     profile_dir=self.profile_dir, playing=self.playing)
+            room.rounds_played = rounds_played
+            room.start()
+        return room
+
+    def create_engine(self, room_name):
+        shuffle = make_shuffle(self.shuffle, self.shuffle_seed, room_name)
+        if shuffle is system_shuffle and self.shoe_pool is not None:
+            shuffle = self.shoe_pool
+        # The round is dealt from a fresh shoe once fewer cards than are
+        # behind the cut card remain.
+        return BlackjackEngine(shoe=MeteredShoe(NUM_DECKS, shuffle),
+                               reshuffle_at=round(52 * NUM_DECKS * (1 - self.penetration)),
+                               max_chips=self.max_chips)
+
+    def sweep(self):
+        self.sweeper = self.scheduler.call_later(min(60, self.idle_timeout / 2), self.sweep)
+        deadline = time.monotonic() - self.idle_timeout
+        for room in [room for room in self.rooms.values() if room.idle() and room.last_active <= deadline]:
+            self.evict_room(room, "idle")
+
+    def evict(self, count, reason):
+        # Least recently used first. Rooms in use are never evicted, so the
+        # cap is exceeded for as long as they all are.
+        idle = (room for room in self.rooms.values() if room.idle())
+        for room in heapq.nsmallest(count, idle, key=lambda room: room.last_active):
+            self.evict_room(room, reason)
+
+    def evict_room(self, room, reason):
+        del self.rooms[room.room_name]
+        room.stop()
+        if self.spill_dir:
+            self.spill(room)
+        drop_room_log(room.room_name)
+        self.lobby.remove(room.room_name)
+        EVICTIONS.labels(reason).inc()
+
+    def spill_path(self, room_name):
+        return os.path.join(self.spill_dir, "%s.json" % room_name)
+
+    def spill(self, room):
+        shoe = room.engine.shoe
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(self.spill_path(room.room_name), "w") as f:
+            json.dump({"rounds_played": room.rounds_played, "num_decks": shoe.num_decks,
+                       "codes": shoe.codes.tolist(), "position": shoe.position}, f)
+
+    def restore(self, room_name, engine):
+        """Load a spilled room's shoe into engine and return its round count."""
+        path = self.spill_path(room_name)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return 0
+        os.remove(path)
+        if state["num_decks"] == engine.shoe.num_decks:
+            engine.shoe.codes = array("B", state["codes"])
+            engine.shoe.position = state["position"]
+        return state["rounds_played"]
+
+    async def submit(self, room_name, action_type, player_name=None, reply_channel=None, **params):
+        owner = self.owner(room_name)
+        if owner == self.worker_id:
+            self.get_room(room_name).inbox.put_nowait((action_type, player_name, reply_channel, params))
+        else:
+            await self.channel_layer.send(worker_channel(owner), {
+                "type": "room.action",
+                "room_name": room_name,
+                "action_type": action_type,
+                "player_name": player_name,
+                "reply_channel": reply_channel,
+                "params": params,
+            })
+
+    async def serve(self):
+        await self.channel_layer.group_add(LOBBY_GROUP, self.channel)
+        await self.channel_layer.group_add(WORKER_GROUP, self.channel)
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            try:
+                self.dispatch(message)
+            except Exception:
+                # A bad message is dropped rather than ending the task, which
+                # would stop every room this worker owns.
+                logger.exception("worker message failed",
+                                 extra={"fields": {"worker": self.worker_id, "type": message.get("type")}})
+
+    def dispatch(self, message):
+        if message["type"] == "lobby.update":
+            if message["worker"] != self.worker_id:
+                self.lobby.apply(message["worker"], message["rooms"], message["full"])
+            return
+        self.get_room(message["room_name"]).inbox.put_nowait(
+            (message["action_type"], message["player_name"], message["reply_channel"], message["params"]))
+
+
+class RoomActor:
+    def __init__(self, room_name, engine=None, channel_layer=None, scheduler=None, bet_window=BET_WINDOW,
+                 action_timeout=ACTION_TIMEOUT, resume_grace=RESUME_GRACE, history=None, round_log=None, lobby=None,
+                 profile_dir="profiles", playing=None):
+        self.room_name = room_name
+        self.room_group_name = 'blackjack_%s' % room_name
+        self.engine = engine or BlackjackEngine(shoe=MeteredShoe(NUM_DECKS))
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.inbox = asyncio.Queue()
+        self.task = None
+        self.scheduler = scheduler or Scheduler()
+        self.bet_window = bet_window
+        self.action_timeout = action_timeout
+        self.resume_grace = resume_grace
+        self.history = history
+        self.round_log = round_log
+        self.lobby = lobby
+        # The summary last reported to the lobby.
+        self.listed = None
+        self.profile_dir = profile_dir
+        self.profile = None
+        # Seated names mapped to their room, shared by the worker's rooms.
+        self.playing = {} if playing is None else playing
+        self.log = get_room_log(room_name)
+        if round_log is not None:
+            round_log.start(room_name, self.engine)
+        # Pending timers: "deal" for the betting window and a player name for
+        # that player's action timeout, mapped to (hand index, Timer).
+        self.timers = {}
+        # Connected channels mapped to their (protocol version, binary).
+        # Messages are only built for protocols someone is listening with.
+        self.clients = {}
+        self.legacy_clients = 0
+        self.delta_clients = 0
+        self.binary_clients = 0
+        # Outbound (channel, message) pairs collected while processing
+        # actions, in order. channel None means everyone in the room. Keyed
+        # entries are replaced by later ones, so only a player's latest state
+        # is sent. Protocol 2 deltas are never replaced. Both are flushed as
+        # one channel-layer message.
+        self.outbox = {}
+        self.deltas = []
+        self.sequence = 0
+        # Whether this round's dealer upcard and hole card went out as deltas.
+        self.upcard_sent = False
+        self.hole_card_sent = False
+        self.rounds_played = 0
+        # Seats mapped to the number of connections bound to them, and each
+        # bound connection to the set of its seats.
+        self.seats = {}
+        self.seated = {}
+        # Session tokens mapped to their player and back, and the release
+        # timers of seats nobody is connected to.
+        self.sessions = {}
+        self.tokens = {}
+        self.releases = {}
+        self.last_active = time.monotonic()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        for _, timer in self.timers.values():
+            timer.cancel()
+        self.timers = {}
+        for timer in self.releases.values():
+            timer.cancel()
+        self.releases = {}
+        if self.profile is not None:
+            self.profile.finish()
+        if self.round_log is not None:
+            self.round_log.close()
+            self.round_log = None
+
+    async def run(self):
+        while True:
+            await self.process(*await self.inbox.get())
+            while not self.inbox.empty():
+                await self.process(*self.inbox.get_nowait())
+            self.update_timers()
+            await self.flush()
+            self.last_active = time.monotonic()
+            if self.lobby is not None:
+                summary = (len(self.engine.players), len(self.clients), self.engine.phase, self.rounds_played)
+                if summary != self.listed:
+                    self.listed = summary
+                    self.lobby.update(self.room_name, *summary)
+
+    def idle(self):
+        return not self.clients and not self.engine.players and self.inbox.empty()
+
+    def schedule(self, key, delay, action_type, player_name=None, **params):
+        self.timers[key] = (params.get("hand_index"), self.scheduler.call_later(
+            delay, self.inbox.put_nowait, (action_type, player_name, None, params)))
+
+    def cancel_timer(self, key):
+        entry = self.timers.pop(key, None)
+        if entry is not None:
+            entry[1].cancel()
+
+    def update_timers(self):
+        engine = self.engine
+        if engine.phase == BETTING and any(player.hands[0].bet for player in engine.players.values()):
+            if "deal" not in self.timers or self.timers["deal"][1].cancelled:
+                self.schedule("deal", self.bet_window, "deal")
+        else:
+            self.cancel_timer("deal")
+
+        turns = {}
+        if engine.phase == PLAYING:
+            for name, hand_index in engine.turns.items():
+                if hand_index < len(engine.players[name].hands):
+                    turns[name] = hand_index
+        for key, (hand_index, timer) in list(self.timers.items()):
+            if key != "deal" and (turns.get(key) != hand_index or timer.cancelled):
+                self.cancel_timer(key)
+        for name, hand_index in turns.items():
+            if name not in self.timers:
+                self.schedule(name, self.action_timeout, "stand", name, hand_index=hand_index)
+
+    async def process(self, action_type, player_name, reply_channel, params):
+        started = time.perf_counter()
+        try:
+            await self.handle(action_type, player_name, reply_channel, params)
+        except Exception as e:
+            self.action_failed(action_type, player_name, e)
+            # Actions without a reply channel (e.g. the deal timer) fail
+            # silently; everyone else gets the error back.
+            if reply_channel is not None:
+                self.queue({"type": "error", "message": str(e)}, reply_channel)
+                self.queue_delta(["error", str(e)], reply_channel)
+        elapsed = time.perf_counter() - started
+        metrics.ACTION_SECONDS.labels(action_type).observe(elapsed)
+        self.log.debug("action", action=action_type, player=player_name, seconds=elapsed)
+
+    def action_failed(self, action_type, player_name, error):
+        metrics.ACTION_ERRORS.labels(action_type).inc()
+        if isinstance(error, (InvalidAction, ValueError)):
+            self.log.debug("action rejected", action=action_type, player=player_name, error=str(error))
+        else:
+            self.log.error("action failed", exc_info=sys.exc_info(), action=action_type, player=player_name)
+
+    async def handle(self, action_type, player_name, reply_channel, params):
+        if action_type == "connect":
+            self.add_client(reply_channel, params.get("protocol", 1), params.get("binary", False))
+            self.queue({
+                'type': 'connection_good',
+                'message': 'You are now connected to room %s' % self.room_name,
+                'channel_name': reply_channel,
+                'cards_remaining': self.engine.shoe.cards_remaining()
+            }, reply_channel)
+            self.queue_delta(self.snapshot(), reply_channel)
+            return
+
+        if action_type == "disconnect":
+            self.remove_client(reply_channel)
+            for name in self.seated.pop(reply_channel, ()):
+                self.seats[name] -= 1
+                if not self.seats[name]:
+                    del self.seats[name]
+                    if self.resume_grace:
+                        self.releases[name] = self.scheduler.call_later(
+                            self.resume_grace, self.inbox.put_nowait, ("release", name, None, {}))
+            if not self.resume_grace:
+                await self.release_seats()
+            return
+
+        if action_type == "release":
+            self.releases.pop(player_name, None)
+            await self.release_seats()
+            return
+
+        if action_type == "resume":
+            await self.resume(params.get("token"), reply_channel)
+            return
+
+        if action_type == "batch":
+            await self.handle_batch(params["actions"], reply_channel)
+            return
+
+        if action_type == "profile":
+            await self.start_profile(params.get("kind", "cpu"), params.get("rounds", 1), reply_channel)
+            return
+
+        if action_type == "hint":
+            self.queue_hint(self.engine.get_player(player_name), params.get("hand_index", 0), reply_channel)
+            return
+
+        if action_type == "join" and not (isinstance(player_name, str) and 0 < len(player_name) <= MAX_NAME_LENGTH):
+            raise InvalidAction("Names are 1 to %d characters long" % MAX_NAME_LENGTH)
+
+        bankroll = None
+        if action_type == "join" and self.history is not None:
+            # Returning players keep their saved chips, unless they lost them
+            # all and buy in again.
+            bankroll = await database_sync_to_async(self.history.bankroll)(player_name)
+            if bankroll is not None and bankroll > 0:
+                params["chips"] = bankroll
+            else:
+                bankroll = None
+
+        if action_type == "join" and self.playing.get(player_name, self.room_name) != self.room_name:
+            raise InvalidAction("%s is playing in another room" % player_name)
+        events = self.engine.apply(action_type, player_name, **params)
+        if self.round_log is not None:
+            if events and events[0]["type"] == "shuffle":
+                self.round_log.shoe(self.engine.shoe)
+            self.round_log.action(action_type, player_name, params)
+        if action_type == "join" and self.history is not None and bankroll is None:
+            self.history.record_player(player_name, params["chips"])
+        elif action_type == "leave":
+            self.playing.pop(player_name, None)
+            self.sessions.pop(self.tokens.pop(player_name, None), None)
+            if self.history is not None:
+                self.history.record_player(player_name, events[-1]["chips"])
+        if reply_channel is not None and player_name in self.timers:
+            # Any action by the player restarts their action timeout.
+            self.cancel_timer(player_name)
+        if action_type == "join":
+            self.playing[player_name] = self.room_name
+            self.log.info("player joined", player=player_name, chips=params["chips"])
+            token = secrets.token_urlsafe(16)
+            self.sessions[token] = player_name
+            self.tokens[player_name] = token
+            await self.seat(self.engine.players[player_name], reply_channel)
+        self.publish(events)
+        if events and events[-1]["type"] == "round_end":
+            self.rounds_played += 1
+            metrics.ROUNDS.inc()
+            if self.history is not None:
+                self.history.record_round(self.room_name, self.rounds_played, events)
+            if self.round_log is not None:
+                self.round_log.settle(events)
+                self.round_log.action("new_round", None, {})
+            self.publish(self.engine.new_round())
+            await self.release_seats()
+
+    async def seat(self, player, channel):
+        player.channel = channel
+        self.seated.setdefault(channel, set()).add(player.name)
+        self.seats[player.name] = self.seats.get(player.name, 0) + 1
+        await self.channel_layer.send(channel, {
+            "type": "player_joined",
+            "player_name": player.name,
+            "chips": player.chips,
+            "token": self.tokens[player.name],
+        })
+
+    async def resume(self, token, reply_channel):
+        # The connection already got a snapshot when it connected; all that
+        # is left is to rebind the seat and tell this client where it stands.
+        name = self.sessions.get(token)
+        if name is None:
+            raise InvalidAction("Unknown or expired session")
+        if name in self.seated.get(reply_channel, ()):
+            raise InvalidAction("Already seated as %s" % name)
+        release = self.releases.pop(name, None)
+        if release is not None:
+            release.cancel()
+        player = self.engine.players[name]
+        await self.seat(player, reply_channel)
+        self.log.info("player resumed", player=name)
+        if name in self.engine.turns:
+            self.queue_cards(player, reply_channel)
+            self.queue_game_state(player)
+            if self.engine.phase == PLAYING and self.engine.turns[name] < len(player.hands):
+                self.queue({"type": "hand_index", "hand_index": self.engine.turns[name]}, reply_channel)
+
+    async def handle_batch(self, actions, reply_channel):
+        # Actions are applied in order and each succeeds or fails on its own.
+        # The reply lists null for each one applied and the error for each
+        # one that wasn't; the messages they cause go out in the same batch
+        # as usual.
+        results = []
+        for action_type, player_name, params in actions:
+            try:
+                if action_type not in BATCH_ACTIONS:
+                    raise InvalidAction("Invalid action type")
+                if action_type != "join" and player_name not in self.seated.get(reply_channel, ()):
+                    raise InvalidAction("Not seated as %s" % player_name)
+                await self.handle(action_type, player_name, reply_channel, params)
+            except Exception as e:
+                # Client-chosen types are bucketed so they can't grow the labels.
+                self.action_failed(action_type if action_type in BATCH_ACTIONS else "batch", player_name, e)
+                results.append(str(e))
+            else:
+                results.append(None)
+        self.queue({"type": "batch_result", "results": results}, reply_channel)
+        self.queue_delta(["results", results], reply_channel)
+
+    async def start_profile(self, kind, rounds, reply_channel):
+        if kind == "stop":
+            if self.profile is None:
+                raise InvalidAction("Room %s isn't being profiled" % self.room_name)
+            await self.finish_profile()
+            return
+        RoomProfile(self, kind, int(rounds), self.profile_dir, reply_channel).start()
+        self.log.info("profile started", kind=kind, rounds=rounds)
+        if reply_channel is not None:
+            await self.channel_layer.send(reply_channel, {
+                "type": "profile.status",
+                "room": self.room_name,
+                "status": "started",
+                "kind": kind,
+                "rounds": rounds,
+            })
+
+    async def finish_profile(self):
+        requester = self.profile.requester
+        name = self.profile.finish()
+        self.log.info("profile written", file=name)
+        if requester is not None:
+            await self.channel_layer.send(requester, {
+                "type": "profile.status",
+                "room": self.room_name,
+                "status": "finished",
+                "file": name,
+            })
+
+    async def release_seats(self):
+        # Players nobody is connected as leave once their grace period is
+        # over and any round they are playing in has settled.
+        engine = self.engine
+        for name in [name for name in engine.players if name not in self.seats and name not in self.releases]:
+            if engine.phase != PLAYING or name not in engine.turns:
+                await self.handle("leave", name, None, {})
+
+    def add_client(self, channel, protocol, binary):
+        self.remove_client(channel)
+        self.clients[channel] = (protocol, binary)
+        if protocol == 1:
+            self.legacy_clients += 1
+        else:
+            self.delta_clients += 1
+            self.binary_clients += binary
+
+    def remove_client(self, channel):
+        client = self.clients.pop(channel, None)
+        if client is None:
+            return
+        protocol, binary = client
+        if protocol == 1:
+            self.legacy_clients -= 1
+        else:
+            self.delta_clients -= 1
+            self.binary_clients -= binary
+
+    def queue(self, message, channel=None, key=None):
+        if channel is None:
+            if not self.legacy_clients:
+                return
+        elif self.clients.get(channel, (1, False))[0] != 1:
+            return
+        if key is None:
+            self.sequence += 1
+            key = self.sequence
+        key = (channel, key)
+        self.outbox.pop(key, None)
+        self.outbox[key] = (channel, message)
+
+    def queue_delta(self, op, channel=None):
+        if channel is None:
+            if not self.delta_clients:
+                return
+        elif self.clients.get(channel, (1, False))[0] != PROTOCOL_VERSION:
+            return
+        self.deltas.append((channel, op))
+
+    async def flush(self):
+        if self.round_log is not None:
+            self.round_log.flush()
+        if not self.outbox and not self.deltas:
+            return
+        # Runs of shared messages and per-channel private messages become
+        # ordered segments, each encoded once per protocol. A consumer splices
+        # the shared segments and its own private ones into a single frame
+        # (version 1 segments are lists of messages, since plain version 1
+        # clients get a frame per message).
+        message = {"type": "room_batch"}
+        if self.outbox:
+            message["segments"] = self.encode_segments(self.outbox.values(), encode_messages, "v1")
+        if self.deltas:
+            message["delta"] = self.encode_segments(self.deltas, encode_items, "v2")
+            if self.binary_clients:
+                message["binary"] = self.encode_segments(self.deltas, self.encode_binary, "binary")
+        channels = {channel for channel, _ in self.outbox.values()}
+        channels.update(channel for channel, _ in self.deltas)
+        metrics.BATCH_MESSAGES.observe(len(self.outbox) + len(self.deltas))
+        self.outbox = {}
+        self.deltas = []
+
+        started = time.perf_counter()
+        if None in channels:
+            await self.send_batch(None, message)
+            metrics.SEND_SECONDS.labels("group").observe(time.perf_counter() - started)
+        else:
+            for channel in channels:
+                await self.send_batch(channel, message)
+            metrics.SEND_SECONDS.labels("direct").observe(time.perf_counter() - started)
+
+    async def send_batch(self, channel, message):
+        # A channel that is full or invalid (or a layer that is down) loses
+        # this batch; letting the error out would end the room's task.
+        try:
+            if channel is None:
+                await self.channel_layer.group_send(self.room_group_name, message)
+            else:
+                await self.channel_layer.send(channel, message)
+        except Exception as e:
+            self.log.warning("send failed", channel=channel, error=str(e))
+
+    def encode_segments(self, items, encode, protocol):
+        segments = []
+        for shared, run in groupby(items, key=lambda item: item[0] is None):
+            if shared:
+                segment = encode([message for _, message in run])
+                size = self.encoded_size(segment)
+            else:
+                private = {}
+                for channel, message in run:
+                    private.setdefault(channel, []).append(message)
+                segment = {channel: encode(messages) for channel, messages in private.items()}
+                size = sum(self.encoded_size(part) for part in segment.values())
+            metrics.SENT_BYTES.labels(protocol).inc(size)
+            segments.append(segment)
+        return segments
+
+    @staticmethod
+    def encoded_size(part):
+        return sum(len(message) for message in part) if isinstance(part, list) else len(part)
+
+    @staticmethod
+    def encode_binary(ops):
+        return b"".join(encode_op(op) for op in ops)
+
+    def publish(self, events):
+        if self.legacy_clients:
+            self.publish_legacy(events)
+        if self.delta_clients:
+            self.publish_deltas(events)
+        if events and events[-1]["type"] == "reset":
+            # Whether or not any delta clients saw the round that ended.
+            self.upcard_sent = self.hole_card_sent = False
+
+    def publish_legacy(self, events):
+        # Translate engine events into the messages the client understands.
+        for event in events:
+            event_type = event["type"]
+            player = self.engine.players.get(event.get("player_name"))
+
+            if event_type == "player_join":
+                self.queue({'type': 'player_join', 'player_name': event["player_name"]})
+            elif event_type in ("deal", "card", "split"):
+                self.queue_cards(player)
+                self.queue_game_state(player)
+            elif event_type == "blackjack":
+                self.queue({"type": "error", "message": "blackjack congrats"}, player.channel)
+            elif event_type == "bust":
+                self.queue({"type": "error", "message": "This hand is already busted"}, player.channel)
+            elif event_type in ("splitable", "hand_index"):
+                self.queue({"type": event_type, "hand_index": event["hand_index"]}, player.channel)
+            elif event_type == "wait_for_players":
+                self.queue({"type": "wait_for_players"}, player.channel)
+            elif event_type == "result":
+                self.queue({"type": "winner", "message": event["message"]}, player.channel)
+            elif event_type == "round_end":
+                for player in self.engine.players.values():
+                    self.queue_game_state(player)
+                    self.queue_end_game(event, player)
+            elif event_type == "reset":
+                self.queue({'type': 'reset'})
+
+    def publish_deltas(self, events):
+        dealer_hand = self.engine.dealer.hands[0]
+        for event in events:
+            event_type = event["type"]
+            name = event.get("player_name")
+
+            if event_type == "player_join":
+                self.queue_delta(["join", name, event["chips"]])
+            elif event_type == "player_leave":
+                self.queue_delta(["leave", name])
+            elif event_type == "bet":
+                self.queue_delta(["bet", name, 0, event["bet"]])
+                self.queue_delta(["chips", name, event["chips"]])
+            elif event_type == "shuffle":
+                self.queue_delta(["shuffle", event["cards_remaining"]])
+            elif event_type == "deal":
+                if not self.upcard_sent:
+                    self.queue_delta(["dealer", [event["dealer_card"].code]])
+                    self.upcard_sent = True
+                self.queue_delta(["deal", name, [card.code for card in event["cards"]]])
+            elif event_type == "card":
+                self.queue_delta(["card", name, event["hand_index"], event["card"].code])
+            elif event_type == "split":
+                hands = self.engine.players[name].hands
+                hand_index, new_hand_index = event["hand_index"], event["new_hand_index"]
+                self.queue_delta(["split", name, hand_index, new_hand_index,
+                                  [card.code for card in hands[hand_index].cards],
+                                  [card.code for card in hands[new_hand_index].cards]])
+                self.queue_delta(["chips", name, event["chips"]])
+            elif event_type == "double":
+                self.queue_delta(["bet", name, event["hand_index"], event["bet"]])
+                self.queue_delta(["chips", name, event["chips"]])
+            elif event_type == "hand_index":
+                self.queue_delta(["turn", name, event["hand_index"]])
+            elif event_type in ("dealer_card", "result", "round_end"):
+                # The hole card is revealed once the dealer's turn starts.
+                if not self.hole_card_sent:
+                    self.queue_delta(["dealer", [dealer_hand.cards[1].code]])
+                    self.hole_card_sent = True
+                if event_type == "dealer_card":
+                    self.queue_delta(["dealer", [event["card"].code]])
+                elif event_type == "result":
+                    self.queue_delta(["result", name, event["hand_index"], event["outcome"], event["payout"]])
+                    self.queue_delta(["chips", name, event["chips"]])
+            elif event_type == "reset":
+                self.queue_delta(["reset"])
+
+    def snapshot(self):
+        engine = self.engine
+        dealer_cards = engine.dealer.hands[0].cards
+        if engine.phase == PLAYING:
+            dealer_cards = dealer_cards[:1]
+        return ["snapshot", {
+            "version": PROTOCOL_VERSION,
+            "room": self.room_name,
+            "phase": engine.phase,
+            "cards_remaining": engine.shoe.cards_remaining(),
+            "dealer": [card.code for card in dealer_cards],
+            "seats": [
+                [player.name, player.chips, [[card.code for card in hand.cards] for hand in player.hands],
+                 [hand.bet for hand in player.hands], engine.turns.get(player.name)]
+                for player in engine.players.values()
+            ],
+        }]
+
+    def queue_hint(self, player, hand_index, reply_channel):
+        if self.engine.phase != PLAYING:
+            raise InvalidAction("No round in progress")
+        if player.name not in self.engine.turns:
+            raise InvalidAction("You aren't playing this round")
+        if not isinstance(hand_index, int) or not 0 <= hand_index < len(player.hands):
+            raise ValueError("Invalid hand index")
+        upcard = self.engine.dealer.hands[0].cards[0]
+        result = hint(player.hands[hand_index], upcard, self.engine.shoe.num_decks, player.chips)
+        self.queue({"type": "hint", "hand_index": hand_index, **result}, reply_channel)
+        self.queue_delta(["hint", hand_index, result["action"], result["ev"]], reply_channel)
+
+    def queue_cards(self, player, channel=None):
+        self.queue({
+            "type": "cards",
+            "player_name": player.name,
+            "player_cards": [[str(card) for card in hand.cards] for hand in player.hands],
+            "dealer_card": str(self.engine.dealer.hands[0].cards[0])
+        }, channel, key=("cards", player.name))
+
+    def queue_game_state(self, player):
+        self.queue(game_state(player, self.engine.dealer.hands[0]), player.channel, key=("game_state", player.name))
+
+    def queue_end_game(self, event, player):
+        self.queue({
+            "type": "end_game",
+            "dealer_cards": [str(card) for card in event['dealer_cards']],
+            "dealer_value": event['dealer_value'],
+            "dealer_busted": event['dealer_busted'],
+            "dealer_blackjack": event['dealer_blackjack'],
+            "player_chips": player.chips
+        }, player.channel)
@@ -0,0 +1,270 @@
+"""
+Append-only binary log of everything that happens in a room.
+
+Each room appends to its own file: the shoe order whenever it is shuffled,
+every engine action that succeeded (timer-driven ones included) and the
+settlement of each round. The engine is deterministic given the shoe order
+and the actions, so replay() rebuilds every round by driving a fresh
+BlackjackEngine and checks the settlements it computes against the logged
+ones.
+
+File layout: MAGIC, then records of RECORD (type, unix time, payload
+length) followed by the payload. Shoe payloads are the raw card codes and
+actions are ACTION_HEADER (action code, parameter) plus the player's name,
+since those make up most of a log; the rest uses the tagged encoding from
+bj.protocol. A START record begins each run of a room, since a restarted
+room starts from a new table (or, when restored after eviction, from its
+saved shoe and position).
+
+Logging is off unless settings.BLACKJACK_ROUND_LOG_DIR is set. A room's
+records are collected in memory and handed to the worker's LogWriter each
+time the room flushes, and its thread appends them to the file, so rooms
+hold no open files and never wait on the disk.
+"""
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from array import array
+
+from django.conf import settings
+
+from bj import metrics
+from bj.blackjack import Shoe
+from bj.engine import BlackjackEngine
+from bj.protocol import decode_binary_message, encode_binary_message
+
+MAGIC = b"BJLOG\x01"
+RECORD = struct.Struct("<BdH")
+ACTION_HEADER = struct.Struct("<Bd")
+START, SHOE, ACTION, SETTLE = range(1, 5)
+
+# Engine actions and the parameter logged with each.
+ACTIONS = (
+    ("join", "chips"),
+    ("leave", None),
+    ("bet", "amount"),
+    ("deal", None),
+    ("hit", "hand_index"),
+    ("stand", "hand_index"),
+    ("split", "hand_index"),
+    ("double", "hand_index"),
+    ("new_round", None),
+)
+ACTION_CODES = {action_type: code for code, (action_type, _) in enumerate(ACTIONS)}
+
+logger = logging.getLogger(__name__)
+
+writer = None
+
+metrics.Gauge("blackjack_round_log_queue", "Round log flushes waiting to be written",
+              lambda: writer.queue.qsize() if writer else 0)
+
+
+def get_log_writer():
+    global writer
+    if writer is None and settings.BLACKJACK_ROUND_LOG_DIR:
+        writer = LogWriter()
+        writer.start()
+    return writer
+
+
+def append(path, data):
+    with open(path, "ab") as f:
+        if f.tell() == 0:
+            f.write(MAGIC)
+        f.write(data)
+
+
+class LogWriter:
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="bj-roundlog", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def write(self, path, data):
+        self.queue.put((path, data))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            # Everything already queued is written with one open per file,
+            # in the order it was queued.
+            pending = {}
+            while item is not None:
+                path, data = item
+                pending.setdefault(path, []).append(data)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            for path, chunks in pending.items():
+                try:
+                    append(path, b"".join(chunks))
+                except OSError:
+                    logger.exception("round log write failed", extra={"fields": {"path": path}})
+            if item is None:
+                return
+
+
+class RoundLog:
+    def __init__(self, path, writer=None):
+        self.path = path
+        # Records since the last flush, appended by writer's thread, or on
+        # the spot without one.
+        self.writer = writer
+        self.buffer = bytearray()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, record_type, payload):
+        self.buffer += RECORD.pack(record_type, time.time(), len(payload))
+        self.buffer += payload
+
+    def start(self, room_name, engine):
+        self.write(START, encode_binary_message([room_name, engine.shoe.num_decks, engine.reshuffle_at,
+                                                 engine.shoe.position]))
+        self.shoe(engine.shoe)
+
+    def shoe(self, shoe):
+        self.write(SHOE, shoe.codes.tobytes())
+
+    def action(self, action_type, player_name, params):
+        code = ACTION_CODES[action_type]
+        name = ACTIONS[code][1]
+        self.write(ACTION, ACTION_HEADER.pack(code, params.get(name, 0) if name else 0) +
+                   (player_name or "").encode())
+
+    def settle(self, events):
+        self.write(SETTLE, encode_binary_message(settlement(events)))
+
+    def flush(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, bytearray()
+            if self.writer is None:
+                append(self.path, data)
+            else:
+                self.writer.write(self.path, data)
+
+    def close(self):
+        self.flush()
+
+
+def settlement(events):
+    results = []
+    dealer = None
+    for event in events:
+        if event["type"] == "result":
+            results.append([event["player_name"], event["hand_index"], event["outcome"], event["payout"],
+                            event["chips"]])
+        elif event["type"] == "round_end":
+            dealer = [card.code for card in event["dealer_cards"]]
+    return [dealer, results]
+
+
+def read_records(path):
+    """Yield (record type, time, payload) for each complete record in a log."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(MAGIC)] != MAGIC:
+                raise ValueError("%s is not a round log" % path)
+            position = len(MAGIC)
+            size = len(data)
+            while position + RECORD.size <= size:
+                record_type, timestamp, length = RECORD.unpack_from(data, position)
+                position += RECORD.size
+                if position + length > size:
+                    # A record cut short by a crash ends the log.
+                    return
+                yield record_type, timestamp, data[position:position + length]
+                position += length
+
+
+class ReplayShuffle:
+    """Stands in for a Shoe's rng, shuffling into the logged orders."""
+
+    def __init__(self):
+        self.orders = []
+
+    def shuffle(self, codes):
+        codes[:] = array("B", self.orders.pop(0))
+
+
+class ReplayedRound:
+    def __init__(self, number, started, events, logged):
+        self.number = number
+        self.started = started
+        self.events = events
+        self.logged = logged
+        self.replayed = settlement(events)
+
+    @property
+    def ok(self):
+        return self.replayed == self.logged
+
+
+def replay(path):
+    """Rebuild each round in a log, yielding a ReplayedRound per settlement."""
+    engine = None
+    shuffle = ReplayShuffle()
+    number = 0
+    events = []
+    started = None
+    for record_type, timestamp, payload in read_records(path):
+        if record_type == START:
+            _, num_decks, reshuffle_at, *position = decode_binary_message(payload)
+            engine = None
+            shuffle = ReplayShuffle()
+            events = []
+        elif record_type == SHOE:
+            shuffle.orders.append(payload)
+            if engine is None:
+                engine = BlackjackEngine(shoe=Shoe(num_decks, shuffle), reshuffle_at=reshuffle_at)
+                # A room restored from a spill starts part way into its shoe.
+                engine.shoe.position = position[0] if position else 0
+        elif record_type == ACTION:
+            code, value = ACTION_HEADER.unpack_from(payload)
+            action_type, name = ACTIONS[code]
+            params = {}
+            if name is not None:
+                params[name] = int(value) if value.is_integer() else value
+            player_name = payload[ACTION_HEADER.size:].decode() or None
+            if action_type == "deal":
+                number += 1
+                started = timestamp
+            result = engine.apply(action_type, player_name, **params)
+            # A round's events run from its first bet to its settlement.
+            events = [] if action_type == "new_round" else events + result
+        elif record_type == SETTLE:
+            yield ReplayedRound(number, started, events, decode_binary_message(payload))
+
+
+def verify(path, round_number=None):
+    """
+    Replay a whole log. Returns (rounds, mismatched rounds, the round with
+    round_number or None).
+    """
+    rounds = 0
+    mismatches = []
+    selected = None
+    for replayed in replay(path):
+        rounds += 1
+        if not replayed.ok:
+            mismatches.append(replayed)
+        if replayed.number == round_number:
+            selected = replayed
+    return rounds, mismatches, selected
@@ -4,5 +4,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'blackjack/(?P<room_name>\w+)/$', consumers.BlackjackGameConsumer.as_asgi()),
+    re_path(r'lobby/$', consumers.LobbyConsumer.as_asgi()),
 ]
 
@@ -0,0 +1,81 @@
+"""
+Timer heap shared by every room on an event loop.
+
+Rooms schedule many short-lived timers (betting windows, action timeouts)
+and cancel most of them before they fire. The scheduler keeps them in one
+heap and holds a single loop callback for the earliest deadline, instead of
+a loop handle or sleeping task per timer. Cancelled timers are dropped
+lazily, and the heap is compacted when they make up most of it.
+"""
+import asyncio
+import heapq
+from itertools import count
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.scheduler = None
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            if self.scheduler is not None:
+                self.scheduler.discard()
+
+
+class Scheduler:
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.heap = []
+        self.counter = count()
+        self.cancelled = 0
+        self.handle = None
+        self.handle_when = None
+
+    def call_later(self, delay, callback, *args):
+        loop = self.loop or asyncio.get_running_loop()
+        self.loop = loop
+        timer = Timer(loop.time() + delay, callback, args)
+        timer.scheduler = self
+        heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+        if self.handle_when is None or timer.when < self.handle_when:
+            self.wake_at(timer.when)
+        return timer
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def discard(self):
+        self.cancelled += 1
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def wake_at(self, when):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.handle = self.loop.call_at(when, self.run_due)
+        self.handle_when = when
+
+    def run_due(self):
+        self.handle = self.handle_when = None
+        now = self.loop.time()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            timer.scheduler = None
+            if timer.cancelled:
+                self.cancelled -= 1
+                continue
+            timer.cancelled = True
+            timer.callback(*timer.args)
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)[2].scheduler = None
+            self.cancelled -= 1
+        if heap:
+            self.wake_at(heap[0][0])
@@ -0,0 +1,57 @@
+"""
+JSON encoding for outbound consumer messages.
+
+orjson is used when it is installed, the stdlib json module otherwise. The
+52 card strings are rendered to JSON once, and each hand's game_state
+fragment is cached on the hand until a card is added or removed, so a
+game_state message is mostly string joins.
+
+Messages queued as str are treated as already encoded JSON.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from bj.blackjack import ranks, suits
+
+CARD_JSON = tuple(json.dumps(f"{rank} of {suit}") for suit in suits for rank in ranks)
+
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value).decode()
+else:
+    def dumps(value):
+        return json.dumps(value, separators=(",", ":"))
+
+
+def encode_items(messages):
+    """Encode messages as the comma separated items of a JSON list."""
+    return ",".join(message if isinstance(message, str) else dumps(message) for message in messages)
+
+
+def encode_messages(messages):
+    """Encode messages one by one, for clients that may take a frame each."""
+    return [message if isinstance(message, str) else dumps(message) for message in messages]
+
+
+def hand_fragment(hand):
+    if hand.fragment is None:
+        hand.fragment = '{"cards":[%s],"value":%d,"busted":%s,"blackjack":%s}' % (
+            ",".join([CARD_JSON[card.code] for card in hand.cards]),
+            hand.value,
+            "true" if hand.is_busted() else "false",
+            "true" if hand.is_blackjack() else "false",
+        )
+    return hand.fragment
+
+
+def game_state(player, dealer_hand):
+    return '{"type":"game_state","player_name":%s,"player_hands":[%s],"dealer_hand":%s,"chips":%s}' % (
+        dumps(player.name),
+        ",".join([hand_fragment(hand) for hand in player.hands]),
+        hand_fragment(dealer_hand),
+        dumps(player.chips),
+    )
@@ -0,0 +1,92 @@
+"""
+Shuffled shoes made ahead of time.
+
+A ShoePool is a shuffle source (see bj.rng) whose shuffle() hands the shoe
+a card order that a background thread already shuffled, so a reshuffle on
+the event loop costs a copy of a few hundred bytes. The pool keeps up to
+`size` orders for each shoe size it has been asked for and is topped up
+once it falls below half. When it runs dry the shoe is shuffled in place
+as before, and that counts as a miss.
+
+Only rooms that shuffle with the OS CSPRNG use the pool; seeded rooms
+shuffle their own shoes so their deals stay reproducible.
+"""
+import threading
+from array import array
+from collections import deque
+
+from django.conf import settings
+
+from bj import metrics
+from bj.rng import SystemShuffle, system_shuffle
+
+pool = None
+
+metrics.Gauge("blackjack_shoe_pool_size", "Shuffled shoes ready in the pool",
+              lambda: sum(len(orders) for orders in pool.orders.values()) if pool else 0)
+TAKES = metrics.Counter("blackjack_shoe_pool_takes", "Reshuffles served by the shoe pool", ["result"])
+
+
+def get_shoe_pool():
+    global pool
+    if pool is None and settings.BLACKJACK_SHOE_POOL_SIZE:
+        pool = ShoePool(settings.BLACKJACK_SHOE_POOL_SIZE)
+        pool.start()
+    return pool
+
+
+class ShoePool:
+    def __init__(self, size=64):
+        self.size = size
+        # Shoe size in cards -> shuffled orders. deque appends and pops are
+        # atomic, so the filling thread needs no lock.
+        self.orders = {}
+        # The thread's own source: SystemShuffle's buffer isn't shared
+        # between threads.
+        self.source = SystemShuffle()
+        self.wanted = threading.Event()
+        self.thread = None
+        self.running = False
+        self.hits = TAKES.labels("hit")
+        self.misses = TAKES.labels("miss")
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, name="bj-shoe-pool", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.running = False
+            self.wanted.set()
+            self.thread.join()
+            self.thread = None
+
+    def shuffle(self, codes):
+        orders = self.orders.get(len(codes))
+        if orders is None:
+            orders = self.orders[len(codes)] = deque()
+        try:
+            codes[:] = orders.popleft()
+            self.hits.inc()
+        except IndexError:
+            system_shuffle.shuffle(codes)
+            self.misses.inc()
+        if len(orders) < self.size // 2 + 1:
+            self.wanted.set()
+
+    def fill(self):
+        for count, orders in list(self.orders.items()):
+            while self.running and len(orders) < self.size:
+                codes = array("B", range(52)) * (count // 52)
+                self.source.shuffle(codes)
+                orders.append(codes)
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            if not self.running:
+                return
+            self.fill()
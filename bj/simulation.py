@@ -0,0 +1,318 @@
+"""
+Headless Monte Carlo simulation of the bj.blackjack rules.
+
+Every table in a batch owns its own shoe (one row of a NumPy array) and
+plays one seat against the dealer each round, so a round for the whole
+batch is a handful of vectorized operations instead of a Python loop per
+hand.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from bj.blackjack import BLACKJACK_PAYOUT, RESHUFFLE_AT, Dealer, ranks, rank_values, suits
+
+STAND, HIT, DOUBLE, DOUBLE_OR_STAND = 0, 1, 2, 3
+
+# Basic strategy for hit/stand/double, rows by player total, columns by dealer
+# upcard 2..A. Pairs are played as their hard or soft total.
+HARD_STRATEGY = {
+    9: "HDDDDHHHHH",
+    10: "DDDDDDDDHH",
+    11: "DDDDDDDDDD",
+    12: "HHSSSHHHHH",
+    13: "SSSSSHHHHH",
+    14: "SSSSSHHHHH",
+    15: "SSSSSHHHHH",
+    16: "SSSSSHHHHH",
+}
+SOFT_STRATEGY = {
+    13: "HHHDDHHHHH",
+    14: "HHHDDHHHHH",
+    15: "HHDDDHHHHH",
+    16: "HHDDDHHHHH",
+    17: "HDDDDHHHHH",
+    18: "SFFFFSSHHH",
+    19: "SSSSFSSSSS",
+}
+STRATEGY_CODES = {"S": STAND, "H": HIT, "D": DOUBLE, "F": DOUBLE_OR_STAND}
+
+# Enough iterations to finish any hand: the longest possible hand uses fewer
+# cards than this.
+MAX_DRAWS = 12
+
+
+def build_strategy_table():
+    table = np.zeros((2, 32, 12), dtype=np.int8)
+    table[0, :12, :] = HIT
+    table[1, :18, :] = HIT
+    for soft, strategy in ((0, HARD_STRATEGY), (1, SOFT_STRATEGY)):
+        for total, actions in strategy.items():
+            table[soft, total, 2:] = [STRATEGY_CODES[action] for action in actions]
+    return table
+
+
+def build_deck(num_decks):
+    # Aces are stored as 1; a hand is soft when it holds an ace and its hard
+    # total is 11 or less.
+    values = [1 if rank_values[rank] == 11 else rank_values[rank] for rank in ranks]
+    return np.tile(np.array(values, dtype=np.int8), len(suits) * num_decks)
+
+
+class Rules:
+    def __init__(self, num_decks=2, hit_soft_17=None, blackjack_payout=BLACKJACK_PAYOUT,
+                 reshuffle_at=RESHUFFLE_AT):
+        if hit_soft_17 is None:
+            hit_soft_17 = Dealer().hit_soft_17
+        if reshuffle_at < 1 or reshuffle_at >= num_decks * len(suits) * len(ranks):
+            raise ValueError("reshuffle_at must be between 1 and the shoe size")
+        self.num_decks = num_decks
+        self.hit_soft_17 = hit_soft_17
+        self.blackjack_payout = blackjack_payout
+        self.reshuffle_at = reshuffle_at
+
+    def __str__(self):
+        return "%d decks, %s, blackjack pays %g, reshuffle at %d cards" % (
+            self.num_decks, "H17" if self.hit_soft_17 else "S17",
+            self.blackjack_payout, self.reshuffle_at)
+
+
+class SimulationResult:
+    def __init__(self, rules):
+        self.rules = rules
+        self.seed = None
+        self.rounds = 0
+        self.total_wagered = 0.0
+        self.net = 0.0
+        self.net_squared = 0.0
+        self.player_busts = 0
+        self.dealer_busts = 0
+        self.player_blackjacks = 0
+        self.dealer_blackjacks = 0
+        self.doubles = 0
+        self.wins = 0
+        self.pushes = 0
+        self.losses = 0
+
+    def merge(self, other):
+        for field in ("rounds", "total_wagered", "net", "net_squared", "player_busts", "dealer_busts",
+                      "player_blackjacks", "dealer_blackjacks", "doubles", "wins", "pushes", "losses"):
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+        return self
+
+    @property
+    def house_edge(self):
+        # Player loss per initial unit bet.
+        return -self.net / self.rounds if self.rounds else 0.0
+
+    @property
+    def variance(self):
+        if not self.rounds:
+            return 0.0
+        mean = self.net / self.rounds
+        return self.net_squared / self.rounds - mean * mean
+
+    @property
+    def standard_error(self):
+        return math.sqrt(self.variance / self.rounds) if self.rounds else 0.0
+
+    @property
+    def player_bust_rate(self):
+        return self.player_busts / self.rounds if self.rounds else 0.0
+
+    @property
+    def dealer_bust_rate(self):
+        return self.dealer_busts / self.rounds if self.rounds else 0.0
+
+    def as_dict(self):
+        return {
+            "rules": str(self.rules),
+            "rounds": self.rounds,
+            "house_edge": self.house_edge,
+            "standard_error": self.standard_error,
+            "variance": self.variance,
+            "player_bust_rate": self.player_bust_rate,
+            "dealer_bust_rate": self.dealer_bust_rate,
+            "player_blackjacks": self.player_blackjacks,
+            "dealer_blackjacks": self.dealer_blackjacks,
+            "doubles": self.doubles,
+            "wins": self.wins,
+            "pushes": self.pushes,
+            "losses": self.losses,
+        }
+
+
+class BatchSimulator:
+    def __init__(self, rules, batch_size, rng):
+        self.rules = rules
+        self.batch_size = batch_size
+        self.rng = rng
+        self.strategy = build_strategy_table()
+        self.deck = build_deck(rules.num_decks)
+        self.shoe_size = len(self.deck)
+        self.rows = np.arange(batch_size)
+        self.shoes = np.tile(self.deck, (batch_size, 1))
+        self.rng.permuted(self.shoes, axis=1, out=self.shoes)
+        self.positions = np.zeros(batch_size, dtype=np.intp)
+
+    def reshuffle(self):
+        low = self.shoe_size - self.positions < self.rules.reshuffle_at
+        if low.any():
+            self.shoes[low] = self.rng.permuted(self.shoes[low], axis=1)
+            self.positions[low] = 0
+
+    def draw(self, mask=None):
+        # Positions wrap inside the shoe, so a pathological run of small cards
+        # past the cut card reuses cards instead of indexing out of range.
+        cards = self.shoes[self.rows, self.positions % self.shoe_size]
+        if mask is None:
+            self.positions += 1
+            return cards
+        self.positions += mask
+        return np.where(mask, cards, 0)
+
+    @staticmethod
+    def totals(hard, aces):
+        soft = aces & (hard <= 11)
+        return np.where(soft, hard + 10, hard), soft
+
+    def play_round(self, result):
+        self.reshuffle()
+        player_first, dealer_up = self.draw(), self.draw()
+        player_second, dealer_hole = self.draw(), self.draw()
+
+        player_hard = (player_first + player_second).astype(np.int16)
+        player_aces = (player_first == 1) | (player_second == 1)
+        dealer_hard = (dealer_up + dealer_hole).astype(np.int16)
+        dealer_aces = (dealer_up == 1) | (dealer_hole == 1)
+
+        player_total, player_soft = self.totals(player_hard, player_aces)
+        dealer_total, dealer_soft = self.totals(dealer_hard, dealer_aces)
+        player_blackjack = player_total == 21
+        dealer_blackjack = dealer_total == 21
+        upcard = np.where(dealer_up == 1, 11, dealer_up)
+
+        bets = np.ones(self.batch_size, dtype=np.float64)
+        # Like bj.engine, the dealer doesn't peek: hands are played out, and
+        # doubled, against a dealer blackjack and lose the whole bet to it.
+        active = ~player_blackjack
+
+        action = self.strategy[player_soft.view(np.int8), player_total, upcard]
+        doubled = active & ((action == DOUBLE) | (action == DOUBLE_OR_STAND))
+        card = self.draw(doubled)
+        player_hard += card
+        player_aces |= card == 1
+        bets[doubled] = 2.0
+        active &= ~doubled
+        active &= action != DOUBLE_OR_STAND
+        player_total, player_soft = self.totals(player_hard, player_aces)
+
+        for _ in range(MAX_DRAWS):
+            # Past the first two cards a hand can't double, so "F" stands.
+            action = self.strategy[player_soft.view(np.int8), player_total, upcard]
+            hitting = active & (action != STAND) & (action != DOUBLE_OR_STAND)
+            if not hitting.any():
+                break
+            card = self.draw(hitting)
+            player_hard += card
+            player_aces |= card == 1
+            player_total, player_soft = self.totals(player_hard, player_aces)
+            active = hitting & (player_total < 21)
+
+        player_busted = player_total > 21
+        dealer_active = ~(player_blackjack | dealer_blackjack | player_busted)
+        for _ in range(MAX_DRAWS):
+            hitting = dealer_active & (dealer_total < 17)
+            if self.rules.hit_soft_17:
+                hitting |= dealer_active & (dealer_total == 17) & dealer_soft
+            if not hitting.any():
+                break
+            card = self.draw(hitting)
+            dealer_hard += card
+            dealer_aces |= card == 1
+            dealer_total, dealer_soft = self.totals(dealer_hard, dealer_aces)
+            dealer_active = hitting
+        dealer_busted = dealer_total > 21
+
+        net = np.select(
+            [
+                player_blackjack & dealer_blackjack,
+                player_blackjack,
+                dealer_blackjack,
+                player_busted,
+                dealer_busted,
+                player_total > dealer_total,
+                player_total < dealer_total,
+            ],
+            [0.0, self.rules.blackjack_payout, -bets, -bets, bets, bets, -bets],
+            0.0,
+        )
+
+        result.rounds += self.batch_size
+        result.total_wagered += float(bets.sum())
+        result.net += float(net.sum())
+        result.net_squared += float(np.dot(net, net))
+        result.player_busts += int(player_busted.sum())
+        result.dealer_busts += int(dealer_busted.sum())
+        result.player_blackjacks += int(player_blackjack.sum())
+        result.dealer_blackjacks += int(dealer_blackjack.sum())
+        result.doubles += int(np.count_nonzero(bets == 2.0))
+        result.wins += int(np.count_nonzero(net > 0))
+        result.pushes += int(np.count_nonzero(net == 0))
+        result.losses += int(np.count_nonzero(net < 0))
+
+
+def simulate(rounds, rules=None, batch_size=100_000, seed=None):
+    """
+    Play ``rounds`` hands under ``rules`` and return a SimulationResult.
+
+    ``seed`` is anything np.random.default_rng accepts: an int, a
+    SeedSequence or a Generator.
+    """
+    if rounds < 1 or batch_size < 1:
+        raise ValueError("rounds and batch_size must be at least 1")
+    rules = rules or Rules()
+    rng = np.random.default_rng(seed)
+    result = SimulationResult(rules)
+    simulator = BatchSimulator(rules, min(batch_size, rounds), rng)
+    while result.rounds + simulator.batch_size <= rounds:
+        simulator.play_round(result)
+    remaining = rounds - result.rounds
+    if remaining:
+        BatchSimulator(rules, remaining, rng).play_round(result)
+    return result
+
+
+def simulate_parallel(rounds, rules=None, batch_size=100_000, seed=None, workers=None, chunk_size=1_000_000):
+    """
+    Shard ``rounds`` across a process pool and merge the per-chunk results.
+
+    Work is split into fixed-size chunks, each with its own child of one
+    SeedSequence, and merged in chunk order, so a given seed produces the
+    same numbers for any number of workers.
+    """
+    if rounds < 1 or batch_size < 1 or chunk_size < 1 or (workers is not None and workers < 1):
+        raise ValueError("rounds, batch_size, chunk_size and workers must be at least 1")
+    rules = rules or Rules()
+    workers = workers or os.cpu_count() or 1
+    seed_sequence = np.random.SeedSequence(seed)
+    chunks = [min(chunk_size, rounds - start) for start in range(0, rounds, chunk_size)]
+    seeds = seed_sequence.spawn(len(chunks))
+    result = SimulationResult(rules)
+    result.seed = seed_sequence.entropy
+
+    if workers == 1 or len(chunks) == 1:
+        for chunk_rounds, chunk_seed in zip(chunks, seeds):
+            result.merge(simulate(chunk_rounds, rules, batch_size, chunk_seed))
+        return result
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        futures = [
+            executor.submit(simulate, chunk_rounds, rules, batch_size, chunk_seed)
+            for chunk_rounds, chunk_seed in zip(chunks, seeds)
+        ]
+        for future in futures:
+            result.merge(future.result())
+    return result
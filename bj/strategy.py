@@ -0,0 +1,215 @@
+"""
+Dealer outcome and basic strategy tables.
+
+Dealer final-total probabilities are computed exactly for the shoe
+composition left after the upcard is removed, recursing over every card the
+dealer can draw. Player EVs for stand, hit, double and split use those
+distributions with card probabilities from the same composition. Like
+bj.engine, the dealer doesn't peek, so a dealer blackjack takes every bet
+on the table, doubles and splits included, and a split hand that makes 21
+on two cards is a plain 21 rather than a blackjack.
+
+Tables are memoized per deck count, can be written to a single compressed
+.npz file and are loaded from it when the app starts, so a hint is a few
+array lookups.
+"""
+import os
+from functools import lru_cache
+
+import numpy as np
+
+from bj.blackjack import Dealer, ranks, rank_values, suits
+
+DEFAULT_TABLE_FILE = os.path.join(os.path.dirname(__file__), "data", "strategy.npz")
+
+OUTCOMES = (17, 18, 19, 20, 21, "bust", "blackjack")
+BUST, BLACKJACK = 5, 6
+
+tables = {}
+
+
+def shoe_counts(num_decks):
+    # Number of cards of each value 1..10 in a full shoe, aces counted as 1.
+    counts = [0] * 10
+    for rank in ranks:
+        value = rank_values[rank]
+        counts[(1 if value == 11 else value) - 1] += len(suits) * num_decks
+    return tuple(counts)
+
+
+def hand_total(hard, aces):
+    if aces and hard <= 11:
+        return hard + 10, True
+    return hard, False
+
+
+def dealer_distribution(upcard, counts, hit_soft_17):
+    """Probability of each entry in OUTCOMES for the dealer, upcard 1..10."""
+    counts = list(counts)
+    counts[upcard - 1] -= 1
+
+    @lru_cache(maxsize=None)
+    def play(hard, aces, num_cards, counts):
+        total, soft = hand_total(hard, aces)
+        if num_cards == 2 and total == 21:
+            return (0.0,) * BLACKJACK + (1.0,)
+        if num_cards >= 2:
+            if total > 21:
+                return (0.0,) * BUST + (1.0, 0.0)
+            if total > 17 or (total == 17 and not (soft and hit_soft_17)):
+                outcome = [0.0] * len(OUTCOMES)
+                outcome[total - 17] = 1.0
+                return tuple(outcome)
+
+        remaining = sum(counts)
+        distribution = [0.0] * len(OUTCOMES)
+        for index, count in enumerate(counts):
+            if not count:
+                continue
+            value = index + 1
+            drawn = counts[:index] + (count - 1,) + counts[index + 1:]
+            weight = count / remaining
+            for outcome, probability in enumerate(play(hard + value, aces or value == 1, num_cards + 1, drawn)):
+                distribution[outcome] += weight * probability
+        return tuple(distribution)
+
+    return np.array(play(upcard, upcard == 1, 1, tuple(counts)))
+
+
+class StrategyTable:
+    # EV arrays are indexed [soft, total, upcard] with upcard values 2..11
+    # (ace = 11) to match Card.value; split is indexed [pair value, upcard].
+    def __init__(self, num_decks, dealer, stand, hit, double, split):
+        self.num_decks = num_decks
+        self.dealer = dealer
+        self.stand = stand
+        self.hit = hit
+        self.double = double
+        self.split = split
+
+    @classmethod
+    def compute(cls, num_decks, hit_soft_17=None):
+        if hit_soft_17 is None:
+            hit_soft_17 = Dealer().hit_soft_17
+        counts = shoe_counts(num_decks)
+        dealer = np.zeros((12, len(OUTCOMES)))
+        stand = np.full((2, 22, 12), -1.0)
+        hit = np.full((2, 22, 12), -1.0)
+        double = np.full((2, 22, 12), -2.0)
+        split = np.full((12, 12), -2.0)
+
+        for upcard in range(1, 11):
+            column = 11 if upcard == 1 else upcard
+            dealer[column] = dealer_distribution(upcard, counts, hit_soft_17)
+            outcomes = dealer[column]
+
+            remaining = list(counts)
+            remaining[upcard - 1] -= 1
+            probabilities = np.array(remaining) / sum(remaining)
+
+            def stand_ev(total):
+                if total > 21:
+                    return -1.0
+                ev = outcomes[BUST] - outcomes[BLACKJACK]
+                for outcome, dealer_total in enumerate(OUTCOMES[:BUST]):
+                    if total > dealer_total:
+                        ev += outcomes[outcome]
+                    elif total < dealer_total:
+                        ev -= outcomes[outcome]
+                return ev
+
+            @lru_cache(maxsize=None)
+            def hit_ev(hard, aces):
+                ev = 0.0
+                for index, probability in enumerate(probabilities):
+                    value = index + 1
+                    total, _ = hand_total(hard + value, aces or value == 1)
+                    if total > 21:
+                        ev -= probability
+                    else:
+                        ev += probability * max(stand_ev(total), hit_ev(hard + value, aces or value == 1))
+                return ev
+
+            def double_ev(hard, aces):
+                return 2.0 * sum(
+                    probability * stand_ev(hand_total(hard + index + 1, aces or index == 0)[0])
+                    for index, probability in enumerate(probabilities)
+                )
+
+            for hard in range(2, 22):
+                for aces in (False, True):
+                    total, soft = hand_total(hard, aces)
+                    stand[int(soft), total, column] = stand_ev(total)
+                    hit[int(soft), total, column] = hit_ev(hard, aces)
+                    double[int(soft), total, column] = double_ev(hard, aces)
+
+            for pair in range(1, 11):
+                ev = 0.0
+                for index, probability in enumerate(probabilities):
+                    hard, aces = pair + index + 1, pair == 1 or index == 0
+                    total, _ = hand_total(hard, aces)
+                    ev += probability * max(stand_ev(total), hit_ev(hard, aces), double_ev(hard, aces))
+                split[11 if pair == 1 else pair, column] = 2.0 * ev
+
+        return cls(num_decks, dealer, stand, hit, double, split)
+
+    def evs(self, total, soft, upcard, can_double=False, pair=None):
+        evs = {
+            "stand": float(self.stand[int(soft), total, upcard]),
+            "hit": float(self.hit[int(soft), total, upcard]),
+        }
+        if can_double:
+            evs["double"] = float(self.double[int(soft), total, upcard])
+        if pair is not None:
+            evs["split"] = float(self.split[pair, upcard])
+        return evs
+
+    def dealer_outcomes(self, upcard):
+        return {str(outcome): float(probability) for outcome, probability in zip(OUTCOMES, self.dealer[upcard])}
+
+
+def get_table(num_decks):
+    table = tables.get(num_decks)
+    if table is None:
+        table = tables[num_decks] = StrategyTable.compute(num_decks)
+    return table
+
+
+def save_tables(path=DEFAULT_TABLE_FILE, deck_counts=(1, 2, 6, 8)):
+    arrays = {}
+    for num_decks in deck_counts:
+        # Computed afresh rather than taken from the tables loaded at startup.
+        table = StrategyTable.compute(num_decks)
+        for name in ("dealer", "stand", "hit", "double", "split"):
+            arrays["%d_%s" % (num_decks, name)] = getattr(table, name).astype(np.float32)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez_compressed(path, decks=np.array(deck_counts), **arrays)
+
+
+def load_tables(path=DEFAULT_TABLE_FILE):
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as data:
+        for num_decks in data["decks"]:
+            num_decks = int(num_decks)
+            tables[num_decks] = StrategyTable(num_decks, *(
+                data["%d_%s" % (num_decks, name)] for name in ("dealer", "stand", "hit", "double", "split")
+            ))
+    return True
+
+
+def hint(hand, upcard, num_decks, chips=None):
+    # Doubling and splitting each take another bet, so with chips given
+    # they are only offered when the player can cover it.
+    if hand.is_busted():
+        raise ValueError("This hand is already busted")
+    table = get_table(num_decks)
+    affordable = chips is None or chips >= hand.bet
+    can_double = affordable and len(hand.cards) == 2
+    pair = hand.cards[0].value if affordable and hand.is_splitable() else None
+    evs = table.evs(hand.value, hand.soft, upcard.value, can_double, pair)
+    return {
+        "action": max(evs, key=evs.get),
+        "ev": evs,
+        "dealer_outcomes": table.dealer_outcomes(upcard.value),
+    }
@@ -1,3 +1,1046 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import pickle
+import tempfile
+import time
+from array import array
+from contextlib import redirect_stdout
+from functools import wraps
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+
+from bj import lobby, protocol, rooms, routing, serialization, strategy
+from bj.blackjack import CARDS, Card, Hand, Player, Shoe, ranks
+from bj.cli import BlackjackGame
+from bj.engine import BETTING, PLAYING, SETTLED, BlackjackEngine, InvalidAction
+from bj.history import HistoryWriter
+from bj.loadtest import CommunicatorConnection, Report, Stats, run_bots
+from bj.rng import FastShuffle
+from bj.roundlog import LogWriter, RoundLog, verify
+from bj.scheduler import Scheduler
+from bj.shoepool import ShoePool
+from bj.simulation import BatchSimulator, Rules, SimulationResult, simulate, simulate_parallel
+
+
+class ShoeTests(SimpleTestCase):
+    def test_cards_are_dealt_from_a_cursor(self):
+        shoe = Shoe(2, FastShuffle(0))
+        order = shoe.codes.tolist()
+        self.assertEqual(sorted(order), sorted(list(range(52)) * 2))
+        self.assertEqual([shoe.deal_card().code for _ in range(10)], order[:10])
+        self.assertEqual((shoe.position, shoe.cards_remaining()), (10, 94))
+        # Dealing moves the cursor and leaves the cards where they are.
+        self.assertEqual(shoe.codes.tolist(), order)
+
+    def test_shuffle_starts_a_full_shoe(self):
+        shoe = Shoe(1, FastShuffle(0))
+        for _ in range(52):
+            shoe.deal_card()
+        self.assertEqual(shoe.cards_remaining(), 0)
+        shoe.shuffle()
+        self.assertEqual(shoe.cards_remaining(), 52)
+        self.assertEqual(sorted(shoe.codes), list(range(52)))
+
+    def test_rounds_are_dealt_from_a_fresh_shoe_past_the_cut_card(self):
+        engine = stacked_engine(reshuffle_at=30)
+        engine.shoe.position = len(engine.shoe.codes) - 29
+        engine.bet("ann", 10)
+        events = engine.deal()
+        self.assertEqual(events[0], {"type": "shuffle", "cards_remaining": 104})
+        self.assertEqual(engine.shoe.cards_remaining(), 100)
+
+
+class HandTests(SimpleTestCase):
+    def totals(self, hand):
+        return hand.value, hand.soft
+
+    def test_aces_turn_hard_when_eleven_would_bust(self):
+        hand = make_hand("A", "6")
+        self.assertEqual(self.totals(hand), (17, True))
+        hand.add_card(Card("Hearts", "10"))
+        self.assertEqual(self.totals(hand), (17, False))
+        hand.add_card(Card("Hearts", "A"))
+        self.assertEqual(self.totals(hand), (18, False))
+        self.assertEqual(self.totals(make_hand("A", "A")), (12, True))
+
+    def test_removing_a_card_restores_the_totals(self):
+        hand = make_hand("A", "5")
+        hand.add_card(Card("Hearts", "9"))
+        self.assertEqual(self.totals(hand), (15, False))
+        self.assertEqual(hand.remove_card().rank, "9")
+        self.assertEqual(self.totals(hand), (16, True))
+        hand.remove_card()
+        self.assertEqual((self.totals(hand), hand.hard_value, hand.num_aces), ((11, True), 1, 1))
+
+    def test_split_hands_keep_their_own_totals(self):
+        hand = make_hand("8", "8")
+        new_hand = hand.split_hand(Shoe(1, StackedShuffle([code("3"), code("A")])))
+        self.assertEqual((self.totals(hand), self.totals(new_hand)), ((11, False), (19, True)))
+        self.assertEqual(hand.get_value(), 11)
+
+    def test_hands_and_players_have_no_instance_dict(self):
+        player = Player("ann")
+        player.hands[0] = make_hand("A", "K")
+        for obj in (Card("Hearts", "A"), player, player.hands[0]):
+            self.assertFalse(hasattr(obj, "__dict__"))
+        with self.assertRaises(AttributeError):
+            player.nickname = "annie"
+        restored = pickle.loads(pickle.dumps(player))
+        self.assertEqual((restored.name, restored.hands[0].value, restored.hands[0].cards),
+                         ("ann", 21, player.hands[0].cards))
+
+
+class CardTests(SimpleTestCase):
+    def test_cards_are_shared_and_immutable(self):
+        card = Card("Spades", "Q")
+        self.assertIs(card, CARDS[card.code])
+        self.assertIs(Card("Spades", "Q"), card)
+        for name in ("rank", "nickname"):
+            with self.assertRaises(AttributeError):
+                setattr(card, name, "K")
+        self.assertEqual(card.rank, "Q")
+
+    def test_pickled_cards_come_back_as_the_same_card(self):
+        self.assertTrue(all(pickle.loads(pickle.dumps(card)) is card for card in CARDS))
+        hand = pickle.loads(pickle.dumps(make_hand("9", "K")))
+        self.assertEqual([card is CARDS[card.code] for card in hand.cards], [True, True])
+
+
+def stacked_simulator(values):
+    # One table whose shoe starts with values (aces as 1), dealt in the
+    # simulator's order: player, dealer up, player, dealer hole, then draws.
+    simulator = BatchSimulator(Rules(), 1, np.random.default_rng(0))
+    simulator.shoes[0, :len(values)] = values
+    return simulator
+
+
+class SimulationTests(SimpleTestCase):
+    def play(self, values):
+        result = SimulationResult(Rules())
+        stacked_simulator(values).play_round(result)
+        return result
+
+    def test_double_loses_whole_bet_to_dealer_blackjack(self):
+        # 11 against an ace doubles, and the engine has no peek.
+        result = self.play([5, 1, 6, 10, 9])
+        self.assertEqual(result.doubles, 1)
+        self.assertEqual(result.net, -2.0)
+
+    def test_blackjacks_push(self):
+        result = self.play([1, 1, 10, 10])
+        self.assertEqual(result.net, 0.0)
+        self.assertEqual(result.pushes, 1)
+
+    def test_player_blackjack_pays(self):
+        result = self.play([1, 9, 10, 8])
+        self.assertEqual(result.net, 1.5)
+
+    def test_soft_18_stands_once_it_cannot_double(self):
+        # A,2 hits against a 3 to soft 18, where the "F" cell stands.
+        simulator = stacked_simulator([1, 3, 2, 10, 5, 5])
+        result = SimulationResult(Rules())
+        simulator.play_round(result)
+        self.assertEqual(simulator.positions[0], 6)
+        self.assertEqual((result.net, result.doubles), (0.0, 0))
+
+    def test_rounds_must_be_positive(self):
+        for rounds, batch_size in ((0, 10), (10, 0)):
+            with self.assertRaises(ValueError):
+                simulate(rounds, batch_size=batch_size)
+        with self.assertRaises(CommandError):
+            call_command("simulate", rounds=0, stdout=io.StringIO())
+
+    def test_parallel_results_do_not_depend_on_workers(self):
+        one, two = (simulate_parallel(5000, batch_size=500, seed=7, workers=workers, chunk_size=1200)
+                    for workers in (1, 2))
+        self.assertEqual(one.as_dict(), two.as_dict())
+        self.assertEqual((one.rounds, one.seed), (5000, 7))
+
+    def test_parallel_rounds_must_be_positive(self):
+        for options in ({"rounds": 0}, {"rounds": 10, "workers": 0}, {"rounds": 10, "chunk_size": 0}):
+            with self.assertRaises(ValueError):
+                simulate_parallel(**options)
+        with self.assertRaises(CommandError):
+            call_command("simulate", rounds=0, workers=4, stdout=io.StringIO())
+
+
+def make_hand(*ranks, suit="Hearts"):
+    hand = Hand()
+    for rank in ranks:
+        hand.add_card(Card(suit, rank))
+    return hand
+
+
+class StrategyTests(SimpleTestCase):
+    def test_shipped_tables_are_current(self):
+        self.assertTrue(strategy.load_tables())
+        computed = strategy.StrategyTable.compute(2)
+        for name in ("dealer", "stand", "hit", "double", "split"):
+            np.testing.assert_allclose(getattr(strategy.tables[2], name), getattr(computed, name), atol=1e-6)
+
+    def test_dealer_blackjack_takes_a_standing_21(self):
+        table = strategy.tables.get(2) or strategy.get_table(2)
+        dealer = table.dealer[11]
+        # Wins everything but a dealer 21 (a push) or blackjack (a loss).
+        self.assertAlmostEqual(table.stand[0, 21, 11], 1 - dealer[4] - 2 * dealer[strategy.BLACKJACK], places=5)
+
+    def test_no_peek_hint_hits_eleven_against_an_ace(self):
+        # Doubling risks twice the bet against the dealer's blackjack.
+        result = strategy.hint(make_hand("5", "6"), Card("Spades", "A"), 2)
+        self.assertEqual(result["action"], "hit")
+        self.assertLess(result["ev"]["double"], result["ev"]["hit"])
+
+    def test_hints_only_offer_what_the_player_can_afford(self):
+        hand = make_hand("8", "8")
+        hand.bet = 10
+        self.assertIn("split", strategy.hint(hand, Card("Spades", "6"), 2, chips=10)["ev"])
+        evs = strategy.hint(hand, Card("Spades", "6"), 2, chips=9)["ev"]
+        self.assertEqual(set(evs), {"stand", "hit"})
+
+
+def code(rank, suit=0):
+    return suit * len(ranks) + ranks.index(rank)
+
+
+class StackedShuffle:
+    """Shuffles a shoe into the given orders of card codes, then by seed."""
+
+    def __init__(self, *orders, seed=0):
+        self.orders = list(orders)
+        self.rng = FastShuffle(seed)
+
+    def shuffle(self, codes):
+        self.rng.shuffle(codes)
+        if self.orders:
+            order = self.orders.pop(0)
+            codes[:len(order)] = array("B", order)
+
+
+def stacked_engine(*orders, players=("ann",), reshuffle_at=0, **kwargs):
+    # Rounds are dealt player by player, then the dealer's two cards.
+    engine = BlackjackEngine(shoe=Shoe(2, StackedShuffle(*orders)), reshuffle_at=reshuffle_at, **kwargs)
+    for name in players:
+        engine.join(name, 100)
+    return engine
+
+
+class EngineTests(SimpleTestCase):
+    def test_round(self):
+        engine = stacked_engine([code("10"), code("9"), code("10"), code("7")])
+        engine.bet("ann", 10)
+        engine.deal()
+        self.assertEqual(engine.phase, PLAYING)
+        events = engine.apply("stand", "ann", hand_index=0)
+        self.assertEqual(engine.phase, SETTLED)
+        result = [event for event in events if event["type"] == "result"][0]
+        self.assertEqual((result["outcome"], result["payout"], result["chips"]), ("win", 20, 110))
+
+    def test_double_loses_twice_the_bet_to_dealer_blackjack(self):
+        engine = stacked_engine([code("5"), code("6"), code("A"), code("K"), code("9")])
+        engine.bet("ann", 10)
+        engine.deal()
+        engine.apply("double", "ann", hand_index=0)
+        self.assertEqual(engine.players["ann"].chips, 80)
+
+    def test_split_hands_carry_their_own_bet(self):
+        engine = stacked_engine([code("8"), code("8", 1), code("10"), code("9"), code("10"), code("10")])
+        engine.bet("ann", 10)
+        engine.deal()
+        engine.apply("split", "ann", hand_index=0)
+        self.assertEqual([hand.bet for hand in engine.players["ann"].hands], [10, 10])
+        engine.apply("stand", "ann", hand_index=0)
+        engine.apply("stand", "ann", hand_index=1)
+        self.assertEqual(engine.phase, SETTLED)
+        self.assertEqual(engine.players["ann"].chips, 80)
+
+    def test_split_21_is_not_a_blackjack(self):
+        engine = stacked_engine([code("A"), code("A", 1), code("10"), code("9"), code("K"), code("K", 1)])
+        engine.bet("ann", 10)
+        engine.deal()
+        events = engine.apply("split", "ann", hand_index=0)
+        self.assertNotIn("blackjack", [event["type"] for event in events])
+        self.assertEqual(engine.turns["ann"], 0)
+        engine.apply("stand", "ann", hand_index=0)
+        events = engine.apply("stand", "ann", hand_index=1)
+        results = [(event["outcome"], event["payout"]) for event in events if event["type"] == "result"]
+        self.assertEqual(results, [("win", 20), ("win", 20)])
+
+    def test_invalid_actions_change_nothing(self):
+        engine = stacked_engine()
+        with self.assertRaises(InvalidAction):
+            engine.deal()
+        with self.assertRaises(InvalidAction):
+            engine.bet("ann", 1000)
+        with self.assertRaises(InvalidAction):
+            engine.apply("hit", "ann", hand_index=0)
+        self.assertEqual((engine.phase, engine.turns, engine.players["ann"].chips), (BETTING, {}, 100))
+
+    def test_leaving_before_the_deal_returns_the_bet(self):
+        engine = stacked_engine()
+        engine.bet("ann", 10)
+        self.assertEqual(engine.leave("ann")[-1]["chips"], 100)
+
+    def test_chips_are_checked_before_joining(self):
+        engine = stacked_engine(max_chips=1000)
+        for chips in (0, -5, 1001, "lots", None, True, float("nan")):
+            with self.assertRaises(InvalidAction):
+                engine.join("bob", chips)
+        self.assertEqual(list(engine.players), ["ann"])
+        engine.join("bob", 1000)
+
+    def test_table_is_capped(self):
+        engine = stacked_engine(players=("ann", "bob"), max_seats=2)
+        with self.assertRaises(InvalidAction):
+            engine.join("cat", 100)
+
+    def test_empty_shoe_is_reshuffled_mid_round(self):
+        engine = stacked_engine([code("10"), code("6"), code("9"), code("8")], [code("5")])
+        engine.bet("ann", 10)
+        engine.deal()
+        engine.shoe.position = len(engine.shoe.codes)
+        events = engine.apply("hit", "ann", hand_index=0)
+        self.assertEqual(events[0], {"type": "shuffle", "cards_remaining": len(engine.shoe.codes) - 1})
+        self.assertEqual(events[1]["card"].code, code("5"))
+
+    def test_full_table_plays_through_shoes(self):
+        # Many seats on a small, deeply dealt shoe run out of cards mid-round.
+        names = ["player%d" % index for index in range(14)]
+        engine = BlackjackEngine(shoe=Shoe(2, FastShuffle(0)), reshuffle_at=26, max_seats=14)
+        for name in names:
+            engine.join(name, 10 ** 6)
+        for _ in range(300):
+            for name in names:
+                engine.bet(name, 1)
+            engine.apply("deal")
+            for name in names:
+                player = engine.players[name]
+                while engine.turns[name] < len(player.hands):
+                    hand_index = engine.turns[name]
+                    action = "hit" if player.hands[hand_index].value < 17 else "stand"
+                    engine.apply(action, name, hand_index=hand_index)
+            self.assertEqual(engine.phase, SETTLED)
+            engine.new_round()
+
+
+class CliTests(SimpleTestCase):
+    def test_prompt_takes_only_hand_actions(self):
+        game = BlackjackGame()
+        game.engine = stacked_engine([code("10"), code("9"), code("10"), code("7")])
+        game.engine.bet("ann", 10)
+        game.engine.deal()
+        with mock.patch("builtins.input", side_effect=["deal", "new_round", "Stand"]), \
+                redirect_stdout(io.StringIO()) as out:
+            game.play_player_hands()
+        self.assertEqual(game.engine.phase, SETTLED)
+        self.assertEqual(out.getvalue().count("Invalid action"), 2)
+
+    def test_duplicate_names_are_asked_again(self):
+        game = BlackjackGame(rng=StackedShuffle([code(rank) for rank in ("10", "9", "10", "8", "10", "7")]))
+        with mock.patch("builtins.input", side_effect=["2", "ann", "ann", "bob", "10", "10", "stand", "stand", "n"]), \
+                redirect_stdout(io.StringIO()) as out:
+            game.play_game()
+        self.assertEqual(list(game.engine.players), ["ann", "bob"])
+        self.assertIn("Player ann already joined", out.getvalue())
+
+
+application = URLRouter(routing.websocket_urlpatterns)
+
+
+def with_worker(test=None, **options):
+    """
+    Runs an async test against its own RoomWorker and in-memory channel
+    layer, since each async test gets a new event loop.
+    """
+    def decorator(test):
+        @wraps(test)
+        async def wrapper(self):
+            channel_layers.backends.clear()
+            settings = dict(bet_window=0.05, action_timeout=1, resume_grace=0, history=None, idle_timeout=0,
+                            shuffle="fast", shuffle_seed=0)
+            settings.update(options)
+            rooms.worker = rooms.RoomWorker("default", ["default"], **settings)
+            rooms.worker.start()
+            try:
+                await test(self)
+            finally:
+                rooms.worker.stop()
+                rooms.worker = None
+                channel_layers.backends.clear()
+        return wrapper
+    return decorator(test) if test else decorator
+
+
+async def connect(path):
+    communicator = WebsocketCommunicator(application, path)
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def frames(communicator, timeout=0.2):
+    received = []
+    while not await communicator.receive_nothing(timeout):
+        frame = await communicator.receive_from()
+        received.append(frame if isinstance(frame, bytes) else json.loads(frame))
+    return received
+
+
+class ConsumerTests(SimpleTestCase):
+    async def join_and_bet(self, path):
+        client = await connect(path)
+        await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        received = await frames(client)
+        await client.send_to(text_data=json.dumps({"type": "deal", "bet": 10}))
+        received += await frames(client)
+        await client.disconnect()
+        return received
+
+    @with_worker
+    async def test_plain_v1_clients_get_one_message_per_frame(self):
+        received = await self.join_and_bet("blackjack/plain/")
+        self.assertNotIn("batch", [frame["type"] for frame in received])
+        self.assertIn("cards", [frame["type"] for frame in received])
+
+    @with_worker
+    async def test_v1_clients_can_ask_for_batch_frames(self):
+        received = await self.join_and_bet("blackjack/batched/?batch=1")
+        batches = [frame["messages"] for frame in received if frame["type"] == "batch"]
+        self.assertIn("cards", [message["type"] for messages in batches for message in messages])
+        self.assertTrue(all(len(messages) > 1 for messages in batches))
+
+    @with_worker
+    async def test_actions_before_joining_are_refused(self):
+        client = await connect("blackjack/early/")
+        await frames(client)
+        with self.assertNoLogs("bj", "ERROR"):
+            for message in ({"type": "hit"}, {"type": "deal", "bet": 10},
+                            {"type": "batch", "actions": [{"type": "stand"}]}):
+                await client.send_to(text_data=json.dumps(message))
+                self.assertEqual(await frames(client), [{"type": "error", "message": "Join first"}])
+        await client.send_to(text_data=json.dumps({"type": "hit", "seat": "bob"}))
+        self.assertEqual(await frames(client), [{"type": "error", "message": "Not seated as bob"}])
+        await client.disconnect()
+
+
+class RoomActorTests(SimpleTestCase):
+    @with_worker
+    async def test_each_room_runs_its_own_actor(self):
+        first = await connect("blackjack/actor1/")
+        second = await connect("blackjack/actor2/")
+        await frames(first)
+        await frames(second)
+        actors = rooms.worker.rooms
+        self.assertEqual(set(actors), {"actor1", "actor2"})
+        self.assertIsNot(actors["actor1"].task, actors["actor2"].task)
+        await first.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        await frames(first)
+        self.assertEqual((list(actors["actor1"].engine.players), list(actors["actor2"].engine.players)), (["ann"], []))
+        await first.disconnect()
+        await second.disconnect()
+
+    @with_worker
+    async def test_a_failed_action_does_not_stop_the_room(self):
+        client = await connect("blackjack/actor3/")
+        await frames(client)
+        room = rooms.worker.rooms["actor3"]
+        # The reply to a channel that doesn't exist fails, and is dropped.
+        room.inbox.put_nowait(("bet", "ann", "not a channel", {"amount": 10}))
+        await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        deal = {"type": "deal", "seat": "ann", "bet": 10}
+        await client.send_to(text_data=json.dumps({"type": "batch", "actions": [deal]}))
+        await frames(client)
+        self.assertFalse(room.task.done())
+        self.assertEqual(room.engine.players["ann"].hands[0].bet, 10)
+        await client.disconnect()
+
+    @with_worker(max_rooms=3)
+    async def test_least_recently_used_idle_room_is_evicted(self):
+        worker = rooms.worker
+        client = await connect("blackjack/busy/")
+        await frames(client)
+        worker.get_room("old").last_active -= 10
+        worker.get_room("new")
+        # The busy room has a client, so only old makes way.
+        worker.rooms["busy"].last_active -= 20
+        worker.get_room("third")
+        self.assertEqual(set(worker.rooms), {"busy", "new", "third"})
+        await client.disconnect()
+
+    @with_worker(idle_timeout=60)
+    async def test_sweep_evicts_rooms_idle_past_the_timeout(self):
+        worker = rooms.worker
+        worker.get_room("stale").last_active -= 61
+        worker.get_room("fresh")
+        worker.sweep()
+        self.assertEqual(list(worker.rooms), ["fresh"])
+
+    async def test_evicted_room_is_restored_from_its_spill(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            worker = rooms.RoomWorker("default", ["default"], channel_layer=InMemoryChannelLayer(), history=None,
+                                      idle_timeout=0, shuffle="fast", shuffle_seed=0, spill_dir=spill_dir)
+            worker.start()
+            try:
+                room = worker.get_room("spilled")
+                for _ in range(7):
+                    room.engine.shoe.deal_card()
+                room.rounds_played = 3
+                codes, position = list(room.engine.shoe.codes), room.engine.shoe.position
+                worker.evict_room(room, "idle")
+                self.assertEqual(os.listdir(spill_dir), ["spilled.json"])
+                room = worker.get_room("spilled")
+                self.assertEqual((list(room.engine.shoe.codes), room.engine.shoe.position), (codes, position))
+                self.assertEqual(room.rounds_played, 3)
+                self.assertEqual(os.listdir(spill_dir), [])
+                # A room that was never spilled starts from scratch.
+                self.assertEqual(worker.get_room("other").rounds_played, 0)
+            finally:
+                worker.stop()
+
+
+class ShardingTests(SimpleTestCase):
+    def test_ring_places_rooms_stably(self):
+        names = ["room%d" % number for number in range(1000)]
+        ring = rooms.HashRing(["a", "b", "c"])
+        placement = {name: ring.get_node(name) for name in names}
+        self.assertEqual(placement, {name: rooms.HashRing(["c", "a", "b"]).get_node(name) for name in names})
+        counts = [list(placement.values()).count(node) for node in "abc"]
+        self.assertGreater(min(counts), 200)
+        # A new worker only takes rooms over, it never moves them between
+        # the old ones.
+        grown = rooms.HashRing(["a", "b", "c", "d"])
+        self.assertTrue(all(grown.get_node(name) in (node, "d") for name, node in placement.items()))
+
+    async def test_actions_are_forwarded_to_the_owner(self):
+        layer = InMemoryChannelLayer()
+        workers = {worker_id: rooms.RoomWorker(worker_id, ["a", "b"], channel_layer=layer, history=None,
+                                               idle_timeout=0, shuffle="fast", shuffle_seed=0)
+                   for worker_id in ("a", "b")}
+        for worker in workers.values():
+            worker.start()
+        try:
+            room_name = next(name for name in ("room%d" % number for number in range(100))
+                             if workers["a"].owner(name) == "b")
+            reply_channel = await layer.new_channel()
+            # The owner survives a malformed forwarded message.
+            with self.assertLogs("bj.rooms", "ERROR"):
+                await layer.send(rooms.worker_channel("b"), {"type": "room.action"})
+                await asyncio.sleep(0.05)
+            await workers["a"].submit(room_name, "connect", None, reply_channel, protocol=1, binary=False)
+            message = await asyncio.wait_for(layer.receive(reply_channel), 1)
+            self.assertIn(room_name, json.dumps(message))
+            self.assertEqual((list(workers["a"].rooms), list(workers["b"].rooms)), ([], [room_name]))
+        finally:
+            for worker in workers.values():
+                worker.stop()
+
+
+class SerializationTests(SimpleTestCase):
+    def test_card_strings_match_the_cards(self):
+        self.assertEqual([json.loads(text) for text in serialization.CARD_JSON], [str(card) for card in CARDS])
+
+    def test_hand_fragments_are_cached_until_the_hand_changes(self):
+        hand = make_hand("A", "K")
+        fragment = serialization.hand_fragment(hand)
+        self.assertIs(serialization.hand_fragment(hand), fragment)
+        self.assertEqual(json.loads(fragment), {"cards": ["A of Hearts", "K of Hearts"], "value": 21,
+                                                "busted": False, "blackjack": True})
+        hand.add_card(Card("Spades", "5"))
+        self.assertEqual(json.loads(serialization.hand_fragment(hand))["value"], 16)
+
+    def test_game_state_is_valid_json(self):
+        player = Player('a "quoted" name')
+        player.chips = 97.5
+        player.hands[0].add_card(Card("Clubs", "9"))
+        dealer_hand = make_hand("7")
+        self.assertEqual(json.loads(serialization.game_state(player, dealer_hand)), {
+            "type": "game_state", "player_name": 'a "quoted" name', "chips": 97.5,
+            "player_hands": [{"cards": ["9 of Clubs"], "value": 9, "busted": False, "blackjack": False}],
+            "dealer_hand": {"cards": ["7 of Hearts"], "value": 7, "busted": False, "blackjack": False},
+        })
+
+    def test_encoded_messages_keep_preencoded_text(self):
+        self.assertEqual(serialization.encode_items([{"type": "reset"}, '{"type":"x"}']),
+                         '{"type":"reset"},{"type":"x"}')
+
+
+class ProtocolTests(SimpleTestCase):
+    def test_values_round_trip(self):
+        message = {"type": "join", "name": "añn", "chips": 100, "ratio": 1.5, "seats": [None, True, False, -300],
+                   "big": 2 ** 40}
+        self.assertEqual(protocol.decode_binary_message(protocol.encode_binary_message(message)), message)
+
+    def test_frames_round_trip(self):
+        ops = [["deal", "ann", [1, 51]], ["dealer", [12]], ["results", [None, "Bets are closed"]]]
+        frame = protocol.encode_binary_frame(protocol.encode_op(op) for op in ops)
+        self.assertEqual(protocol.decode_binary_frame(frame), ops)
+
+    def test_frames_of_other_versions_are_rejected(self):
+        with self.assertRaises(ValueError):
+            protocol.decode_binary_frame(bytes([1]))
+
+    def test_negotiate(self):
+        self.assertEqual(protocol.negotiate({"subprotocols": ["chat", "blackjack.v2.binary"]}),
+                         (2, True, "blackjack.v2.binary"))
+        self.assertEqual(protocol.negotiate({"query_string": b"protocol=2"}), (2, False, None))
+        self.assertEqual(protocol.negotiate({"query_string": b"protocol=3"}), (1, False, None))
+
+
+class DeltaTests(SimpleTestCase):
+    @with_worker
+    async def test_upcard_is_sent_after_delta_clients_missed_a_reset(self):
+        player = await connect("blackjack/upcard/")
+        watcher = await connect("blackjack/upcard/?protocol=2")
+        await player.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        await frames(player)
+        await player.send_to(text_data=json.dumps({"type": "deal", "bet": 10}))
+        await frames(player)
+        await watcher.disconnect()
+        # The round ends and resets with no delta clients connected.
+        await player.send_to(text_data=json.dumps({"type": "stand"}))
+        await frames(player)
+        watcher = await connect("blackjack/upcard/?protocol=2")
+        await frames(watcher)
+        await player.send_to(text_data=json.dumps({"type": "deal", "bet": 10}))
+        ops = [op for frame in await frames(watcher) for op in frame["ops"]]
+        self.assertIn("deal", [op[0] for op in ops])
+        self.assertEqual([op[0] for op in ops if op[0] in ("dealer", "deal")][0], "dealer")
+        await player.disconnect()
+        await watcher.disconnect()
+
+
+class SchedulerTests(SimpleTestCase):
+    async def test_timers_fire_in_deadline_order(self):
+        scheduler = Scheduler()
+        fired = []
+        scheduler.call_later(0.03, fired.append, "late")
+        scheduler.call_later(0.01, fired.append, "early")
+        scheduler.call_later(0.01, fired.append, "early too")
+        await asyncio.sleep(0.06)
+        self.assertEqual(fired, ["early", "early too", "late"])
+        self.assertEqual(len(scheduler), 0)
+
+    async def test_cancelled_timers_do_not_fire(self):
+        scheduler = Scheduler()
+        fired = []
+        first = scheduler.call_later(0.01, fired.append, 1)
+        scheduler.call_later(0.02, fired.append, 2)
+        first.cancel()
+        first.cancel()
+        self.assertEqual(len(scheduler), 1)
+        await asyncio.sleep(0.04)
+        self.assertEqual(fired, [2])
+
+    async def test_heap_is_compacted(self):
+        scheduler = Scheduler()
+        timers = [scheduler.call_later(60, print) for _ in range(200)]
+        for timer in timers[:150]:
+            timer.cancel()
+        self.assertEqual(len(scheduler), 50)
+        self.assertLess(len(scheduler.heap), 200)
+        for timer in timers[150:]:
+            timer.cancel()
+
+    @with_worker(action_timeout=0.1)
+    async def test_rooms_deal_and_stand_on_timers(self):
+        client = await connect("blackjack/timers/")
+        await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        await frames(client)
+        await client.send_to(text_data=json.dumps({"type": "deal", "bet": 10}))
+        # The betting window deals, and the action timeout stands the hand.
+        received = await frames(client, timeout=0.5)
+        self.assertIn("cards", [frame["type"] for frame in received])
+        self.assertIn("reset", [frame["type"] for frame in received])
+        await client.disconnect()
+
+
+def settled_round(engine, *names):
+    for name in names:
+        engine.bet(name, 10)
+    engine.apply("deal")
+    events = []
+    for name in names:
+        while engine.turns[name] < len(engine.players[name].hands):
+            events += engine.apply("stand", name, hand_index=engine.turns[name])
+    return events
+
+
+class HistoryTests(TestCase):
+    def drain(self, writer):
+        batch = []
+        while not writer.queue.empty():
+            batch.append(writer.queue.get())
+        return batch
+
+    def test_rounds_are_written_in_one_batch(self):
+        from bj.models import Hand, Player, Round
+
+        writer = HistoryWriter()
+        engine = BlackjackEngine(shoe=Shoe(2, FastShuffle(0)))
+        engine.join("ann", 100)
+        engine.join("bob", 100)
+        for number in range(3):
+            writer.record_round("room", number, settled_round(engine, "ann", "bob"))
+            engine.new_round()
+        with self.assertNumQueries(8):
+            writer.write(self.drain(writer))
+        self.assertEqual(Round.objects.count(), 3)
+        self.assertEqual(Hand.objects.count(), 6)
+        self.assertEqual(Player.objects.get(name="ann").chips, engine.players["ann"].chips)
+        self.assertEqual(writer.pending_chips, {})
+
+    def test_a_bad_item_loses_only_itself(self):
+        from bj.models import Player
+
+        writer = HistoryWriter()
+        writer.record_player("ann", 100)
+        writer.record_player("cat", "lots")
+        writer.record_player("bob", 50)
+        with self.assertLogs("bj.history", "ERROR"):
+            writer.write(self.drain(writer))
+        self.assertEqual(dict(Player.objects.values_list("name", "chips")), {"ann": 100, "bob": 50})
+
+    def test_queued_chips_take_precedence(self):
+        from bj.models import Player
+
+        Player.objects.create(name="ann", chips=100)
+        writer = HistoryWriter()
+        writer.record_player("ann", 70)
+        self.assertEqual(writer.bankroll("ann"), 70)
+        self.assertIsNone(writer.bankroll("bob"))
+
+    def test_items_are_batched(self):
+        writer = HistoryWriter(batch_size=4, flush_interval=0.2)
+        batches = []
+        writer.write = batches.append
+        writer.start()
+        for index in range(6):
+            writer.record_player("player%d" % index, index)
+        writer.stop()
+        self.assertEqual([len(batch) for batch in batches], [4, 2])
+
+
+class SeatTests(SimpleTestCase):
+    async def join(self, path, name):
+        client = await connect(path)
+        await client.send_to(text_data=json.dumps({"type": "join", "name": name, "chips": 100}))
+        return client, [frame for frame in await frames(client) if frame["type"] in ("join", "error")]
+
+    @with_worker
+    async def test_a_name_sits_in_one_room_at_a_time(self):
+        first, joined = await self.join("blackjack/seats1/", "ann")
+        self.assertEqual(joined[0]["type"], "join")
+        second, joined = await self.join("blackjack/seats2/", "ann")
+        self.assertEqual(joined, [{"type": "error", "message": "ann is playing in another room"}])
+        # Once the seat is released, the name is free again.
+        await first.disconnect()
+        await asyncio.sleep(0.1)
+        await second.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        self.assertIn("join", [frame["type"] for frame in await frames(second)])
+        await second.disconnect()
+
+    @with_worker
+    async def test_bad_chips_leave_no_seat_behind(self):
+        client = await connect("blackjack/chips/")
+        for chips in ("lots", -100):
+            await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": chips}))
+            self.assertEqual([frame["type"] for frame in await frames(client) if frame["type"] in ("join", "error")],
+                             ["error"])
+        self.assertEqual(rooms.worker.rooms["chips"].engine.players, {})
+        await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+        self.assertIn("join", [frame["type"] for frame in await frames(client)])
+        await client.disconnect()
+
+    @with_worker(resume_grace=1)
+    async def test_a_token_resumes_the_seat_on_a_new_connection(self):
+        first, joined = await self.join("blackjack/resume1/", "ann")
+        token = joined[0]["token"]
+        await first.disconnect()
+        await asyncio.sleep(0.1)
+        second = await connect("blackjack/resume1/")
+        await frames(second)
+        await second.send_to(text_data=json.dumps({"type": "resume", "token": token}))
+        self.assertEqual([frame for frame in await frames(second) if frame["type"] == "join"],
+                         [{"type": "join", "name": "ann", "chips": 100, "token": token}])
+        await second.send_to(text_data=json.dumps({"type": "resume", "token": token}))
+        self.assertEqual([frame for frame in await frames(second) if frame["type"] == "error"],
+                         [{"type": "error", "message": "Already seated as ann"}])
+        # The seat's release was cancelled.
+        self.assertEqual(rooms.worker.rooms["resume1"].releases, {})
+        await second.disconnect()
+
+    @with_worker(resume_grace=0.1)
+    async def test_a_token_expires_with_its_seat(self):
+        first, joined = await self.join("blackjack/resume2/", "ann")
+        await first.disconnect()
+        await asyncio.sleep(0.3)
+        second = await connect("blackjack/resume2/")
+        await frames(second)
+        for token in (joined[0]["token"], "made up"):
+            await second.send_to(text_data=json.dumps({"type": "resume", "token": token}))
+            self.assertEqual([frame for frame in await frames(second) if frame["type"] in ("join", "error")],
+                             [{"type": "error", "message": "Unknown or expired session"}])
+        await second.disconnect()
+
+    @with_worker
+    async def test_long_names_are_rejected(self):
+        client, joined = await self.join("blackjack/seats3/", "x" * 101)
+        self.assertEqual(joined, [{"type": "error", "message": "Names are 1 to 100 characters long"}])
+        await client.disconnect()
+
+
+class RoundLogTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "room.bjlog")
+
+    def play(self, engine, rounds, names=("ann", "bob"), writer=None):
+        # Logs the way RoomActor does, flushing once a round.
+        log = RoundLog(self.path, writer)
+        log.start("room", engine)
+
+        def apply(action_type, player_name=None, **params):
+            events = engine.apply(action_type, player_name, **params)
+            if events and events[0]["type"] == "shuffle":
+                log.shoe(engine.shoe)
+            log.action(action_type, player_name, params)
+            return events
+
+        for name in names:
+            apply("join", name, chips=1000)
+        for _ in range(rounds):
+            for name in names:
+                apply("bet", name, amount=10)
+            events = apply("deal")
+            for name in names:
+                player = engine.players[name]
+                while engine.turns[name] < len(player.hands):
+                    hand_index = engine.turns[name]
+                    action = "hit" if player.hands[hand_index].value < 17 else "stand"
+                    events = apply(action, name, hand_index=hand_index)
+            log.settle(events)
+            apply("new_round")
+            log.flush()
+        log.close()
+
+    def test_rounds_replay_exactly(self):
+        self.play(BlackjackEngine(shoe=Shoe(2, FastShuffle(0)), reshuffle_at=30), 50)
+        rounds, mismatches, selected = verify(self.path, 7)
+        self.assertEqual((rounds, mismatches, selected.number), (50, [], 7))
+
+    def test_rounds_written_in_the_background_replay(self):
+        writer = LogWriter()
+        writer.start()
+        self.play(BlackjackEngine(shoe=Shoe(2, FastShuffle(0)), reshuffle_at=30), 30, writer=writer)
+        writer.stop()
+        rounds, mismatches, _ = verify(self.path)
+        self.assertEqual((rounds, mismatches), (30, []))
+
+    async def test_rooms_log_through_the_writer(self):
+        writer = LogWriter()
+        writer.start()
+
+        @with_worker(log_dir=os.path.dirname(self.path), log_writer=writer)
+        async def play(self):
+            client = await connect("blackjack/room/")
+            await client.send_to(text_data=json.dumps({"type": "join", "name": "ann", "chips": 100}))
+            await frames(client)
+            await client.send_to(text_data=json.dumps({"type": "deal", "bet": 10}))
+            await frames(client)
+            await client.send_to(text_data=json.dumps({"type": "stand"}))
+            await frames(client)
+            await client.disconnect()
+
+        await play(self)
+        writer.stop()
+        rounds, mismatches, _ = verify(self.path)
+        self.assertEqual((rounds, mismatches), (1, []))
+
+    def test_mid_round_reshuffles_replay(self):
+        engine = BlackjackEngine(shoe=Shoe(1, FastShuffle(0)), reshuffle_at=0)
+        self.play(engine, 40, names=["player%d" % index for index in range(7)])
+        rounds, mismatches, _ = verify(self.path)
+        self.assertEqual((rounds, mismatches), (40, []))
+
+    def test_a_cut_off_record_ends_the_log(self):
+        self.play(BlackjackEngine(shoe=Shoe(2, FastShuffle(0))), 5)
+        # Cuts the last record, the new_round after the fifth settlement.
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        rounds, mismatches, _ = verify(self.path)
+        self.assertEqual((rounds, mismatches), (5, []))
+
+
+class MetricsTests(SimpleTestCase):
+    @with_worker
+    async def test_metrics_are_rendered_on_the_event_loop(self):
+        client = await connect("blackjack/metrics/")
+        await frames(client)
+        response = await self.async_client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"\nblackjack_rooms 1\n", response.content)
+        await client.disconnect()
+
+
+class HintTests(SimpleTestCase):
+    async def send(self, client, message):
+        await client.send_to(text_data=json.dumps(message))
+        return [frame for frame in await frames(client) if frame["type"] in ("hint", "error")]
+
+    @with_worker(bet_window=0.1, action_timeout=30)
+    async def test_hints_need_a_hand_in_play(self):
+        player = await connect("blackjack/hints/")
+        watcher = await connect("blackjack/hints/")
+        await self.send(player, {"type": "join", "name": "ann", "chips": 100})
+        await self.send(watcher, {"type": "join", "name": "bob", "chips": 100})
+        await self.send(player, {"type": "deal", "bet": 10})
+        await asyncio.sleep(0.2)
+        await frames(player)
+        await frames(watcher)
+        self.assertEqual(await self.send(watcher, {"type": "hint"}),
+                         [{"type": "error", "message": "You aren't playing this round"}])
+        self.assertEqual(await self.send(player, {"type": "hint", "hand": -1}),
+                         [{"type": "error", "message": "Invalid hand index"}])
+        self.assertEqual((await self.send(player, {"type": "hint"}))[0]["type"], "hint")
+        await player.disconnect()
+        await watcher.disconnect()
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+class LobbyTests(SimpleTestCase):
+    def test_parse_query(self):
+        self.assertEqual(lobby.parse_query({}), (None, lobby.PAGE_SIZE, None))
+        self.assertEqual(lobby.parse_query({"after": "b", "limit": "1000", "min_players": "2"}),
+                         ("b", lobby.MAX_PAGE_SIZE, {"phase": None, "prefix": "", "min_players": 2,
+                                                     "max_players": None}))
+        for query in ({"prefix": 5}, {"phase": ["betting"]}, {"after": {}}, {"limit": "ten"},
+                      {"min_players": 1.5}, {"max_players": True}):
+            with self.assertRaises(ValueError):
+                lobby.parse_query(query)
+
+    async def test_full_listings_only_go_to_workers(self):
+        layer = RecordingLayer()
+        index = lobby.Lobby("default", layer, Scheduler())
+        index.update("room", 1, 1, "betting", 0)
+        await index.publish(dict(index.local), True)
+        await index.publish(dict(index.local), False)
+        self.assertEqual([group for group, _ in layer.sent], [lobby.WORKER_GROUP, lobby.LOBBY_GROUP])
+        self.assertNotIn("text", layer.sent[0][1])
+
+    def test_paging(self):
+        index = lobby.Lobby("default", RecordingLayer(), Scheduler())
+        index.apply("default", {"room%d" % number: ["room%d" % number, number, 0, "betting", 0]
+                                for number in range(5)})
+        page = index.page(limit=2)
+        self.assertEqual(([entry[0] for entry in page["rooms"]], page["next"]), (["room0", "room1"], "room1"))
+        page = index.page(after="room1", limit=2, filters=lobby.parse_query({"min_players": "3"})[2])
+        self.assertEqual([entry[0] for entry in page["rooms"]], ["room3", "room4"])
+
+    @with_worker
+    async def test_bad_messages_get_an_error(self):
+        client = await connect("lobby/")
+        await frames(client)
+        for message in ("[1]", '"list"', '{"type": "list", "prefix": 5}'):
+            await client.send_to(text_data=message)
+            self.assertEqual((await frames(client))[0]["type"], "error")
+        await client.send_to(text_data='{"type": "list"}')
+        self.assertEqual((await frames(client))[0]["type"], "rooms")
+        await client.disconnect()
+
+
+class BenchShuffleTests(SimpleTestCase):
+    def test_small_run_without_reads(self):
+        out = io.StringIO()
+        call_command("bench_shuffle", rooms=10, repeat=2, stdout=out)
+        self.assertIn("n/a shoes per os.urandom read", out.getvalue())
+
+
+class LoadTestTests(SimpleTestCase):
+    @with_worker
+    async def test_bots_play_every_round(self):
+        report = await run_bots(lambda path: CommunicatorConnection(application, path), "inprocess", 2, 2, 3)
+        result = report.as_dict()
+        self.assertEqual(result["clients"], 4)
+        self.assertEqual(result["rounds"], 12)
+        self.assertEqual(result["errors"], 0)
+        self.assertGreater(result["actions"], 0)
+
+    def test_percentiles(self):
+        stats = Stats()
+        stats.latencies = [i / 1000 for i in range(1, 101)]
+        report = Report("inprocess", 1, 1, stats, 1.0, None)
+        self.assertEqual(report.percentile(0.5), 0.051)
+        self.assertEqual(report.percentile(0.99), 0.1)
+        self.assertEqual(Report("inprocess", 1, 1, Stats(), 1.0, None).percentile(0.5), 0.0)
+
+
+class ShoePoolTests(SimpleTestCase):
+    def wait_until_full(self, pool, count):
+        for _ in range(100):
+            if len(pool.orders[count]) == pool.size:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(pool.orders[count]), pool.size)
+
+    def test_an_empty_pool_shuffles_in_place(self):
+        pool = ShoePool(size=4)
+        misses = pool.misses.value
+        codes = array("B", range(52)) * 6
+        pool.shuffle(codes)
+        self.assertEqual(sorted(codes), sorted(array("B", range(52)) * 6))
+        self.assertEqual(pool.misses.value, misses + 1)
+        # The miss asks for shoes of that size.
+        self.assertTrue(pool.wanted.is_set())
+        self.assertEqual(list(pool.orders), [312])
+
+    def test_shoes_come_from_the_pool_once_filled(self):
+        pool = ShoePool(size=4)
+        pool.start()
+        try:
+            pool.shuffle(array("B", range(52)) * 6)
+            self.wait_until_full(pool, 312)
+            hits = pool.hits.value
+            ready = list(pool.orders[312])
+            codes = array("B", range(52)) * 6
+            pool.shuffle(codes)
+            self.assertEqual(codes, ready[0])
+            self.assertEqual(pool.hits.value, hits + 1)
+            # Taking the pool below half tops it up again.
+            pool.shuffle(codes)
+            pool.shuffle(codes)
+            self.wait_until_full(pool, 312)
+        finally:
+            pool.stop()
+
+
+class ProfilesViewTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.client.force_login(User.objects.create_user("admin", is_staff=True))
+        rooms.worker = rooms.RoomWorker("default", ["default"], history=None)
+
+    def tearDown(self):
+        rooms.worker = None
+
+    def test_bad_input_is_rejected(self):
+        for data in ({"room_name": "../x"}, {"room_name": ""}, {"room_name": "room", "kind": "disk"},
+                     {"room_name": "room", "rounds": "lots"}, {"room_name": "room", "rounds": "0"}):
+            self.assertEqual(self.client.post("/profiles", data).status_code, 400)
+        self.assertEqual(self.client.post("/profiles", {"room_name": "room", "rounds": "2"}).status_code, 404)
+        self.assertEqual(rooms.worker.rooms, {})
@@ -3,5 +3,8 @@ from . import views
 
 urlpatterns = [
     path('', views.blackjack, name='blackjack'),
-    path('ws/blackjack/', views.blackjack_ws),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('lobby', views.lobby_view, name='lobby'),
+    path('profiles', views.profiles_view, name='profiles'),
+    path('profiles/<str:name>', views.profile_download, name='profile_download'),
 ]
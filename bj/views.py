@@ -1,7 +1,18 @@
+import re
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.views.generic import TemplateView
 
+from bj import metrics
+from bj.lobby import parse_query
+from bj.profiling import KINDS, list_profiles, profile_path
+from bj.rooms import get_worker
+
 
 # def blackjack(request):
 #     return render(request, 'test.html')
@@ -17,3 +28,59 @@ class CreateRoomView(TemplateView):
 
 def blackjack(request, room_name):
     return render(request, 'test.html', {'room_name': room_name})
+
+
+async def metrics_view(request):
+    # Async so that the gauges, which walk the rooms, run on the event loop
+    # that changes them.
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+async def lobby_view(request):
+    try:
+        after, limit, filters = parse_query(request.GET)
+    except ValueError as e:
+        return JsonResponse({"type": "error", "message": str(e)}, status=400)
+    return JsonResponse(get_worker().lobby.page(after, limit, filters))
+
+
+async def submit_profile(room_name, kind, rounds):
+    worker = get_worker()
+    if room_name not in worker.rooms and room_name not in worker.lobby.rooms:
+        return False
+    await worker.submit(room_name, "profile", kind=kind, rounds=rounds)
+    return True
+
+
+@staff_member_required
+def profiles_view(request):
+    if request.method == "POST":
+        # Room names end up in file paths, so only accept what bj.routing does.
+        room_name = request.POST.get("room_name", "")
+        kind = request.POST.get("kind", "cpu")
+        if not re.fullmatch(r"\w+", room_name):
+            return HttpResponseBadRequest("Bad room name")
+        if kind not in KINDS + ("stop",):
+            return HttpResponseBadRequest("Bad profile kind")
+        try:
+            rounds = int(request.POST.get("rounds") or 1)
+        except ValueError:
+            rounds = 0
+        if rounds < 1:
+            return HttpResponseBadRequest("Rounds must be a positive integer")
+        if not async_to_sync(submit_profile)(room_name, kind, rounds):
+            raise Http404("No such room")
+        messages.info(request, "Sent %s to room %s" % (kind, room_name))
+        return redirect("profiles")
+    return render(request, "profiles.html", {
+        "profiles": list_profiles(settings.BLACKJACK_PROFILE_DIR),
+        "kinds": KINDS,
+    })
+
+
+@staff_member_required
+def profile_download(request, name):
+    path = profile_path(settings.BLACKJACK_PROFILE_DIR, name)
+    if path is None:
+        raise Http404("No such profile")
+    return FileResponse(open(path, "rb"), as_attachment=True, filename=name)
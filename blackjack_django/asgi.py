@@ -12,8 +12,6 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 from channels.auth import AuthMiddlewareStack
-from bj.blackjack import Shoe, Dealer, Player
-from bj.models import User
 
 import bj.routing
 
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -76,11 +77,97 @@ TEMPLATES = [
 WSGI_APPLICATION = 'blackjack_django.wsgi.application'
 ASGI_APPLICATION = 'blackjack_django.asgi.application'
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+REDIS_URL = os.environ.get('REDIS_URL')
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
     }
-}
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+
+# Rooms are pinned to one of these worker processes by consistent hashing of
+# the room name; every process must list the same workers and set its own id.
+BLACKJACK_WORKERS = os.environ.get('BLACKJACK_WORKERS', 'default').split(',')
+BLACKJACK_WORKER_ID = os.environ.get('BLACKJACK_WORKER_ID', BLACKJACK_WORKERS[0])
+
+# Seconds from the first bet until the round is dealt, and that a player may
+# take to act before their hand is stood.
+BLACKJACK_BET_WINDOW = float(os.environ.get('BLACKJACK_BET_WINDOW', 10))
+BLACKJACK_ACTION_TIMEOUT = float(os.environ.get('BLACKJACK_ACTION_TIMEOUT', 30))
+
+# Shoes in rooms shuffle with "system", the OS CSPRNG, or "fast", a seedable
+# PRNG for tests and load tests that must not be used for real play. With
+# BLACKJACK_SHUFFLE_SEED set, each room's "fast" generator is seeded from it
+# and the room name.
+BLACKJACK_SHUFFLE = os.environ.get('BLACKJACK_SHUFFLE', 'system')
+BLACKJACK_SHUFFLE_SEED = int(os.environ['BLACKJACK_SHUFFLE_SEED']) if os.environ.get('BLACKJACK_SHUFFLE_SEED') else None
+
+# Rooms reshuffle once BLACKJACK_PENETRATION of the shoe has been dealt.
+# Shoes for rooms on the "system" shuffle come from a pool of
+# BLACKJACK_SHOE_POOL_SIZE shoes per shoe size, shuffled ahead of time by a
+# background thread; 0 shuffles on the spot.
+BLACKJACK_PENETRATION = float(os.environ.get('BLACKJACK_PENETRATION', 0.75))
+if not 0 < BLACKJACK_PENETRATION < 1:
+    raise ImproperlyConfigured("BLACKJACK_PENETRATION must be between 0 and 1")
+BLACKJACK_SHOE_POOL_SIZE = int(os.environ.get('BLACKJACK_SHOE_POOL_SIZE', 64))
+
+# Most chips a player can sit down with.
+BLACKJACK_MAX_CHIPS = int(os.environ.get('BLACKJACK_MAX_CHIPS', 10 ** 9))
+
+# Seconds a seat is kept after its last connection drops, for the player to
+# resume it with their session token.
+BLACKJACK_RESUME_GRACE = float(os.environ.get('BLACKJACK_RESUME_GRACE', 60))
+
+# Bankrolls and round history are written to the database in the background,
+# in batches of up to BLACKJACK_HISTORY_BATCH_SIZE rounds collected for at
+# most BLACKJACK_HISTORY_FLUSH_INTERVAL seconds. A name sits at one table at
+# a time per worker only: with several BLACKJACK_WORKERS it can be seated in
+# rooms owned by different workers, and the last of them to save its
+# bankroll wins.
+BLACKJACK_HISTORY = os.environ.get('BLACKJACK_HISTORY', '1') == '1'
+BLACKJACK_HISTORY_BATCH_SIZE = 500
+BLACKJACK_HISTORY_FLUSH_INTERVAL = 0.5
+
+# Directory for the per-room append-only round logs (see bj.roundlog). They
+# are off unless it is set.
+BLACKJACK_ROUND_LOG_DIR = os.environ.get('BLACKJACK_ROUND_LOG_DIR', '')
+
+# Rooms nobody is using are evicted after BLACKJACK_ROOM_IDLE_TIMEOUT seconds,
+# or sooner, least recently used first, once a worker hosts more than
+# BLACKJACK_MAX_ROOMS. With BLACKJACK_ROOM_SPILL_DIR set, an evicted room's
+# shoe and round count are saved there until the room is used again.
+BLACKJACK_ROOM_IDLE_TIMEOUT = float(os.environ.get('BLACKJACK_ROOM_IDLE_TIMEOUT', 300))
+BLACKJACK_MAX_ROOMS = int(os.environ.get('BLACKJACK_MAX_ROOMS', 10000))
+BLACKJACK_ROOM_SPILL_DIR = os.environ.get('BLACKJACK_ROOM_SPILL_DIR', '')
+
+# How often workers send lobby subscribers the rooms that changed, and send
+# each other every room they host.
+BLACKJACK_LOBBY_INTERVAL = 1.0
+BLACKJACK_LOBBY_RESYNC = 30
+
+# Where room profiles taken at runtime are written (see bj.profiling).
+BLACKJACK_PROFILE_DIR = os.environ.get('BLACKJACK_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+
+# Structured logs of the "bj" logger, as JSON lines on stderr or in
+# BLACKJACK_LOG_FILE. Room debug events are sampled 1 in BLACKJACK_LOG_SAMPLE
+# (0 turns them off), overridden per room in BLACKJACK_LOG_ROOMS, e.g.
+# {"vip": 1} to keep everything; room warnings and errors are limited to
+# BLACKJACK_LOG_RATE per second.
+BLACKJACK_LOG_LEVEL = os.environ.get('BLACKJACK_LOG_LEVEL', 'INFO')
+BLACKJACK_LOG_FILE = os.environ.get('BLACKJACK_LOG_FILE', '')
+BLACKJACK_LOG_SAMPLE = int(os.environ.get('BLACKJACK_LOG_SAMPLE', 100))
+BLACKJACK_LOG_ROOMS = {}
+BLACKJACK_LOG_RATE = 10
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases